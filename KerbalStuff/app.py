@@ -1,3 +1,4 @@
+import atexit
 import hashlib
 import hmac
 import json
@@ -27,13 +28,18 @@ from .blueprints.login_oauth import list_defined_oauths, login_oauth
 from .blueprints.mods import mods
 from .blueprints.profile import profiles
 from .celery import update_from_github
-from .common import first_paragraphs, many_paragraphs, json_output, jsonify_exception, dumb_object, sanitize_text
+from .cache import RenderCache
+from .common import first_paragraphs, many_paragraphs, json_output, jsonify_exception, dumb_object, sanitize_text, \
+    SANITIZE_FINGERPRINT
 from .config import _cfg, _cfgb, _cfgd, _cfgi, site_logger
 from .custom_json import CustomJSONEncoder
-from .database import db
+from .database import db, start_query_stats, get_query_stats, stop_query_stats
 from .helpers import is_admin, following_mod
-from .kerbdown import KerbDown
+from .kerbdown import KerbDown, fingerprint as kerbdown_fingerprint
 from .objects import User, BlogPost
+from .metrics import ENDPOINT_KEY
+from .profiling import QUERY_STATS_KEY, prune_in_background
+from .sampler import StackSampler, SAMPLE_INTERVAL_MS, SAMPLE_WINDOW
 
 app = Flask(__name__, template_folder='../templates')
 # https://flask.palletsprojects.com/en/1.1.x/security/#set-cookie-options
@@ -50,11 +56,15 @@ if not app.debug:
         REMEMBER_COOKIE_SECURE=True
     )
 app.jinja_env.filters['first_paragraphs'] = first_paragraphs
-app.jinja_env.filters['bleach'] = sanitize_text
 app.jinja_env.auto_reload = app.debug
 app.secret_key = _cfg("secret-key")
 app.json_encoder = CustomJSONEncoder
 Markdown(app, extensions=[KerbDown(), 'fenced_code'])
+# Only render descriptions etc. again when they change
+render_cache_chars = _cfgi('render-cache-mb', 64) * 1024 * 1024
+app.jinja_env.filters['markdown'] = RenderCache('markdown', app.jinja_env.filters['markdown'],
+                                                kerbdown_fingerprint() + '-fenced_code', render_cache_chars)
+app.jinja_env.filters['bleach'] = RenderCache('bleach', sanitize_text, SANITIZE_FINGERPRINT, render_cache_chars)
 login_manager = LoginManager(app)
 
 prof_dir = _cfg('profile-dir')
@@ -64,6 +74,16 @@ if prof_dir:
     Path(prof_dir).mkdir(parents=True, exist_ok=True)
     app.wsgi_app = ConditionalProfilerMiddleware(  # type: ignore[assignment]
         app.wsgi_app, stream=None, profile_dir=prof_dir, sampling_function=sampling_function)
+sample_interval = _cfgi('sample-interval-ms', SAMPLE_INTERVAL_MS)
+sampler = (StackSampler(prof_dir, sample_interval / 1000, _cfgi('sample-window', SAMPLE_WINDOW))
+           if prof_dir and sample_interval > 0 else None)
+if sampler:
+    # Don't lose the window we're in when the worker process shuts down
+    atexit.register(sampler.flush)
+
+if _cfg('metrics-dir'):
+    from .middleware.metrics import MetricsMiddleware
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)  # type: ignore[assignment]
 
 
 @login_manager.user_loader
@@ -267,6 +287,55 @@ def find_dnt() -> None:
     g.do_not_track = do_not_track
 
 
+def request_route() -> str:
+    # Not the path of requests that match no route, or every 404 would get its own
+    return f'{request.method} {request.url_rule.rule if request.url_rule else "none"}'
+
+
+@app.before_request
+def start_query_timing() -> None:
+    # Also for the profiler middleware, which looks at them after we're done
+    request.environ[QUERY_STATS_KEY] = start_query_stats(request_route())
+
+
+@app.before_request
+def remember_endpoint() -> None:
+    # For the metrics middleware, which only looks at the request after we're done
+    request.environ[ENDPOINT_KEY] = request.endpoint
+
+
+@app.before_request
+def start_sampling() -> None:
+    if sampler:
+        sampler.start(request_route())
+
+
+@app.after_request
+def add_server_timing(response: werkzeug.wrappers.Response) -> werkzeug.wrappers.Response:
+    stats = get_query_stats()
+    if stats:
+        response.headers.add('Server-Timing', f'db;dur={stats.seconds * 1000:.1f};desc="{stats.count} queries"')
+    return response
+
+
+@app.teardown_request
+def stop_query_timing(exc: Optional[BaseException]) -> None:
+    stop_query_stats()
+
+
+@app.teardown_request
+def stop_sampling(exc: Optional[BaseException]) -> None:
+    if sampler:
+        sampler.stop()
+
+
+@app.teardown_request
+def prune_profiles(exc: Optional[BaseException]) -> None:
+    # Here rather than in Celery, the worker might not see profile-dir
+    if prof_dir:
+        prune_in_background(prof_dir)
+
+
 @app.context_processor
 def inject() -> Dict[str, Any]:
     protocol = _cfg('protocol')
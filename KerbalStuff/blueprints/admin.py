@@ -1,11 +1,14 @@
+import json
+from collections import Counter
 import math
+import time
 from typing import Union, List, Tuple, Dict, Any
 import datetime
 from datetime import timezone
 from pathlib import Path
 from subprocess import run, PIPE
 
-from flask import Blueprint, render_template, redirect, request, abort, url_for
+from flask import Blueprint, render_template, redirect, request, abort, url_for, Response
 from flask_login import login_user, current_user
 from sqlalchemy import desc, or_, func
 from sqlalchemy.orm import Query
@@ -15,7 +18,11 @@ from ..common import adminrequired, with_session, TRUE_STR
 from ..config import _cfg
 from ..database import db
 from ..email import send_bulk_email
+from ..metrics import collect
 from ..objects import Mod, GameVersion, Game, Publisher, User
+from ..profiling import parse_prof_filename, search_profiles
+from ..sampler import DAY, load_folded, render_svg, sample_files
+from ..search import invalidate_game_versions
 
 admin = Blueprint('admin', __name__, template_folder='../../templates/admin')
 ITEMS_PER_PAGE = 10
@@ -33,65 +40,35 @@ def profiling(page: int) -> Union[str, werkzeug.wrappers.Response]:
     if page < 1:
         return redirect(url_for('admin.profiling', page=1, **request.args))
     prof_dir = _cfg('profile-dir')
-    profilings = [] if not prof_dir else list(map(
-        parse_prof_filename,
-        sorted(Path(prof_dir).glob('*.prof'),
-               key=lambda p: -p.stat().st_mtime)))
     query = request.args.get('query', type=str)
-    if query:
-        terms = query.split(' ')
-        profilings = [p for p in profilings
-                      if all(map(lambda t: query_term_matches(t, p), terms))]
-    total_pages = max(1, math.ceil(len(profilings) / ITEMS_PER_PAGE))
-    profilings = profilings[(page - 1) * ITEMS_PER_PAGE : page * ITEMS_PER_PAGE]
+    total, rows = search_profiles(prof_dir, query, (page - 1) * ITEMS_PER_PAGE, ITEMS_PER_PAGE) \
+        if prof_dir else (0, [])
+    total_pages = max(1, math.ceil(total / ITEMS_PER_PAGE))
+    profilings = [load_query_stats(prof_dir, profiling_info(name, route, started, duration_ms))
+                  for name, route, started, duration_ms in rows] if prof_dir else []
     return render_template("admin-profiling.html",
                            profilings=profilings, query=query,
                            page=page, total_pages=total_pages)
 
 
-def parse_prof_filename(p: Path) -> Dict[str, Any]:
-    pieces = p.name.split('.')
-    route_pieces = pieces[1:-3]
-    # ProfilerMiddleware uses 'root' as the route when it's '/', which doesn't help us
-    if len(route_pieces) == 1 and route_pieces[0] == 'root':
-        route_pieces = []
+def profiling_info(name: str, route: str, started: float, duration_ms: int) -> Dict[str, Any]:
     return {
-        'name': p.name,
-        'route': '/' + '/'.join(route_pieces),
-        'timestamp': datetime.datetime.fromtimestamp(float(pieces[-2]), tz=timezone.utc),
-        # The 'ms' suffix is hard coded in the default format string, it's always milliseconds
-        'duration':  datetime.timedelta(milliseconds=int(pieces[-3].replace('ms', ''))),
-        'svg_url': url_for('admin.profiling_viz_svg', name=p.name),
+        'name': name,
+        'route': route,
+        'timestamp': datetime.datetime.fromtimestamp(started, tz=timezone.utc),
+        'duration':  datetime.timedelta(milliseconds=duration_ms),
+        'svg_url': url_for('admin.profiling_viz_svg', name=name),
     }
 
 
-def query_term_matches(term: str, profiling: Dict[str, Any]) -> bool:
+def load_query_stats(prof_dir: str, profiling: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the database.QueryStats saved along with a profile, if any, as 'query_stats'"""
     try:
-        if term.startswith('<'):
-            # Durations less than remainder of string
-            max_dur = datetime.timedelta(milliseconds=int(term[1:]))
-            return max_dur >= profiling['duration']
-        elif term.startswith('>'):
-            # Durations greater than remainder of string
-            min_dur = datetime.timedelta(milliseconds=int(term[1:]))
-            return min_dur <= profiling['duration']
-        elif term.startswith('start:'):
-            # Started on or after this date
-            min_date = datetime.date(*map(int, term[6:].split('-')))
-            return min_date <= profiling['timestamp'].date()
-        elif term.startswith('end:'):
-            # Started on or before this date
-            max_date = datetime.date(*map(int, term[4:].split('-')))
-            return max_date >= profiling['timestamp'].date()
-        elif term.startswith('!'):
-            # Match the route, inverted
-            return term[1:] not in profiling.get('route', '')
-        else:
-            # Match the route
-            return term in profiling.get('route', '')
-    except:
-        # Malformed search string
-        return False
+        with open(Path(prof_dir) / (profiling['name'] + '.json')) as f:
+            profiling['query_stats'] = json.load(f)
+    except (OSError, ValueError):
+        profiling['query_stats'] = None
+    return profiling
 
 
 @admin.route("/admin/profiling_viz/<name>")
@@ -99,7 +76,7 @@ def query_term_matches(term: str, profiling: Dict[str, Any]) -> bool:
 def profiling_viz(name: str) -> Union[str, werkzeug.wrappers.Response]:
     prof_dir = _cfg('profile-dir')
     return (render_template("admin-profiling-viz.html",
-                            profiling=parse_prof_filename(Path(prof_dir) / name))
+                            profiling=load_query_stats(prof_dir, profiling_info(name, *parse_prof_filename(name))))
             if prof_dir else redirect(url_for('admin.profiling', page=1)))
 
 
@@ -107,8 +84,47 @@ def profiling_viz(name: str) -> Union[str, werkzeug.wrappers.Response]:
 @adminrequired
 def profiling_viz_svg(name: str) -> Union[str, werkzeug.wrappers.Response]:
     prof_dir = _cfg('profile-dir')
-    return (run(['flameprof', Path(prof_dir) / name], stdout=PIPE).stdout.decode('utf-8')
-            if prof_dir else '')
+    if not prof_dir:
+        return ''
+    # Drawing a flame graph takes a while, and profiles don't change
+    svg_path = Path(prof_dir) / (name + '.svg')
+    if not svg_path.is_file():
+        result = run(['flameprof', Path(prof_dir) / name], stdout=PIPE)
+        if result.returncode != 0:
+            return result.stdout.decode('utf-8')
+        tmp_path = svg_path.with_suffix('.svg.tmp')
+        tmp_path.write_bytes(result.stdout)
+        tmp_path.replace(svg_path)
+    return Response(svg_path.read_bytes(), mimetype='image/svg+xml')
+
+
+@admin.route("/admin/metrics")
+@adminrequired
+def metrics() -> werkzeug.wrappers.Response:
+    return Response(collect(), mimetype='text/plain; version=0.0.4')
+
+
+@admin.route("/admin/profiling/samples")
+@adminrequired
+def profiling_samples() -> Union[str, werkzeug.wrappers.Response]:
+    prof_dir = _cfg('profile-dir')
+    days = request.args.get('days', 1, type=int)
+    routes = load_folded(sample_files(prof_dir, time.time() - days * DAY)) if prof_dir else dict()
+    endpoints = sorted(((route, sum(stacks.values())) for route, stacks in routes.items()),
+                       key=lambda e: -e[1])
+    return render_template("admin-profiling-samples.html",
+                           endpoints=endpoints, total=sum(count for _, count in endpoints),
+                           days=days, route=request.args.get('route', type=str))
+
+
+@admin.route("/admin/profiling/samples_svg")
+@adminrequired
+def profiling_samples_svg() -> werkzeug.wrappers.Response:
+    prof_dir = _cfg('profile-dir')
+    route = request.args.get('route', '', type=str)
+    days = request.args.get('days', 1, type=int)
+    routes = load_folded(sample_files(prof_dir, time.time() - days * DAY)) if prof_dir else dict()
+    return Response(render_svg(routes.get(route, Counter()), route), mimetype='image/svg+xml')
 
 
 @admin.route("/admin/users/<int:page>")
@@ -231,12 +247,12 @@ def email() -> Union[str, werkzeug.wrappers.Response]:
     modders_only = request.form.get('modders-only') == 'on'
     if not subject or not body:
         abort(400)
-    users = User.query
+    emails = db.query(User.email)
     if modders_only:
-        users = db.query(User.email) \
+        emails = emails \
             .filter(or_(User.username == current_user.username,
                         db.query(Mod.id).filter(Mod.user_id == User.id).exists()))
-    send_bulk_email([u.email for u in users], subject, body)
+    send_bulk_email(emails, subject, body)
     return redirect(url_for('admin.email'))
 
 
@@ -304,6 +320,7 @@ def create_version() -> werkzeug.wrappers.Response:
         return game_versions(1, 'A version by that name already exists for that game!')
     db.add(GameVersion(friendly_version=friendly, game_id=gid))
     db.commit()
+    invalidate_game_versions(int(gid))
     return redirect(url_for('admin.game_versions', page=1, **request.args))
 
 
@@ -1,15 +1,18 @@
 import os.path
+from typing import Callable, Iterable
 
 import werkzeug.wrappers
 from flask import Blueprint, render_template, send_from_directory, abort, request, Response
 from flask_login import current_user
+from markupsafe import Markup
 from sqlalchemy import desc
 
-from ..common import dumb_object, paginate_query, get_paginated_mods, get_game_info, get_games, \
+from ..cache import cached_fragment, game_fragment_key
+from ..common import dumb_object, paginate_query, paginate_keyset, get_paginated_mods, get_game_info, get_games, \
     get_featured_mods, get_top_mods, get_new_mods, get_updated_mods
 from ..config import _cfg
 from ..database import db
-from ..objects import Featured, Mod, ModVersion, User
+from ..objects import Featured, Mod, ModVersion
 
 anonymous = Blueprint('anonymous', __name__, template_folder='../../templates/anonymous')
 
@@ -22,25 +25,30 @@ def index() -> str:
 @anonymous.route("/<gameshort>")
 def game(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
-    featured = get_featured_mods(ga.id, 6)
-    top = get_top_mods(ga.id, 6)
-    new = get_new_mods(ga.id, 6)
-    recent = get_updated_mods(ga.id, 6)
-    user_count = User.query.count()
-    mod_count = Mod.query.filter(Mod.game_id == ga.id, Mod.published == True).count()
     following = sorted(filter(lambda m: m.game_id == ga.id, current_user.following),
                        key=lambda m: m.updated, reverse=True)[:6] if current_user else list()
     return render_template("game.html",
                            ga=ga,
-                           featured=featured,
-                           new=new,
-                           top=top,
-                           recent=recent,
-                           user_count=user_count,
-                           mod_count=mod_count,
+                           featured=_game_section(ga.id, 'featured',
+                                                  lambda: [f.mod for f in get_featured_mods(ga.id, 6)]),
+                           new=_game_section(ga.id, 'new', lambda: get_new_mods(ga.id, 6)),
+                           top=_game_section(ga.id, 'top', lambda: get_top_mods(ga.id, 6)),
+                           recent=_game_section(ga.id, 'recent', lambda: get_updated_mods(ga.id, 6)),
                            yours=following)
 
 
+def _game_section(game_id: int, section: str, get_mods: Callable[[], Iterable[Mod]]) -> Markup:
+    """
+    The mod boxes of a section of a game's page. They're the same for all anonymous users,
+    so they're cached for them. Logged in users see which mods they follow.
+    """
+    def render() -> str:
+        return render_template("mod-boxes.html", mods=get_mods())
+    if current_user:
+        return Markup(render())
+    return cached_fragment(game_fragment_key(game_id, section), render)
+
+
 @anonymous.route("/content/<path:path>")
 def content(path: str) -> werkzeug.wrappers.Response:
     storage = _cfg('storage')
@@ -59,9 +67,9 @@ def browse() -> str:
 
 @anonymous.route("/browse/new")
 def browse_new() -> str:
-    mods = Mod.query.filter(Mod.published).order_by(desc(Mod.created))
-    mods, page, total_pages = paginate_query(mods)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages,
+    mods = Mod.query.filter(Mod.published)
+    mods, page, total_pages, next_after = paginate_keyset(mods, [Mod.created, Mod.id])
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
                            url="/browse/new", name="Newest Mods", rss="/browse/new.rss")
 
 
@@ -78,9 +86,9 @@ def browse_new_rss() -> Response:
 
 @anonymous.route("/browse/updated")
 def browse_updated() -> str:
-    mods = Mod.query.filter(Mod.published, Mod.versions.any(ModVersion.id != Mod.default_version_id)).order_by(desc(Mod.updated))
-    mods, page, total_pages = paginate_query(mods)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages,
+    mods = Mod.query.filter(Mod.published, Mod.versions.any(ModVersion.id != Mod.default_version_id))
+    mods, page, total_pages, next_after = paginate_keyset(mods, [Mod.updated, Mod.id])
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
                            url="/browse/updated", name="Recently Updated Mods", rss="/browse/updated.rss")
 
 
@@ -98,8 +106,8 @@ def browse_updated_rss() -> Response:
 
 @anonymous.route("/browse/top")
 def browse_top() -> str:
-    mods, page, total_pages = get_paginated_mods()
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages,
+    mods, page, total_pages, next_after = get_paginated_mods()
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
                            url="/browse/top", name="Popular Mods")
 
 
@@ -130,8 +138,8 @@ def browse_featured_rss() -> Response:
 
 @anonymous.route("/browse/all")
 def browse_all() -> str:
-    mods, page, total_pages = get_paginated_mods()
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages,
+    mods, page, total_pages, next_after = get_paginated_mods()
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
                            url="/browse/all", name="All Mods")
 
 
@@ -147,9 +155,9 @@ def singlegame_browse(gameshort: str) -> str:
 @anonymous.route("/<gameshort>/browse/new")
 def singlegame_browse_new(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
-    mods = Mod.query.filter(Mod.published, Mod.game_id == ga.id).order_by(desc(Mod.created))
-    mods, page, total_pages = paginate_query(mods)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, ga=ga,
+    mods = Mod.query.filter(Mod.published, Mod.game_id == ga.id)
+    mods, page, total_pages, next_after = paginate_keyset(mods, [Mod.created, Mod.id])
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after, ga=ga,
                            url="/browse/new", name="Newest Mods", rss="/browse/new.rss")
 
 
@@ -168,9 +176,9 @@ def singlegame_browse_new_rss(gameshort: str) -> Response:
 @anonymous.route("/<gameshort>/browse/updated")
 def singlegame_browse_updated(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
-    mods = Mod.query.filter(Mod.published, Mod.game_id == ga.id, Mod.versions.any(ModVersion.id != Mod.default_version_id)).order_by(desc(Mod.updated))
-    mods, page, total_pages = paginate_query(mods)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, ga=ga,
+    mods = Mod.query.filter(Mod.published, Mod.game_id == ga.id, Mod.versions.any(ModVersion.id != Mod.default_version_id))
+    mods, page, total_pages, next_after = paginate_keyset(mods, [Mod.updated, Mod.id])
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after, ga=ga,
                            url="/browse/updated", name="Recently Updated Mods", rss="/browse/updated.rss")
 
 
@@ -190,8 +198,8 @@ def singlegame_browse_updated_rss(gameshort: str) -> Response:
 @anonymous.route("/<gameshort>/browse/top")
 def singlegame_browse_top(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
-    mods, page, total_pages = get_paginated_mods(ga)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, ga=ga,
+    mods, page, total_pages, next_after = get_paginated_mods(ga)
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after, ga=ga,
                            url="/browse/top", name="Popular Mods")
 
 
@@ -226,8 +234,8 @@ def singlegame_browse_featured_rss(gameshort: str) -> Response:
 @anonymous.route("/<gameshort>/browse/all")
 def singlegame_browse_all(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
-    mods, page, total_pages = get_paginated_mods(ga)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, ga=ga,
+    mods, page, total_pages, next_after = get_paginated_mods(ga)
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after, ga=ga,
                            url="/browse/all", name="All Mods")
 
 
@@ -249,13 +257,15 @@ def privacy() -> str:
 @anonymous.route("/search")
 def search() -> str:
     query = request.args.get('query') or ''
-    mods, page, total_pages = get_paginated_mods(query=query)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, search=True, query=query)
+    mods, page, total_pages, next_after = get_paginated_mods(query=query)
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
+                           search=True, query=query, url="/search")
 
 
 @anonymous.route("/<gameshort>/search")
 def singlegame_search(gameshort: str) -> str:
     ga = get_game_info(short=gameshort)
     query = request.args.get('query') or ''
-    mods, page, total_pages = get_paginated_mods(ga, query)
-    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, search=True, query=query, ga=ga)
+    mods, page, total_pages, next_after = get_paginated_mods(ga, query)
+    return render_template("browse-list.html", mods=mods, page=page, total_pages=total_pages, next_after=next_after,
+                           search=True, query=query, ga=ga, url="/search")
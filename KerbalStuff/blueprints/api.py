@@ -1,5 +1,5 @@
-import math
 import os
+import shutil
 import time
 import zipfile
 from datetime import datetime
@@ -7,24 +7,34 @@ from functools import wraps
 from typing import Dict, Any, Callable, Optional, Tuple, Iterable, List, Union
 
 import bcrypt
+import werkzeug.wrappers
 from flask import Blueprint, url_for, current_app, request, abort
 from flask_login import login_user, current_user
-from sqlalchemy import desc, asc
+from sqlalchemy import desc
+from sqlalchemy.orm import joinedload, selectinload
+from werkzeug.urls import url_encode
 from werkzeug.utils import secure_filename
 
 from .accounts import check_password_criteria
+from .. import thumbnail
+from ..cache import cached_count
 from ..ckan import send_to_ckan, notify_ckan
-from ..common import json_output, paginate_query, with_session, get_paginated_mods, json_response, \
-    check_mod_editable, set_game_info, TRUE_STR, get_page
+from ..changes import changes_after, changes_cursor, parse_changes_cursor
+from ..common import json_output, paginate_query, paginate_keyset, with_session, get_paginated_mods, \
+    json_response, check_mod_editable, set_game_info, TRUE_STR, get_page
 from ..config import _cfg, _cfgi
 from ..database import db
 from ..email import send_update_notification, send_grant_notice, send_password_changed
 from ..objects import GameVersion, Game, Publisher, Mod, Featured, User, ModVersion, SharedAuthor, \
-    ModList
-from ..search import search_mods, search_users, typeahead_mods, get_mod_score
+    ModList, ModChange
+from ..search import search_users, typeahead_mods, get_mod_score
+from ..uploads import FileInfo, write_chunk, file_info, remove_abandoned_parts
 
 api = Blueprint('api', __name__)
 
+# Maximum number of changes returned by /api/changes at once
+CHANGES_PAGE_SIZE = 500
+
 default_description = """This is your mod listing! You can edit it as much as you like before you make it public.
 
 To edit **this** text, you can click on the "**Edit this Mod**" button up there.
@@ -58,7 +68,7 @@ def mod_info(mod: Mod) -> Dict[str, Any]:
         "downloads": mod.download_count,
         "followers": mod.follower_count,
         "author": mod.user.username,
-        "default_version_id": mod.default_version.id,
+        "default_version_id": mod.default_version_id,
         "shared_authors": list(),
         "background": mod.background,
         "bg_offset_y": mod.bgOffsetY,
@@ -70,20 +80,52 @@ def mod_info(mod: Mod) -> Dict[str, Any]:
     }
 
 
-def version_info(mod: Mod, version: ModVersion) -> Dict[str, Any]:
+def typeahead_info(mod: Mod) -> Dict[str, Any]:
+    # Keep this small, it's requested on every keystroke in the pack editor
+    default_version = mod.default_version
+    return {
+        "id": mod.id,
+        "name": mod.name,
+        "author": mod.user.username,
+        "thumbnail": mod.background_thumb() if mod.background else None,
+        "game": mod.game.name,
+        "short_description": mod.short_description,
+        "background": mod.background,
+        "bg_offset_y": mod.bgOffsetY,
+        "url": url_for("mods.mod", mod_id=mod.id, mod_name=mod.name),
+        "default_version": {
+            "friendly_version": default_version.friendly_version,
+            "game_version": default_version.gameversion.friendly_version,
+        } if default_version else None,
+    }
+
+
+def version_info(mod: Mod, version: ModVersion, download_path: Optional[str] = None) -> Dict[str, Any]:
     return {
         "friendly_version": version.friendly_version,
         "game_version": version.gameversion.friendly_version,
         "id": version.id,
         "created": version.created,
-        "download_path": url_for('mods.download', mod_id=mod.id,
-                                 mod_name=mod.name,
-                                 version=version.friendly_version),
+        "download_path": download_path or url_for('mods.download', mod_id=mod.id,
+                                                  mod_name=mod.name,
+                                                  version=version.friendly_version),
+        "download_size": version.download_size,
+        "download_hash": version.download_hash,
         "changelog": version.changelog,
         "downloads": version.download_count,
     }
 
 
+def mod_change_info(change: ModChange) -> Dict[str, Any]:
+    return {
+        "id": change.id,
+        "mod_id": change.mod_id,
+        "game_id": change.game_id,
+        "event_type": change.event_type,
+        "created": change.created,
+    }
+
+
 def game_version_info(version: ModVersion) -> Dict[str, str]:
     return {
         "id": version.id,
@@ -179,6 +221,7 @@ def _update_image(old_path: str, base_name: str, base_path: str) -> Optional[str
     except:
         pass  # who cares
     f.save(os.path.join(full_path, filename))
+    thumbnail.queue('/content/' + os.path.join(base_path, filename))
     return os.path.join(base_path, filename)
 
 
@@ -198,11 +241,79 @@ def _get_modversion_paths(mod_name: str, friendly_version: str) -> Tuple[str, st
     return (full_path, os.path.join(storage_base, filename))
 
 
+def _receive_zipball(full_path: str) -> Optional[FileInfo]:
+    """
+    Write the uploaded request.files['zipball'] to a part file next to full_path.
+    Dropzone sends big files in chunks, which we place by their dzchunkbyteoffset,
+    so they can arrive in any order. Once all chunks are there, the part file is moved
+    to full_path and its size and hash are returned, before that None.
+    Without an upload id the part file is shared by all uploads of this version,
+    so the chunks have to come in order, and the offsets are ignored.
+    """
+    total_chunks = int(request.form.get('dztotalchunkcount', 1))
+    chunk_index = int(request.form.get('dzchunkindex', 0))
+    if chunk_index == 0:
+        remove_abandoned_parts(os.path.dirname(full_path))
+    upload_id = secure_filename(request.form.get('dzuuid', ''))
+    part_path = f'{full_path}.{upload_id}.part' if upload_id else f'{full_path}.part'
+    offset = request.form.get('dzchunkbyteoffset', type=int) if upload_id else None
+    if offset is None:
+        # Start over, an aborted upload could have left a longer part file
+        if chunk_index == 0:
+            for path in (part_path, part_path + '.chunks'):
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.isfile(path):
+                    os.remove(path)
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    info = write_chunk(part_path, request.files['zipball'].stream, offset)
+    if total_chunks > 1:
+        # Remember which chunks we have, they might be written by different workers
+        received_path = part_path + '.chunks'
+        os.makedirs(received_path, exist_ok=True)
+        open(os.path.join(received_path, str(chunk_index)), 'w').close()
+        if len(os.listdir(received_path)) < total_chunks:
+            return None
+    try:
+        # Only one request gets to finish the upload, even if the last chunks arrive at once
+        os.replace(part_path, full_path)
+    except FileNotFoundError:
+        return None
+    if total_chunks > 1:
+        shutil.rmtree(part_path + '.chunks', ignore_errors=True)
+        info = file_info(full_path)
+    return info
+
+
+def _mod_list_response(mods: Iterable[Mod], page: int, next_after: Optional[str]) -> werkzeug.wrappers.Response:
+    """A list of mods, with a Link header pointing to the next page if there is one"""
+    response = json_response(serialize_mod_list(mods))
+    if next_after:
+        args = request.args.copy()
+        args['page'] = str(page + 1)
+        args['after'] = next_after
+        response.headers['Link'] = f'<{request.base_url}?{url_encode(args)}>; rel="next"'
+    return response
+
+
 def serialize_mod_list(mods: Iterable[Mod]) -> Iterable[Dict[str, Any]]:
+    mods = list(mods)
+    # Load everything mod_info and version_info need for all mods at once,
+    # instead of lazy loading it mod by mod
+    if mods:
+        Mod.query.options(joinedload(Mod.game),
+                          joinedload(Mod.user),
+                          selectinload(Mod.versions).joinedload(ModVersion.gameversion)) \
+            .filter(Mod.id.in_([m.id for m in mods])) \
+            .all()
+    # Download links are the mod's URL plus the version, no need for url_for for each of them
+    quote_version = current_app.url_map.converters['default'](current_app.url_map).to_url
     results = list()
     for m in mods:
         a = mod_info(m)
-        a['versions'] = [version_info(m, v) for v in m.versions]
+        download_base = a['url'] + '/download/'
+        a['versions'] = [version_info(m, v, download_base + quote_version(v.friendly_version))
+                         for v in m.versions]
         results.append(a)
     return results
 
@@ -258,16 +369,16 @@ def publishers_list() -> List[Dict[str, Any]]:
 def typeahead_mod() -> Iterable[Dict[str, Any]]:
     game_id = request.args.get('game_id', '')
     query = request.args.get('query', '')
-    return serialize_mod_list(typeahead_mods(game_id, query))
+    return [typeahead_info(m) for m in typeahead_mods(game_id, query)]
 
 
 @api.route("/api/search/mod")
 @json_output
-def search_mod() -> Iterable[Dict[str, Any]]:
+def search_mod() -> werkzeug.wrappers.Response:
     query = request.args.get('query')
     query = '' if not query else query
-    page = get_page()
-    return serialize_mod_list(search_mods(None, query, page, 30)[0])
+    mods, page, total_pages, next_after = get_paginated_mods(query=query)
+    return _mod_list_response(mods, page, next_after)
 
 
 @api.route("/api/search/user")
@@ -280,7 +391,8 @@ def search_user() -> Iterable[Dict[str, Any]]:
     results = list()
     for u in search_users(query, page):
         a = user_info(u)
-        mods = Mod.query.filter(Mod.user == u, Mod.published == True).order_by(Mod.created)
+        mods = Mod.query.options(joinedload(Mod.game)) \
+            .filter(Mod.user == u, Mod.published == True).order_by(Mod.created)
         a['mods'] = [mod_info(m) for m in mods]
         results.append(a)
     return results
@@ -295,10 +407,7 @@ def browse() -> Dict[str, Any]:
         per_page = min(max(int(per_page), 1), 500)
     except (ValueError, TypeError):
         per_page = 30
-    mods = Mod.query.filter(Mod.published)
-    # detect total pages
-    count = mods.count()
-    total_pages = max(math.ceil(count / per_page), 1)
+    published = Mod.query.filter(Mod.published)
     # order by field
     orderby = request.args.get('orderby')
     if orderby == "name":
@@ -308,47 +417,61 @@ def browse() -> Dict[str, Any]:
     else:
         orderby = Mod.created
     # order direction
-    order = request.args.get('order')
-    if order == "desc":
-        mods.order_by(desc(orderby))
-    else:
-        mods.order_by(asc(orderby))
-    # current page
-    page = request.args.get('page', 1)
-    try:
-        page = max(int(page), 1)
-    except (ValueError, TypeError):
-        page = 1
-    mods = mods.offset(per_page * (page - 1)).limit(per_page)
+    descending = request.args.get('order') == "desc"
+    mods, page, total_pages, next_after = paginate_keyset(published, [orderby, Mod.id], per_page, descending)
     # generate result
     return {
-        "total": count,
+        "total": cached_count(published),
         "count": per_page,
-        "pages": total_pages,
+        "pages": max(total_pages, 1),
         "page": page,
+        "next_after": next_after,
         "result": serialize_mod_list(mods)
     }
 
 
 @api.route("/api/browse/new")
 @json_output
-def browse_new() -> Iterable[Dict[str, Any]]:
-    mods = Mod.query.filter(Mod.published).order_by(desc(Mod.created))
-    mods, page, total_pages = paginate_query(mods)
-    return serialize_mod_list(mods)
+def browse_new() -> werkzeug.wrappers.Response:
+    mods = Mod.query.filter(Mod.published)
+    mods, page, total_pages, next_after = paginate_keyset(mods, [Mod.created, Mod.id])
+    return _mod_list_response(mods, page, next_after)
 
 
 @api.route("/api/browse/top")
 @json_output
-def browse_top() -> Iterable[Dict[str, Any]]:
-    mods, *_ = get_paginated_mods()
-    return serialize_mod_list(mods)
+def browse_top() -> werkzeug.wrappers.Response:
+    mods, page, total_pages, next_after = get_paginated_mods()
+    return _mod_list_response(mods, page, next_after)
+
+
+@api.route("/api/changes")
+@json_output
+def changes() -> Dict[str, Any]:
+    since = request.args.get('since', '0')
+    game_id = request.args.get('game_id', type=int)
+    query = changes_after(parse_changes_cursor(since))
+    if game_id:
+        query = query.filter(ModChange.game_id == game_id)
+    # One extra to see whether there's more
+    mod_changes = query.limit(CHANGES_PAGE_SIZE + 1).all()
+    more = len(mod_changes) > CHANGES_PAGE_SIZE
+    mod_changes = mod_changes[:CHANGES_PAGE_SIZE]
+    # The current state of the changed mods that are still public
+    mod_ids = {c.mod_id for c in mod_changes}
+    mods = Mod.query.filter(Mod.id.in_(mod_ids), Mod.published).order_by(Mod.id).all() if mod_ids else []
+    return {
+        "changes": [mod_change_info(c) for c in mod_changes],
+        "mods": serialize_mod_list(mods),
+        "next_since": changes_cursor(mod_changes[-1]) if mod_changes else since,
+        "more": more,
+    }
 
 
 @api.route("/api/browse/featured")
 @json_output
 def browse_featured() -> Iterable[Dict[str, Any]]:
-    mods = Featured.query.order_by(desc(Featured.created))
+    mods = Featured.query.options(joinedload(Featured.mod)).order_by(desc(Featured.created))
     mods, page, total_pages = paginate_query(mods)
     return serialize_mod_list((f.mod for f in mods))
 
@@ -639,17 +762,8 @@ def create_mod() -> Tuple[Dict[str, Any], int]:
         return {'error': True, 'reason': 'Game version does not exist.'}, 400
 
     full_path, relative_path = _get_modversion_paths(mod_name, mod_friendly_version)
-    how_many_chunks = int(request.form.get('dztotalchunkcount', 1))
-    which_chunk = int(request.form.get('dzchunkindex', 0))
-    if which_chunk == 0:
-        if os.path.isfile(full_path):
-            os.remove(full_path)
-
-    with open(full_path, 'ab') as f:
-        f.seek(int(request.form.get('dzchunkbyteoffset', 0)))
-        f.write(request.files['zipball'].stream.read())
-
-    if which_chunk + 1 == how_many_chunks:
+    info = _receive_zipball(full_path)
+    if info:
         # Last chunk, create the records
         if not zipfile.is_zipfile(full_path):
             os.remove(full_path)
@@ -657,7 +771,9 @@ def create_mod() -> Tuple[Dict[str, Any], int]:
 
         version = ModVersion(friendly_version=mod_friendly_version,
                              gameversion_id=game_version.id,
-                             download_path=relative_path)
+                             download_path=relative_path,
+                             download_size=info.size,
+                             download_hash=info.sha256)
         # create the mod
         mod = Mod(user=current_user,
                   name=mod_name,
@@ -710,26 +826,19 @@ def update_mod(mod_id: int) -> Tuple[Dict[str, Any], int]:
             }, 400
 
     full_path, relative_path = _get_modversion_paths(mod.name, friendly_version)
-    how_many_chunks = int(request.form.get('dztotalchunkcount', 1))
-    which_chunk = int(request.form.get('dzchunkindex', 0))
-    if which_chunk == 0:
-        if os.path.isfile(full_path):
-            os.remove(full_path)
-
-    with open(full_path, 'ab') as f:
-        f.seek(int(request.form.get('dzchunkbyteoffset', 0)))
-        f.write(request.files['zipball'].stream.read())
-
-    if which_chunk + 1 == how_many_chunks:
+    info = _receive_zipball(full_path)
+    if info:
         # Last chunk, make records
         if not zipfile.is_zipfile(full_path):
             os.remove(full_path)
-            return {'error': True, 'reason': f'{full_path} {which_chunk}/{how_many_chunks} is not a valid zip file.'}, 400
+            return {'error': True, 'reason': f'{full_path} is not a valid zip file.'}, 400
 
         changelog = request.form.get('changelog')
         version = ModVersion(friendly_version=friendly_version,
                              gameversion_id=game_version.id,
                              download_path=relative_path,
+                             download_size=info.size,
+                             download_hash=info.sha256,
                              changelog=changelog)
         # Assign a sort index
         if mod.versions:
@@ -22,14 +22,17 @@ from urllib3.util import connection
 from werkzeug.utils import secure_filename
 
 from .api import default_description
+from ..cache import invalidate_game_page
+from ..changes import log_mod_change
 from ..ckan import send_to_ckan, notify_ckan
 from ..common import get_game_info, set_game_info, with_session, dumb_object, loginrequired, \
-    json_output, adminrequired, check_mod_editable, get_version_size, TRUE_STR, \
+    json_output, adminrequired, check_mod_editable, get_version_size, format_size, TRUE_STR, \
     get_referral_events, get_download_events, get_follow_events, get_games
 from ..config import _cfg
 from ..database import db
+from ..downloads import record_download
 from ..email import send_autoupdate_notification, send_mod_locked
-from ..objects import Mod, ModVersion, DownloadEvent, FollowEvent, ReferralEvent, \
+from ..objects import Mod, ModVersion, FollowEvent, ReferralEvent, \
     Featured, Media, GameVersion, Game
 from ..search import get_mod_score
 
@@ -150,7 +153,8 @@ def mod(mod_id: int, mod_name: str) -> Union[str, werkzeug.wrappers.Response]:
     if storage:
         for v in mod.versions:
             json_versions.append({'name': v.friendly_version, 'id': v.id})
-            size_versions[v.id] = get_version_size(os.path.join(storage, v.download_path))
+            size_versions[v.id] = (format_size(v.download_size) if v.download_size is not None
+                                   else get_version_size(os.path.join(storage, v.download_path)))
     if request.args.get('noedit') is not None:
         editable = False
     forum_thread = False
@@ -269,6 +273,9 @@ def edit_mod(mod_id: int, mod_name: str) -> Union[str, werkzeug.wrappers.Respons
         elif mod.ckan:
             # Badge checked previously, notify
             notify_ckan(mod, 'edit')
+        elif mod.published:
+            # Not for CKAN, but mirrors still want to know
+            log_mod_change(mod, 'publish' if newly_published else 'edit')
 
         if background and background != '':
             mod.background = background
@@ -422,6 +429,7 @@ def feature(mod_id: int) -> Dict[str, Any]:
     featured = Featured()
     featured.mod = mod
     db.add(featured)
+    invalidate_game_page(mod.game_id)
     return {"success": True}
 
 
@@ -430,11 +438,12 @@ def feature(mod_id: int) -> Dict[str, Any]:
 @json_output
 @with_session
 def unfeature(mod_id: int) -> Dict[str, Any]:
-    _get_mod_game_info(mod_id)
+    mod, game = _get_mod_game_info(mod_id)
     featured = Featured.query.filter(Featured.mod_id == mod_id).first()
     if not featured:
         abort(404)
     db.delete(featured)
+    invalidate_game_page(mod.game_id)
     return {"success": True}
 
 
@@ -520,30 +529,12 @@ def download(mod_id: int, mod_name: Optional[str], version: Optional[str]) -> Op
         else next(filter(lambda v: v.friendly_version == version, mod.versions), None)
     if not mod_version:
         abort(404, 'Unfortunately we couldn\'t find the requested mod version. Maybe it got deleted?')
-    download = DownloadEvent.query\
-        .filter(DownloadEvent.mod_id == mod.id, DownloadEvent.version_id == mod_version.id)\
-        .order_by(desc(DownloadEvent.created))\
-        .first()
     storage = _cfg('storage')
     if not storage or not os.path.isfile(os.path.join(storage, mod_version.download_path)):
         abort(404)
 
     if 'Range' not in request.headers:
-        # Events are aggregated hourly
-        if not download or ((datetime.now() - download.created).seconds / 60 / 60) >= 1:
-            download = DownloadEvent()
-            download.mod = mod
-            download.version = mod_version
-            download.downloads = 1
-            db.add(download)
-            db.flush()
-            db.commit()
-            mod.downloads.append(download)
-        else:
-            download.downloads += 1
-        mod.download_count += 1
-        mod_version.download_count += 1
-        mod.score = get_mod_score(mod)
+        record_download(mod.id, mod_version.id)
 
     protocol = _cfg("protocol")
     cdn_domain = _cfg("cdn-domain")
@@ -602,6 +593,8 @@ def delete_version(mod_id: int, version_id: str) -> werkzeug.wrappers.Response:
 
     db.delete(version[0])
     mod.versions = [v for v in mod.versions if v.id != int(version_id)]
+    if mod.published:
+        log_mod_change(mod, 'version-delete')
     db.commit()
     return redirect(url_for("mods.mod", mod_id=mod.id, mod_name=mod.name, ga=game))
 
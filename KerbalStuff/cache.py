@@ -0,0 +1,193 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple, cast
+
+import redis
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Query, Session, SessionTransaction
+
+from .config import _cfg, site_logger
+from .database import db
+
+# Seconds to remember the result of cached_count
+COUNT_CACHE_TTL = 300
+# Number of counts cached in-process without Redis
+LOCAL_COUNT_CACHE_SIZE = 1000
+# Seconds to keep rendered text in Redis. It's keyed by content, so this is only for cleaning up.
+RENDER_CACHE_TTL = 7 * 24 * 3600
+# Seconds to keep rendered page fragments. They're invalidated when their content changes,
+# this catches what doesn't trigger that, like changing scores.
+FRAGMENT_CACHE_TTL = 60
+# Cached sections of each game's landing page
+GAME_SECTIONS = ('featured', 'new', 'recent', 'top')
+# Session.info key of the games whose pages to invalidate when the session commits
+_INVALIDATE_GAMES_KEY = 'invalidate-game-pages'
+
+_redis: Optional[redis.Redis] = None
+# cache key -> (time.monotonic() when it expires, count)
+_local_counts: Dict[str, Tuple[float, int]] = dict()
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """
+    The shared Redis client for the redis-connection URL (the same server Celery uses),
+    or None if Redis isn't configured.
+    The connection is made lazily, so a missing server only shows up as a RedisError on use.
+    """
+    global _redis
+    if _redis is None:
+        url = _cfg('redis-connection')
+        if url:
+            _redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1,
+                                      decode_responses=True)
+    return _redis
+
+
+def cached_count(query: Query, ttl: int = COUNT_CACHE_TTL) -> int:
+    """
+    query.count(), remembered for ttl seconds. Good enough to show a number of pages,
+    without counting the whole result again for every page someone looks at.
+    Cached in Redis if available so all processes share it, otherwise in this process.
+    """
+    compiled = query.statement.compile()
+    key = 'count:' + hashlib.sha1((str(compiled) + repr(sorted(compiled.params.items())))
+                                  .encode('utf-8')).hexdigest()
+    r = get_redis()
+    if r:
+        try:
+            cached = r.get(key)
+            if cached is not None:
+                return int(cached)
+            count = query.count()
+            r.setex(key, ttl, count)
+            return count
+        except redis.RedisError:
+            site_logger.exception('Unable to use cached count')
+    now = time.monotonic()
+    entry = _local_counts.get(key)
+    if entry and entry[0] > now:
+        return entry[1]
+    if len(_local_counts) >= LOCAL_COUNT_CACHE_SIZE:
+        _local_counts.clear()
+    count = query.count()
+    _local_counts[key] = (now + ttl, count)
+    return count
+
+
+class RenderCache:
+    """
+    Remembers the output of an expensive text filter like markdown or bleach,
+    keyed by a hash of the input, so the work is done once per edit instead of once per view.
+    Keeps the most recently used results in this process, up to max_chars characters in total,
+    and all of them in Redis if available.
+    Change version whenever the filter's output could change, to get rid of old results.
+    """
+
+    def __init__(self, name: str, render: Callable[[str], str], version: str,
+                 max_chars: int, ttl: int = RENDER_CACHE_TTL) -> None:
+        self.render = render
+        self.prefix = f'render:{name}:{version}:'
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self._local: 'OrderedDict[str, str]' = OrderedDict()
+        self._local_chars = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> Markup:
+        if not text:
+            return Markup(self.render(text))
+        key = self.prefix + hashlib.sha256(text.encode('utf-8')).hexdigest()
+        with self._lock:
+            html = self._local.get(key)
+            if html is not None:
+                self._local.move_to_end(key)
+                return Markup(html)
+        r = get_redis()
+        if r:
+            try:
+                # get_redis() decodes responses
+                html = cast(Optional[str], r.get(key))
+            except redis.RedisError:
+                site_logger.exception('Unable to get cached %s', key)
+        if html is None:
+            html = str(self.render(text))
+            if r:
+                try:
+                    r.setex(key, self.ttl, html)
+                except redis.RedisError:
+                    site_logger.exception('Unable to cache %s', key)
+        self._remember(key, html)
+        return Markup(html)
+
+    def _remember(self, key: str, html: str) -> None:
+        if len(html) > self.max_chars:
+            return
+        with self._lock:
+            if key in self._local:
+                return
+            self._local[key] = html
+            self._local_chars += len(html)
+            while self._local_chars > self.max_chars:
+                _, evicted = self._local.popitem(last=False)
+                self._local_chars -= len(evicted)
+
+
+def cached_fragment(key: str, render: Callable[[], str], ttl: int = FRAGMENT_CACHE_TTL) -> Markup:
+    """
+    A rendered piece of a page, shared by all processes through Redis for ttl seconds.
+    Only for fragments that look the same to everyone, they're rendered every time without Redis.
+    """
+    key = 'fragment:' + key
+    r = get_redis()
+    if r:
+        try:
+            # get_redis() decodes responses
+            html = cast(Optional[str], r.get(key))
+            if html is not None:
+                return Markup(html)
+        except redis.RedisError:
+            site_logger.exception('Unable to get cached %s', key)
+            r = None
+    html = str(render())
+    if r:
+        try:
+            r.setex(key, ttl, html)
+        except redis.RedisError:
+            site_logger.exception('Unable to cache %s', key)
+    return Markup(html)
+
+
+def invalidate_fragments(keys: Iterable[str]) -> None:
+    """Throw away the cached_fragment()s with these keys, so they're rendered again"""
+    r = get_redis()
+    if r:
+        try:
+            r.delete(*('fragment:' + key for key in keys))
+        except redis.RedisError:
+            site_logger.exception('Unable to invalidate fragments')
+
+
+def game_fragment_key(game_id: int, section: str) -> str:
+    return f'game:{game_id}:{section}'
+
+
+def invalidate_game_page(game_id: int) -> None:
+    """
+    Throw away the cached sections of a game's page once the current transaction commits.
+    Doing it before would let another request cache them again from the old data in between.
+    """
+    db.info.setdefault(_INVALIDATE_GAMES_KEY, set()).add(game_id)
+
+
+@event.listens_for(db, 'after_commit')
+def _invalidate_committed_game_pages(session: Session) -> None:
+    for game_id in session.info.pop(_INVALIDATE_GAMES_KEY, set()):
+        invalidate_fragments(game_fragment_key(game_id, section) for section in GAME_SECTIONS)
+
+
+@event.listens_for(db, 'after_soft_rollback')
+def _forget_game_pages(session: Session, previous_transaction: SessionTransaction) -> None:
+    session.info.pop(_INVALIDATE_GAMES_KEY, None)
@@ -1,14 +1,17 @@
+import os
 from datetime import datetime
 from types import FrameType
-from typing import List, Iterable, Any
+from typing import List, Iterable, Any, Dict, Tuple
 
 from celery import Celery
+from celery.signals import after_task_publish, worker_process_shutdown
 
+from . import metrics, smtp, thumbnail
 from .common import with_session
 from .config import _cfg, _cfgi, _cfgb, site_logger
-from .objects import Mod
-from .search import get_mod_score
+from .search import update_mod_scores
 from .ckan import import_ksp_versions_from_ckan
+from .downloads import flush_downloads
 
 app = Celery("tasks", broker=_cfg("redis-connection"))
 
@@ -22,20 +25,24 @@ def chunks(l: List[str], n: int) -> Iterable[List[str]]:
 
 @app.task
 def send_mail(sender: str, recipients: List[str], subject: str, message: str, important: bool = False) -> None:
-    host = _cfg('smtp-host')
-    if not host:
+    if not _cfg('smtp-host'):
         return
-    import smtplib
+    smtp.send_messages(_mail_messages(sender, recipients, subject, message, important))
+
+
+@app.task
+def send_mail_batch(mails: List[Dict[str, Any]]) -> None:
+    """Send many mails, each a dict of send_mail's arguments, over one SMTP session"""
+    if not _cfg('smtp-host'):
+        return
+    smtp.send_messages(m for mail in mails for m in _mail_messages(**mail))
+
+
+def _mail_messages(sender: str, recipients: List[str], subject: str, message: str,
+                   important: bool = False) -> Iterable[Tuple[str, List[str], str]]:
+    """The (sender, recipients, message) tuples to send a mail to recipients, 100 at a time"""
     from email.mime.text import MIMEText
     from email.utils import format_datetime
-    smtp = smtplib.SMTP(host=host, port=_cfgi("smtp-port"))
-    if _cfgb("smtp-tls"):
-        smtp.starttls()
-    user = _cfg('smtp-user')
-    passwd = _cfg('smtp-password')
-    if user and passwd:
-        # If there's a user and no password, let the connection attempt fail hard so that it logs the message.
-        smtp.login(user, passwd)
     msg = MIMEText(message)
     if important:
         msg['X-MC-Important'] = "true"
@@ -46,13 +53,18 @@ def send_mail(sender: str, recipients: List[str], subject: str, message: str, im
     if len(recipients) > 1:
         msg['Precedence'] = 'bulk'
     for group in chunks(recipients, 100):
+        # Assigning adds another header, replace it instead
+        del msg['To']
         if len(group) > 1:
             msg['To'] = "undisclosed-recipients:;"
         else:
             msg['To'] = ";".join(group)
-        site_logger.info("Sending email from %s to %s recipients", sender, len(group))
-        smtp.sendmail(sender, group, msg.as_string())
-    smtp.quit()
+        yield sender, group, msg.as_string()
+
+
+@app.task
+def create_thumbnails(background_url: str) -> None:
+    thumbnail.create(background_url)
 
 
 @app.task
@@ -94,17 +106,55 @@ def update_from_github(working_directory: str, branch: str, restart_command: str
         site_logger.exception('Unable to update from github')
 
 
+@worker_process_shutdown.connect
+def close_smtp(**kwargs: Any) -> None:
+    smtp.close()
+    metrics.mark_process_dead()
+
+
+@after_task_publish.connect
+def count_queued_task(headers: Dict[str, Any], **kwargs: Any) -> None:
+    metrics.count('spacedock_tasks_queued_total', task=headers.get('task', ''))
+
+
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender: Any, **kwargs: int) -> None:
     sender.add_periodic_task(86400, calculate_mod_scores.s(), name='calculate mod scores')
     sender.add_periodic_task(3600, ckan_version_import.s(), name='import ksp versions from ckan')
+    sender.add_periodic_task(_cfgi('download-flush-interval', 60), flush_download_counts.s(),
+                             name='flush buffered download counts')
+    sender.add_periodic_task(_cfgi('snapshot-interval', 3600), export_catalog_snapshot.s(),
+                             name='export catalog snapshot')
 
 
 @app.task
 @with_session
 def calculate_mod_scores() -> None:
-    for mod in Mod.query.all():
-        mod.score = get_mod_score(mod)
+    update_mod_scores()
+
+
+@app.task
+@with_session
+def flush_download_counts() -> None:
+    flush_downloads()
+
+
+@app.task
+@with_session
+def export_catalog_snapshot() -> None:
+    storage = _cfg('storage')
+    if not storage:
+        return
+    if not os.path.isdir(storage):
+        # Otherwise we'd write it where the web server can't serve it
+        site_logger.warning('Not exporting the catalog snapshot, storage %s is not mounted', storage)
+        return
+    # The Flask app imports this module, so import it late
+    from .app import app as flask_app
+    from .snapshot import write_snapshot
+    # For url_for
+    with flask_app.test_request_context():
+        write_snapshot(storage)
 
 
 @app.task
@@ -0,0 +1,47 @@
+from typing import Any, Tuple
+
+from sqlalchemy import func, literal, tuple_
+from sqlalchemy.orm import Query
+
+from .cache import invalidate_game_page
+from .database import db, is_postgresql
+from .objects import Mod, ModChange
+
+
+def log_mod_change(mod: Mod, event_type: str) -> None:
+    """
+    Record a change for /api/changes. Committed along with the rest of the request.
+    Also drops the cached sections of the game's page after the commit, as the mod might be shown there.
+    """
+    invalidate_game_page(mod.game_id)
+    db.add(ModChange(mod_id=mod.id, game_id=mod.game_id, event_type=event_type,
+                     # SQLite runs one transaction at a time, the ids are in commit order there
+                     txid=func.txid_current() if is_postgresql() else 0))
+
+
+def changes_after(cursor: Tuple[int, int]) -> Query:
+    """
+    The changes after a (txid, id) cursor, in a stable order.
+    Ids are handed out when the changes are added, not when they're committed,
+    so a slow transaction can add a lower id than one that already committed.
+    Instead we order by transaction, and only show the changes of transactions older than all that are
+    still running. Those are done, every later change will belong to a later transaction.
+    """
+    query = ModChange.query.filter(tuple_(ModChange.txid, ModChange.id)
+                                   > tuple_(*(literal(value) for value in cursor)))
+    if is_postgresql():
+        query = query.filter(ModChange.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+    return query.order_by(ModChange.txid, ModChange.id)
+
+
+def changes_cursor(change: ModChange) -> str:
+    return f'{change.txid}-{change.id}'
+
+
+def parse_changes_cursor(cursor: Any) -> Tuple[int, int]:
+    """The (txid, id) of a changes_cursor(), or of a plain id from before there were transactions in it"""
+    try:
+        txid, _, change_id = str(cursor).rpartition('-')
+        return int(txid or 0), int(change_id)
+    except ValueError:
+        return 0, 0
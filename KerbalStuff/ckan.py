@@ -1,25 +1,48 @@
+import atexit
+import os
 import threading
+import time
+from collections import OrderedDict
 import requests
 import re
 from flask import url_for
-from typing import Dict, Iterable
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+from urllib3.util import Retry
 
-from .config import _cfg
+from . import metrics
+from .changes import log_mod_change
+from .config import _cfg, site_logger
 from .objects import Mod, Game, GameVersion
 from .database import db
+from .search import invalidate_game_versions
 
 CKAN_BUILDS_URL = 'https://github.com/KSP-CKAN/CKAN-meta/raw/master/builds.json'
 MAJOR_MINOR_PATCH_PATTERN = re.compile('^([^.]+\.[^.]+\.[^.]+)')
+# Notifications waiting to be sent, per process. More are dropped.
+CKAN_QUEUE_SIZE = 1000
+# Seconds a notification waits, so repeats of it can be merged into one
+CKAN_COALESCE_SECONDS = 60
+# Seconds repeats can hold back a notification at most, counted from the first of them
+CKAN_MAX_DELAY_SECONDS = 5 * 60
+# Seconds to wait for a response, and how often to try again after errors
+CKAN_TIMEOUT = 10
+CKAN_RETRIES = 5
+# Seconds a process that shuts down spends on sending what's still queued, without retries.
+# Well below uwsgi's grace period, or it kills the process in the middle.
+CKAN_EXIT_SECONDS = 5
 
 
 def send_to_ckan(mod: Mod) -> None:
+    if mod.published:
+        log_mod_change(mod, 'publish')
     protocol = _cfg('protocol')
     domain = _cfg('domain')
     url = _cfg('create-url')
     site_name = _cfg('site-name')
     if mod.ckan and mod.published and url and protocol and domain and site_name:
         site_base_url = protocol + "://" + domain
-        _bg_post(url, {
+        _bg_post(url, ('create', mod.id), {
             'name': mod.name,
             'id': mod.id,
             'license': mod.license,
@@ -35,17 +58,115 @@ def send_to_ckan(mod: Mod) -> None:
 
 
 def notify_ckan(mod: Mod, event_type: str, force: bool = False) -> None:
+    if mod.published or force:
+        log_mod_change(mod, event_type)
     url = _cfg("notify-url")
     if mod.ckan and url and (mod.published or force):
-        _bg_post(url, {
+        _bg_post(url, (event_type, mod.id), {
             'mod_id': mod.id,
             'event_type': event_type,
         })
 
 
-def _bg_post(url: str, data: Dict[str, str]) -> None:
-    """Fire and forget some data to a POST URL in a background thread"""
-    threading.Thread(target=requests.post, args=(url, data)).start()
+class NotificationDispatcher:
+    """
+    Sends POST requests from one background thread per process, through a pooled session
+    that retries with backoff.
+    Requests with the same key queued within CKAN_COALESCE_SECONDS of each other
+    are merged into one, with the newest data. It goes to the back of the queue,
+    so when events undo each other (lock, unlock, lock), the last one is sent last.
+    Repeats stop pushing it back CKAN_MAX_DELAY_SECONDS after the first one, so a mod that
+    keeps being edited is still announced. It's sent after those queued before it, though.
+    """
+
+    def __init__(self, delay: float = CKAN_COALESCE_SECONDS, max_size: int = CKAN_QUEUE_SIZE,
+                 max_delay: float = CKAN_MAX_DELAY_SECONDS) -> None:
+        self.delay = delay
+        self.max_size = max_size
+        self.max_delay = max_delay
+        # key -> (time.monotonic() when it's due, when it was first queued, url, data), in the order they're due
+        self._pending: 'OrderedDict[Hashable, Tuple[float, float, str, Dict[str, Any]]]' = OrderedDict()
+        self._cond = threading.Condition()
+        # The process that started the worker thread, threads don't survive a fork
+        self._pid: Optional[int] = None
+        self._session: Optional[requests.Session] = None
+
+    def post(self, url: str, key: Hashable, data: Dict[str, Any]) -> None:
+        now = time.monotonic()
+        with self._cond:
+            if key in self._pending:
+                first = self._pending[key][1]
+                # Sent after everything else queued, so the last of several events comes last
+                self._pending[key] = (min(now + self.delay, first + self.max_delay), first, url, data)
+                self._pending.move_to_end(key)
+                # It might be due sooner than the worker thread is waiting for
+                self._cond.notify()
+                return
+            if len(self._pending) >= self.max_size:
+                site_logger.error('Too many notifications queued, dropping %s for %s', key, url)
+                return
+            self._pending[key] = (now + self.delay, now, url, data)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='notification-dispatcher', daemon=True).start()
+            self._cond.notify()
+
+    def flush(self, timeout: float = CKAN_EXIT_SECONDS) -> None:
+        """
+        Send everything that's queued right now, in this thread, when the process shuts down.
+        Doesn't try again after errors, and drops what isn't sent within timeout seconds.
+        """
+        with self._cond:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        deadline = time.monotonic() + timeout
+        session = requests.Session()
+        for i, (_, _, url, data) in enumerate(pending):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                site_logger.error('Out of time, dropping %s notifications', len(pending) - i)
+                metrics.count('spacedock_ckan_posts_total', len(pending) - i, result='dropped')
+                break
+            self._send(session, url, data, min(CKAN_TIMEOUT, remaining))
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    wait = None
+                    if self._pending:
+                        key, (due, _, url, data) = next(iter(self._pending.items()))
+                        wait = due - time.monotonic()
+                        if wait <= 0:
+                            del self._pending[key]
+                            break
+                    self._cond.wait(wait)
+            if self._session is None:
+                self._session = requests.Session()
+                retry = Retry(total=CKAN_RETRIES, backoff_factor=2,
+                              status_forcelist=(429, 500, 502, 503, 504),
+                              allowed_methods=frozenset({'POST'}))
+                self._session.mount('http://', HTTPAdapter(max_retries=retry))
+                self._session.mount('https://', HTTPAdapter(max_retries=retry))
+            self._send(self._session, url, data, CKAN_TIMEOUT)
+
+    def _send(self, session: requests.Session, url: str, data: Dict[str, Any], timeout: float) -> None:
+        try:
+            session.post(url, data=data, timeout=timeout).raise_for_status()
+            metrics.count('spacedock_ckan_posts_total', result='sent')
+        except requests.RequestException:
+            site_logger.exception('Unable to send notification to %s', url)
+            metrics.count('spacedock_ckan_posts_total', result='failed')
+
+
+_dispatcher = NotificationDispatcher()
+# Don't lose what's still waiting when the worker process shuts down
+atexit.register(_dispatcher.flush)
+
+
+def _bg_post(url: str, key: Hashable, data: Dict[str, Any]) -> None:
+    """Queue some data to POST to a URL in the background, replacing a queued post with the same key"""
+    _dispatcher.post(url, (url, key), data)
 
 
 def import_ksp_versions_from_ckan(ksp_game_id: int) -> None:
@@ -56,6 +177,7 @@ def import_ksp_versions_from_ckan(ksp_game_id: int) -> None:
             current_versions.add(version)
             db.add(GameVersion(friendly_version=version, game_id=ksp_game_id))
             db.commit()
+            invalidate_game_versions(ksp_game_id)
 
 
 def ksp_versions_from_ckan() -> Iterable[str]:
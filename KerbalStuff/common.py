@@ -1,3 +1,6 @@
+import base64
+import binascii
+import hashlib
 import json
 import math
 import urllib.parse
@@ -5,7 +8,7 @@ import os
 import re
 from datetime import timedelta, datetime
 from functools import wraps
-from typing import Union, List, Any, Optional, Callable, Tuple, Iterable
+from typing import Union, List, Any, Optional, Callable, Tuple, Iterable, Sequence
 
 import bleach
 import werkzeug.wrappers
@@ -13,14 +16,15 @@ from bleach_allowlist import bleach_allowlist
 from flask import jsonify, redirect, request, Response, abort, session
 from flask_login import current_user
 from markupsafe import Markup
-from sqlalchemy import desc
+from sqlalchemy import desc, asc, literal, tuple_
 from werkzeug.exceptions import HTTPException
 from sqlalchemy.orm import Query
 
+from .cache import cached_count
 from .custom_json import CustomJSONEncoder
 from .database import db, Base
 from .objects import Game, Mod, Featured, ModVersion, ReferralEvent, DownloadEvent, FollowEvent
-from .search import search_mods
+from .search import search_mods_query
 
 TRUE_STR = ('true', 'yes', 'on')
 PARAGRAPH_PATTERN = re.compile('\n\n|\r\n\r\n')
@@ -28,6 +32,10 @@ PARAGRAPH_PATTERN = re.compile('\n\n|\r\n\r\n')
 cleaner = bleach.Cleaner(tags=bleach_allowlist.markdown_tags,
                          attributes=bleach_allowlist.markdown_attrs,
                          filters=[bleach.linkifier.LinkifyFilter])
+# Changes whenever the output of sanitize_text could, to invalidate cached HTML
+SANITIZE_FINGERPRINT = hashlib.sha1(repr((bleach.__version__,
+                                          bleach_allowlist.markdown_tags,
+                                          bleach_allowlist.markdown_attrs)).encode('utf-8')).hexdigest()[:12]
 
 
 def first_paragraphs(text: str) -> str:
@@ -135,7 +143,7 @@ def cors(f: Callable[..., Any]) -> Callable[..., Any]:
 
 
 def paginate_query(query: Query, page_size: int = 30) -> Tuple[List[Mod], int, int]:
-    total_pages = math.ceil(query.count() / page_size)
+    total_pages = math.ceil(cached_count(query) / page_size)
     page = get_page()
     if page > total_pages:
         page = total_pages
@@ -144,6 +152,74 @@ def paginate_query(query: Query, page_size: int = 30) -> Tuple[List[Mod], int, i
     return query.offset(page_size * (page - 1)).limit(page_size), page, total_pages
 
 
+def paginate_keyset(query: Query, keys: Sequence[Any], page_size: int = 30,
+                    descending: bool = True) -> Tuple[List[Any], int, int, Optional[str]]:
+    """
+    Like paginate_query, but orders by keys, which have to end with a unique column like Mod.id.
+    The keys can't be NULL, a NULL is never less or greater than the cursor and its row would be skipped.
+    If the request has an after= cursor, the page continues after the row it was made from,
+    instead of skipping the previous pages with OFFSET.
+    A cursor made for another order, or with values that don't fit the keys, is ignored.
+    Also returns the cursor for the next page, or None if this is the last page.
+    """
+    total_pages = math.ceil(cached_count(query) / page_size)
+    page = get_page()
+    query = query.order_by(*(desc(key) if descending else asc(key) for key in keys))
+    spec = _cursor_spec(keys, descending)
+    after = request.args.get('after')
+    values = decode_cursor(after, spec) if after else None
+    if values is not None and len(values) == len(keys) \
+            and all(_fits_key(value, key) for key, value in zip(keys, values)):
+        # The page number is only for display, the total is an estimate
+        page = max(page, 1)
+        bound = tuple_(*(literal(value, key.type) for key, value in zip(keys, values)))
+        query = query.filter(tuple_(*keys) < bound if descending else tuple_(*keys) > bound)
+    else:
+        page = max(min(page, total_pages), 1)
+        query = query.offset(page_size * (page - 1))
+    rows = query.add_columns(*keys).limit(page_size + 1).all()
+    next_after = encode_cursor(rows[page_size - 1][1:], spec) if len(rows) > page_size else None
+    return [row[0] for row in rows[:page_size]], page, total_pages, next_after
+
+
+def _cursor_spec(keys: Sequence[Any], descending: bool) -> str:
+    """Identifies the order a cursor belongs to"""
+    spec = ','.join(map(str, keys)) + (' desc' if descending else ' asc')
+    return hashlib.sha1(spec.encode('utf-8')).hexdigest()[:8]
+
+
+def _fits_key(value: Any, key: Any) -> bool:
+    try:
+        python_type = key.type.python_type
+    except NotImplementedError:
+        return True
+    if isinstance(value, bool):
+        return python_type is bool
+    if python_type is float:
+        return isinstance(value, (int, float))
+    return isinstance(value, python_type)
+
+
+def encode_cursor(values: Sequence[Any], spec: str) -> str:
+    data = json.dumps({'order': spec,
+                       'values': [{'datetime': v.isoformat()} if isinstance(v, datetime) else v
+                                  for v in values]},
+                      separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, spec: str) -> Optional[List[Any]]:
+    """The values encoded by encode_cursor for the order spec, or None if the cursor isn't valid for it"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(data, dict) or data.get('order') != spec or not isinstance(data.get('values'), list):
+            return None
+        return [datetime.fromisoformat(v['datetime']) if isinstance(v, dict) else v
+                for v in data['values']]
+    except (ValueError, TypeError, KeyError, binascii.Error):
+        return None
+
+
 def get_page() -> int:
     try:
         return int(request.args.get('page', ''))
@@ -151,10 +227,10 @@ def get_page() -> int:
         return 1
 
 
-def get_paginated_mods(ga: Game = None, query: str = '', page_size: int = 30) -> Tuple[Iterable[Mod], int, int]:
-    page = get_page()
-    mods, total_pages = search_mods(ga.id if ga else None, query, page, page_size)
-    return mods, page, total_pages
+def get_paginated_mods(ga: Game = None, query: str = '',
+                       page_size: int = 30) -> Tuple[List[Mod], int, int, Optional[str]]:
+    mods, keys = search_mods_query(ga.id if ga else None, query)
+    return paginate_keyset(mods, keys, page_size)
 
 
 def get_featured_mods(game_id: Optional[int], limit: int) -> List[Mod]:
@@ -255,8 +331,10 @@ def check_mod_editable(mod: Mod, abort_response: Optional[Union[int, werkzeug.wr
 def get_version_size(f: str) -> Optional[str]:
     if not os.path.isfile(f):
         return None
+    return format_size(os.path.getsize(f))
+
 
-    size = os.path.getsize(f)
+def format_size(size: int) -> str:
     if size < 1023:
         return "%d %s" % (size, ("byte" if size == 1 else "bytes"))
     elif size < 1048576:
@@ -1,8 +1,14 @@
-from sqlalchemy import create_engine
+import heapq
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Connection, ExecutionContext
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
-from .config import _cfg
+from .config import _cfg, _cfgi, site_logger
 
 engine = create_engine(_cfg('connection-string'))
 db = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
@@ -10,6 +16,84 @@ db = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 Base.query = db.query_property()
 
+# Queries taking at least this many milliseconds are logged, 0 turns it off
+SLOW_QUERY_MS = _cfgi('slow-query-ms', 500)
+# Number of statements QueryStats remembers
+SLOWEST_QUERIES = 5
+
+
+class QueryStats:
+    """Number and duration of the queries run for a route, along with the slowest of them"""
+
+    def __init__(self, route: str) -> None:
+        self.route = route
+        self.count = 0
+        self.seconds = 0.0
+        # Min-heap of (seconds, statement)
+        self._slowest: List[Tuple[float, str]] = list()
+
+    def add(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        if len(self._slowest) < SLOWEST_QUERIES:
+            heapq.heappush(self._slowest, (seconds, statement))
+        else:
+            heapq.heappushpop(self._slowest, (seconds, statement))
+
+    @property
+    def slowest(self) -> List[Tuple[float, str]]:
+        return sorted(self._slowest, reverse=True)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'route': self.route,
+            'queries': self.count,
+            'db_ms': round(self.seconds * 1000, 1),
+            'slowest': [{'ms': round(seconds * 1000, 1), 'statement': statement}
+                        for seconds, statement in self.slowest],
+        }
+
+
+_local = threading.local()
+
+
+def start_query_stats(route: str) -> QueryStats:
+    """Count the queries of this thread for route, until stop_query_stats"""
+    stats = QueryStats(route)
+    _local.stats = stats
+    return stats
+
+
+def get_query_stats() -> Optional[QueryStats]:
+    return getattr(_local, 'stats', None)
+
+
+def stop_query_stats() -> None:
+    _local.stats = None
+
+
+@event.listens_for(engine, 'before_cursor_execute')
+def _before_cursor_execute(conn: Connection, cursor: Any, statement: str, parameters: Any,
+                           context: ExecutionContext, executemany: bool) -> None:
+    context._query_start = time.perf_counter()  # type: ignore[attr-defined]
+
+
+@event.listens_for(engine, 'after_cursor_execute')
+def _after_cursor_execute(conn: Connection, cursor: Any, statement: str, parameters: Any,
+                          context: ExecutionContext, executemany: bool) -> None:
+    seconds = time.perf_counter() - context._query_start  # type: ignore[attr-defined]
+    stats = get_query_stats()
+    if stats is not None:
+        stats.add(statement, seconds)
+    if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+        site_logger.warning('Slow query (%.0f ms) for %s: %s',
+                            seconds * 1000, stats.route if stats else 'no request', statement)
+
+
+def is_postgresql() -> bool:
+    """Whether we're talking to PostgreSQL (production) rather than e.g. SQLite (tests)."""
+    return engine.dialect.name == 'postgresql'
+
 
 def create_database() -> bool:
     """Create the database of the service using the preconfigured backend."""
@@ -0,0 +1,145 @@
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, cast
+
+import redis
+from sqlalchemy import bindparam
+
+from . import metrics
+from .cache import get_redis
+from .config import site_logger
+from .database import db
+from .objects import Mod, ModVersion, DownloadEvent, DownloadFlush
+from .search import update_mod_scores
+
+# Redis hash of pending downloads, field '<mod_id>:<version_id>' -> count
+PENDING_KEY = 'downloads:pending'
+# Where the flusher moves the pending hash while it writes it to the database
+FLUSHING_KEY = 'downloads:flushing'
+FLUSH_LOCK_KEY = 'downloads:flush-lock'
+# Identifies the batch in FLUSHING_KEY, it's recorded as a DownloadFlush in the same transaction as its counts
+FLUSH_ID_KEY = 'downloads:flush-id'
+# How long to remember written batches
+FLUSH_ID_RETENTION = timedelta(days=1)
+# Downloads of a version are aggregated in one DownloadEvent per hour
+EVENT_INTERVAL = timedelta(hours=1)
+
+
+def record_download(mod_id: int, version_id: int) -> None:
+    """
+    Count a download. Normally this is only an increment in Redis,
+    flush_downloads folds the buffered counts into the database later.
+    Without Redis we fall back to writing to the database right away.
+    """
+    metrics.count('spacedock_downloads_total')
+    r = get_redis()
+    if r:
+        try:
+            r.hincrby(PENDING_KEY, f'{mod_id}:{version_id}', 1)
+            return
+        except redis.RedisError:
+            site_logger.exception('Unable to buffer download, writing it to the database')
+    apply_downloads({(mod_id, version_id): 1})
+
+
+def flush_downloads() -> None:
+    """Move the downloads buffered in Redis into DownloadEvents and the download counters"""
+    r = get_redis()
+    if not r:
+        return
+    lock = r.lock(FLUSH_LOCK_KEY, timeout=600)
+    if not lock.acquire(blocking=False):
+        # Another flush is still running
+        return
+    try:
+        # A leftover FLUSHING_KEY means the last flush failed somewhere, retry that first
+        if not r.exists(FLUSHING_KEY):
+            if not r.exists(PENDING_KEY):
+                return
+            # We hold the lock, so nobody else renames it in the meantime
+            with r.pipeline() as pipe:
+                pipe.rename(PENDING_KEY, FLUSHING_KEY)
+                pipe.set(FLUSH_ID_KEY, uuid.uuid4().hex)
+                pipe.execute()
+        flush_id = cast(Optional[str], r.get(FLUSH_ID_KEY))
+        if not flush_id:
+            # Left behind by a version that didn't have flush ids
+            flush_id = uuid.uuid4().hex
+            r.set(FLUSH_ID_KEY, flush_id)
+        # If the last try committed but couldn't clean up Redis, the counts are in already
+        if not db.query(DownloadFlush).get(flush_id):
+            # get_redis() decodes responses
+            pending = cast(Dict[str, str], r.hgetall(FLUSHING_KEY))
+            counts = dict()
+            for field, count in pending.items():
+                mod_id, version_id = field.split(':')
+                counts[(int(mod_id), int(version_id))] = int(count)
+            apply_downloads(counts)
+            now = datetime.now()
+            db.add(DownloadFlush(id=flush_id, created=now))
+            db.query(DownloadFlush).filter(DownloadFlush.created < now - FLUSH_ID_RETENTION) \
+                .delete(synchronize_session=False)
+            db.commit()
+        r.delete(FLUSHING_KEY, FLUSH_ID_KEY)
+    finally:
+        lock.release()
+
+
+def apply_downloads(counts: Dict[Tuple[int, int], int]) -> None:
+    """
+    Add the given number of downloads per (mod id, version id) to the hourly DownloadEvents
+    and the mod and version download counters, and rescore the affected mods.
+    All rows are written with one executemany statement per table.
+    Counts of mods or versions that have been deleted since are dropped.
+    """
+    existing = set(db.query(ModVersion.mod_id, ModVersion.id)
+                   .join(Mod, Mod.id == ModVersion.mod_id)
+                   .filter(ModVersion.id.in_({version_id for _, version_id in counts})))
+    deleted = [key for key in counts if key not in existing]
+    if deleted:
+        site_logger.info('Dropping downloads of %s deleted mod versions', len(deleted))
+        counts = {key: count for key, count in counts.items() if key in existing}
+    if not counts:
+        return
+    now = datetime.now()
+    mod_ids = {mod_id for mod_id, _ in counts}
+    # The most recent event of each version, if it's recent enough to add to
+    latest_events: Dict[Tuple[int, int], int] = dict()
+    for event_id, mod_id, version_id in db.query(DownloadEvent.id,
+                                                 DownloadEvent.mod_id,
+                                                 DownloadEvent.version_id) \
+            .filter(DownloadEvent.mod_id.in_(mod_ids),
+                    DownloadEvent.created > now - EVENT_INTERVAL) \
+            .order_by(DownloadEvent.created):
+        latest_events[(mod_id, version_id)] = event_id
+
+    event_increments = list()
+    new_events = list()
+    for (mod_id, version_id), count in counts.items():
+        event_id = latest_events.get((mod_id, version_id))
+        if event_id:
+            event_increments.append({'row_id': event_id, 'increment': count})
+        else:
+            new_events.append({'mod_id': mod_id, 'version_id': version_id,
+                               'downloads': count, 'created': now})
+    if event_increments:
+        _increment(DownloadEvent.__table__, 'downloads', event_increments)
+    if new_events:
+        db.bulk_insert_mappings(DownloadEvent, new_events)
+
+    mod_increments: Dict[int, int] = dict()
+    for (mod_id, _), count in counts.items():
+        mod_increments[mod_id] = mod_increments.get(mod_id, 0) + count
+    _increment(Mod.__table__, 'download_count',
+               [{'row_id': mod_id, 'increment': count} for mod_id, count in mod_increments.items()])
+    _increment(ModVersion.__table__, 'download_count',
+               [{'row_id': version_id, 'increment': count}
+                for (_, version_id), count in counts.items()])
+    update_mod_scores(mod_ids)
+
+
+def _increment(table: Any, column: str, rows: List[Dict[str, int]]) -> None:
+    db.execute(table.update()
+               .where(table.c.id == bindparam('row_id'))
+               .values({column: table.c[column] + bindparam('increment')}),
+               rows)
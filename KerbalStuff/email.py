@@ -1,26 +1,38 @@
 import html
-from typing import Iterable, List, Dict
+from typing import Any, List, Dict
 
 from flask import url_for
-from jinja2 import Template
+from flask.helpers import get_debug_flag
+from jinja2 import Environment, FileSystemLoader
+from sqlalchemy.orm import Query
 from werkzeug.utils import secure_filename
 
-from .objects import User, Mod, ModVersion
-from .celery import send_mail
+from .database import db
+from .objects import User, Mod, ModVersion, mod_followers
+from .celery import send_mail, send_mail_batch
 from .config import _cfg, _cfgd
 
+# Recipients per mail when mailing many users
+RECIPIENTS_PER_MAIL = 100
+# Mails per send_mail_batch task, each task sends them over one SMTP connection
+MAILS_PER_TASK = 10
+
+# Each email template is compiled once, the first time it's used.
+# While debugging, changed files are picked up like the site's templates.
+_templates = Environment(loader=FileSystemLoader('emails'), auto_reload=get_debug_flag())
+
 
 def send_confirmation(user: User, followMod: str = None) -> None:
     site_name = _cfg('site-name')
     if site_name:
-        with open("emails/confirm-account") as f:
-            if followMod is not None:
-                message = Template(f.read()).render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
-                                                    'confirmation': user.confirmation + "?f=" + followMod})
-            else:
-                message = html.unescape(
-                    Template(f.read()).render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
-                                              'confirmation': user.confirmation}))
+        template = _templates.get_template('confirm-account')
+        if followMod is not None:
+            message = template.render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
+                                       'confirmation': user.confirmation + "?f=" + followMod})
+        else:
+            message = html.unescape(
+                template.render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
+                                 'confirmation': user.confirmation}))
         send_mail.delay(_cfg('support-mail'), [user.email], "Welcome to " + site_name + "!", message,
                         important=True)
 
@@ -28,24 +40,23 @@ def send_confirmation(user: User, followMod: str = None) -> None:
 def send_password_reset(user: User) -> None:
     site_name = _cfg('site-name')
     if site_name:
-        with open("emails/password-reset") as f:
-            message = html.unescape(
-                Template(f.read()).render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
-                                          'confirmation': user.passwordReset}))
+        message = html.unescape(
+            _templates.get_template('password-reset').render({
+                'user': user, 'site_name': site_name, "domain": _cfg("domain"),
+                'confirmation': user.passwordReset}))
         send_mail.delay(_cfg('support-mail'), [user.email], "Reset your password on " + site_name, message,
                         important=True)
 
 
 def send_password_changed(user: User) -> None:
-    with open("emails/password-changed") as f:
-        message = html.unescape(
-            Template(f.read()).render({
-                'user': user,
-                'site_name': _cfg('site-name'),
-                "domain": _cfg("domain"),
-                'support_channels': _cfgd('support-channels')
-            })
-        )
+    message = html.unescape(
+        _templates.get_template('password-changed').render({
+            'user': user,
+            'site_name': _cfg('site-name'),
+            "domain": _cfg("domain"),
+            'support_channels': _cfgd('support-channels')
+        })
+    )
     send_mail.delay(_cfg('support-mail'), [user.email], f'Your password on {_cfg("site-name")} has been changed',
                     message, important=True)
 
@@ -55,81 +66,95 @@ def send_mod_locked(mod: Mod, user: User) -> None:
     for name, url in _cfgd('support-channels').items():
         support_channels.append({'name': name, 'channel_url': url})
 
-    with open('emails/mod-locked') as f:
-        message = html.unescape(
-            Template(f.read()).render({
-                'mod': mod, 'user': user,
-                'url': url_for('mods.mod', mod_id=mod.id, mod_name=mod.name, _external=True),
-                'site_name': _cfg('site-name'),
-                'support_channels': _cfgd('support-channels')
-            })
-        )
-        subject = f'Your mod {mod.name} has been locked on {_cfg("site-name")}'
+    message = html.unescape(
+        _templates.get_template('mod-locked').render({
+            'mod': mod, 'user': user,
+            'url': url_for('mods.mod', mod_id=mod.id, mod_name=mod.name, _external=True),
+            'site_name': _cfg('site-name'),
+            'support_channels': _cfgd('support-channels')
+        })
+    )
+    subject = f'Your mod {mod.name} has been locked on {_cfg("site-name")}'
     send_mail.delay(_cfg('support-mail'), [user.email], subject, message, important=True)
 
 
 def send_grant_notice(mod: Mod, user: User) -> None:
     site_name = _cfg('site-name')
     if site_name:
-        with open("emails/grant-notice") as f:
-            message = html.unescape(
-                Template(f.read()).render({'user': user, 'site_name': site_name, "domain": _cfg("domain"),
-                                          'mod': mod, 'url': url_for('mods.mod', mod_id=mod.id, mod_name=mod.name)}))
+        message = html.unescape(
+            _templates.get_template('grant-notice').render({
+                'user': user, 'site_name': site_name, "domain": _cfg("domain"),
+                'mod': mod, 'url': url_for('mods.mod', mod_id=mod.id, mod_name=mod.name)}))
         send_mail.delay(_cfg('support-mail'), [user.email], "You've been asked to co-author a mod on " + site_name,
                         message, important=True)
 
 
+def _follower_emails(mod: Mod) -> Query:
+    return db.query(User.email) \
+        .join(mod_followers, mod_followers.c.user_id == User.id) \
+        .filter(mod_followers.c.mod_id == mod.id) \
+        .order_by(User.id)
+
+
+def _send_in_batches(emails: Query, subject: str, message: str) -> None:
+    """
+    Mail RECIPIENTS_PER_MAIL addresses at a time, reading them from the database as we go,
+    and queue a send_mail_batch task per MAILS_PER_TASK mails.
+    The tasks are independent, so workers share the load and a failure only affects one task.
+    emails is a query of single email columns.
+    """
+    mails: List[Dict[str, Any]] = list()
+    batch: List[str] = list()
+    for email, in emails.execution_options(stream_results=True).yield_per(RECIPIENTS_PER_MAIL):
+        batch.append(email)
+        if len(batch) >= RECIPIENTS_PER_MAIL:
+            mails.append({'sender': _cfg('support-mail'), 'recipients': batch,
+                          'subject': subject, 'message': message})
+            batch = list()
+            if len(mails) >= MAILS_PER_TASK:
+                send_mail_batch.delay(mails)
+                mails = list()
+    if batch:
+        mails.append({'sender': _cfg('support-mail'), 'recipients': batch,
+                      'subject': subject, 'message': message})
+    if mails:
+        send_mail_batch.delay(mails)
+
+
 def send_update_notification(mod: Mod, version: ModVersion, user: User) -> None:
-    followers = [u.email for u in mod.followers]
     changelog = version.changelog
     if changelog:
         changelog = '\n'.join(['    ' + line for line in changelog.split('\n')])
 
-    targets = list()
-    for follower in followers:
-        targets.append(follower)
-    if len(targets) == 0:
-        return
-    with open("emails/mod-updated") as f:
-        message = html.unescape(Template(f.read()).render({
-            'mod': mod,
-            'user': user,
-            'site_name': _cfg('site-name'),
-            'domain': _cfg("domain"),
-            'latest': version,
-            'url': '/mod/' + str(mod.id) + '/' + secure_filename(mod.name)[:64],
-            'changelog': changelog
-        }))
+    message = html.unescape(_templates.get_template('mod-updated').render({
+        'mod': mod,
+        'user': user,
+        'site_name': _cfg('site-name'),
+        'domain': _cfg("domain"),
+        'latest': version,
+        'url': '/mod/' + str(mod.id) + '/' + secure_filename(mod.name)[:64],
+        'changelog': changelog
+    }))
     subject = user.username + " has just updated " + mod.name + "!"
-    send_mail.delay(_cfg('support-mail'), targets, subject, message)
+    _send_in_batches(_follower_emails(mod), subject, message)
 
 
 def send_autoupdate_notification(mod: Mod) -> None:
-    followers = [u.email for u in mod.followers]
     changelog = mod.default_version.changelog
     if changelog:
         changelog = '\n'.join(['    ' + line for line in changelog.split('\n')])
 
-    targets = list()
-    for follower in followers:
-        targets.append(follower)
-    if len(targets) == 0:
-        return
-    with open("emails/mod-autoupdated") as f:
-        message = html.unescape(Template(f.read()).render({
-            'mod': mod,
-            'domain': _cfg("domain"),
-            'latest': mod.default_version,
-            'url': '/mod/' + str(mod.id) + '/' + secure_filename(mod.name)[:64],
-            'changelog': changelog
-        }))
+    message = html.unescape(_templates.get_template('mod-autoupdated').render({
+        'mod': mod,
+        'domain': _cfg("domain"),
+        'latest': mod.default_version,
+        'url': '/mod/' + str(mod.id) + '/' + secure_filename(mod.name)[:64],
+        'changelog': changelog
+    }))
     subject = mod.name + " is compatible with " + \
               mod.game.name + mod.versions[0].gameversion.friendly_version + "!"
-    send_mail.delay(_cfg('support-mail'), targets, subject, message)
+    _send_in_batches(_follower_emails(mod), subject, message)
 
 
-def send_bulk_email(users: Iterable[User], subject: str, body: str) -> None:
-    targets = list()
-    for u in users:
-        targets.append(u)
-    send_mail.delay(_cfg('support-mail'), targets, subject, body)
+def send_bulk_email(emails: Query, subject: str, body: str) -> None:
+    _send_in_batches(emails, subject, body)
@@ -1,7 +1,10 @@
+import hashlib
 import urllib.parse
+from pathlib import Path
 from urllib.parse import parse_qs, urlparse
 from typing import Dict, Any, Match
 
+import markdown
 from markdown import Markdown
 from markdown.extensions import Extension
 from markdown.inlinepatterns import Pattern
@@ -77,3 +80,8 @@ class KerbDown(Extension):
         # BUG: the base method signature is INVALID, it's a bug in flask-markdown
         md.inlinePatterns['embeds'] = EmbedPattern(EMBED_RE, md, self.config) # type: ignore[attr-defined]
         md.registerExtension(self)
+
+
+def fingerprint() -> str:
+    """Changes whenever this module or the markdown package does, to invalidate cached HTML"""
+    return hashlib.sha1(Path(__file__).read_bytes() + markdown.__version__.encode('utf-8')).hexdigest()[:12]
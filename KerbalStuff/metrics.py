@@ -0,0 +1,294 @@
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .config import _cfg, site_logger
+
+# Where the metrics middleware finds the Flask endpoint of a request in its WSGI environment
+ENDPOINT_KEY = 'spacedock.endpoint'
+
+# Upper bounds of the buckets of the request duration histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Seconds between two writes of this process's metrics to metrics-dir
+FLUSH_INTERVAL = 5
+# Each process writes its metrics to {PROCESS_PREFIX}{host}-{pid}-{random}.json in metrics-dir
+PROCESS_PREFIX = 'process-'
+# The metrics of processes that ended are added up in this file in metrics-dir
+DEAD_PROCESSES_FILE = 'dead-processes.json'
+# Taken while moving the metrics of a process into DEAD_PROCESSES_FILE, and while collecting
+LOCK_FILE = 'dead-processes.lock'
+
+# Name -> (type, help text) of everything we count
+METRICS = {
+    'spacedock_http_request_duration_seconds': ('histogram', 'Time until a response was sent completely'),
+    'spacedock_http_responses_total': ('counter', 'Responses sent, per status'),
+    'spacedock_http_response_bytes_total': ('counter', 'Bytes of response bodies sent'),
+    'spacedock_downloads_total': ('counter', 'Mod downloads'),
+    'spacedock_mod_scores_computed_total': ('counter', 'Mod scores computed'),
+    'spacedock_thumbnails_created_total': ('counter', 'Backgrounds thumbnails were created for'),
+    'spacedock_ckan_posts_total': ('counter', 'Notifications sent to CKAN, per result'),
+    'spacedock_tasks_queued_total': ('counter', 'Celery tasks queued, per task. Emails are send_mail or send_mail_batch tasks'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+Counters = Dict[Tuple[str, Labels], float]
+# Histograms are counts per bucket of LATENCY_BUCKETS, then one for everything larger, then the sum
+Histograms = Dict[Tuple[str, Labels], List[float]]
+
+# The metrics of this process since it started, or since mark_process_dead.
+# Each process writes its own to a file in metrics-dir, collect() adds them up.
+# The file name is unique to the process, so one that reuses the pid of a dead one doesn't overwrite its metrics.
+# When a process ends, its metrics are added to DEAD_PROCESSES_FILE, so the sums never go down.
+_counters: Counters = dict()
+_histograms: Histograms = dict()
+_lock = threading.Lock()
+# Held while writing the file of this process
+_flush_lock = threading.Lock()
+# The process these metrics belong to, a forked child starts from zero
+_pid: Optional[int] = None
+_file_name = ''
+# Whether anything was counted since the last flush
+_dirty = False
+
+
+def _key(name: str, labels: Dict[str, str]) -> Tuple[str, Labels]:
+    return name, tuple(sorted(labels.items()))
+
+
+def _check_pid() -> None:
+    global _pid, _file_name
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _file_name = f'{PROCESS_PREFIX}{socket.gethostname()}-{_pid}-{uuid.uuid4().hex[:8]}.json'
+        _counters.clear()
+        _histograms.clear()
+        # Threads don't survive a fork, every process needs its own
+        threading.Thread(target=_flush_regularly, name='metrics-flush', daemon=True).start()
+
+
+def _flush_regularly() -> None:
+    # Also write what idle processes counted last, instead of waiting for their next request
+    pid = os.getpid()
+    while _pid == pid:
+        time.sleep(FLUSH_INTERVAL)
+        if _dirty:
+            flush()
+
+
+def count(name: str, amount: float = 1, **labels: str) -> None:
+    """Add to a counter of this process, if metrics-dir is configured"""
+    if not _cfg('metrics-dir'):
+        return
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        _counters[key] = _counters.get(key, 0) + amount
+        _dirty = True
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """Add a value to a histogram of this process, if metrics-dir is configured"""
+    if not _cfg('metrics-dir'):
+        return
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _check_pid()
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+        _dirty = True
+
+
+def _dump(counters: Counters, histograms: Histograms, **extra: Any) -> Dict[str, Any]:
+    return {'counters': [[name, dict(labels), value] for (name, labels), value in counters.items()],
+            'histograms': [[name, dict(labels), values] for (name, labels), values in histograms.items()],
+            **extra}
+
+
+def _add(data: Dict[str, Any], counters: Counters, histograms: Histograms) -> None:
+    """Add metrics in the format of _dump to counters and histograms"""
+    for name, labels, value in data['counters']:
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, values in data['histograms']:
+        key = _key(name, labels)
+        if key in histograms:
+            histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+        else:
+            histograms[key] = values
+
+
+def _load(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path: str, data: Dict[str, Any]) -> None:
+    # Write to a temporary file first, so collect() never reads half of it
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@contextmanager
+def _dead_processes_lock(metrics_dir: str) -> Iterator[None]:
+    # Other processes, maybe on other hosts sharing metrics-dir, could be collecting at the same time
+    with open(os.path.join(metrics_dir, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _add_to_dead(metrics_dir: str, data: Dict[str, Any], path: Optional[str]) -> None:
+    """Add data to DEAD_PROCESSES_FILE, then remove the file of its process. Needs _dead_processes_lock"""
+    counters: Counters = dict()
+    histograms: Histograms = dict()
+    dead_path = os.path.join(metrics_dir, DEAD_PROCESSES_FILE)
+    for d in (_load(dead_path), data):
+        if d:
+            _add(d, counters, histograms)
+    _write(dead_path, _dump(counters, histograms))
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's
+        return True
+    return True
+
+
+def flush() -> None:
+    """Write the metrics of this process to metrics-dir"""
+    global _dirty
+    metrics_dir = _cfg('metrics-dir')
+    if not metrics_dir:
+        return
+    with _flush_lock:
+        with _lock:
+            _check_pid()
+            data = _dump(_counters, _histograms, host=socket.gethostname(), pid=_pid)
+            path = os.path.join(metrics_dir, _file_name)
+            _dirty = False
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            _write(path, data)
+        except OSError:
+            site_logger.exception('Unable to write metrics to %s', metrics_dir)
+
+
+def mark_process_dead() -> None:
+    """
+    Move the metrics of this process into DEAD_PROCESSES_FILE, when it ends.
+    collect() does the same for processes that ended without calling this.
+    """
+    global _dirty
+    metrics_dir = _cfg('metrics-dir')
+    if not metrics_dir or _pid != os.getpid():
+        # Nothing counted in this process
+        return
+    with _flush_lock:
+        with _lock:
+            data = _dump(_counters, _histograms)
+            path = os.path.join(metrics_dir, _file_name)
+            # Anything counted after this starts from zero again
+            _counters.clear()
+            _histograms.clear()
+            _dirty = False
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            with _dead_processes_lock(metrics_dir):
+                _add_to_dead(metrics_dir, data, path)
+        except OSError:
+            site_logger.exception('Unable to write metrics to %s', metrics_dir)
+
+
+atexit.register(mark_process_dead)
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    def escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    pairs = ','.join(f'{name}="{escape(value)}"' for name, value in labels)
+    return '{' + pairs + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    # Prometheus reads floats, but large counts shouldn't lose digits to an exponent
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def collect() -> str:
+    """
+    The metrics of all processes that wrote to metrics-dir, in the Prometheus text format.
+    The files of processes on this host that ended are moved into DEAD_PROCESSES_FILE.
+    """
+    metrics_dir = _cfg('metrics-dir')
+    if not metrics_dir:
+        return ''
+    flush()
+    counters: Counters = dict()
+    histograms: Histograms = dict()
+    host = socket.gethostname()
+    with _dead_processes_lock(metrics_dir):
+        for path in Path(metrics_dir).glob(PROCESS_PREFIX + '*.json'):
+            data = _load(str(path))
+            if data is None:
+                continue
+            if data.get('host') == host and not _is_alive(data.get('pid', 0)):
+                _add_to_dead(metrics_dir, data, str(path))
+            else:
+                _add(data, counters, histograms)
+        dead = _load(os.path.join(metrics_dir, DEAD_PROCESSES_FILE))
+        if dead:
+            _add(dead, counters, histograms)
+
+    lines: List[str] = list()
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (key_name, labels), value in sorted(counters.items()):
+            if key_name == name:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        for (key_name, labels), values in sorted(histograms.items()):
+            if key_name != name:
+                continue
+            cumulative = 0.0
+            for bound, bucket in zip([*map(str, LATENCY_BUCKETS), '+Inf'], values):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels([*labels, ("le", bound)])} {_format_value(cumulative)}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(values[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {_format_value(cumulative)}')
+    return '\n'.join(lines) + '\n'
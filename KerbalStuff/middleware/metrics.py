@@ -0,0 +1,59 @@
+import time
+from typing import Any, Callable, Iterable, Iterator, Optional, TYPE_CHECKING
+
+from .. import metrics
+
+if TYPE_CHECKING:
+    from wsgiref.types import StartResponse, WSGIApplication, WSGIEnvironment
+
+
+class MetricsMiddleware:
+    """
+    Records the duration, status and size of every response per Flask endpoint in metrics.py.
+    The response is still streamed, it's counted as it passes through.
+    """
+
+    def __init__(self, app: "WSGIApplication") -> None:
+        self._app = app
+
+    def __call__(self, environ: "WSGIEnvironment", start_response: "StartResponse") -> Iterable[bytes]:
+        start = time.perf_counter()
+        status = ''
+
+        def catching_start_response(status_line: str, headers: Any, exc_info: Any = None) -> Callable[[bytes], Any]:
+            nonlocal status
+            status = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        def record(size: int) -> None:
+            # Requests that didn't match any route have no endpoint
+            endpoint = environ.get(metrics.ENDPOINT_KEY) or 'none'
+            metrics.observe('spacedock_http_request_duration_seconds', time.perf_counter() - start,
+                            endpoint=endpoint)
+            metrics.count('spacedock_http_responses_total', endpoint=endpoint, status=status)
+            metrics.count('spacedock_http_response_bytes_total', size, endpoint=endpoint)
+
+        return _CountingIterable(self._app(environ, catching_start_response), record)  # type: ignore[arg-type]
+
+
+class _CountingIterable:
+    """Passes a response on, and tells on_close how many bytes it had"""
+
+    def __init__(self, app_iter: Iterable[bytes], on_close: Callable[[int], None]) -> None:
+        self._app_iter = app_iter
+        self._on_close: Optional[Callable[[int], None]] = on_close
+        self._size = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._app_iter:
+            self._size += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._app_iter, 'close'):
+                self._app_iter.close()  # type: ignore[attr-defined]
+        finally:
+            if self._on_close:
+                self._on_close(self._size)
+                self._on_close = None
@@ -1,9 +1,17 @@
+import json
+import os
+import time
+from cProfile import Profile
+from pstats import Stats
 from sys import stdout
 from os import access, W_OK
-from typing import Optional, Iterable, Union, Callable, TextIO, List, TYPE_CHECKING
+from typing import Optional, Iterable, Union, Callable, TextIO, List, Any, TYPE_CHECKING
 
 from werkzeug.middleware.profiler import ProfilerMiddleware
 
+from ..config import site_logger
+from ..profiling import QUERY_STATS_KEY, index_profile
+
 if TYPE_CHECKING:
     from wsgiref.types import StartResponse, WSGIApplication, WSGIEnvironment
 
@@ -26,17 +34,64 @@ class ConditionalProfilerMiddleware(ProfilerMiddleware):
         self._profile_dir = profile_dir
         self._sampling_function = sampling_function
 
-    def __call__(self, environ: "WSGIEnvironment", start_response: "StartResponse") -> List[bytes]:
+    def __call__(self, environ: "WSGIEnvironment", start_response: "StartResponse") -> Iterable[bytes]:
 
         if (self._sampling_function and not self._sampling_function(environ)
             or self._profile_dir and not access(self._profile_dir, W_OK)):
-            # Run without profiling
-            response_body: List[bytes] = []
-            app_iter = self._app(environ, start_response)
+            # Run without profiling. Hand the response on as it is, so it's streamed
+            # rather than loaded into memory, and the server closes it when it's done.
+            return self._app(environ, start_response)
+
+        else:
+            return self._profile(environ, start_response)
+
+    def _profile(self, environ: "WSGIEnvironment", start_response: "StartResponse") -> List[bytes]:
+        """
+        Same as ProfilerMiddleware.__call__, but also saves the request's database.QueryStats
+        in a .json file next to the .prof file
+        """
+        response_body: List[bytes] = []
+
+        def catching_start_response(status: str, headers: Any, exc_info: Any = None) -> Callable[[bytes], None]:
+            start_response(status, headers, exc_info)
+            return response_body.append
+
+        def runapp() -> None:
+            app_iter = self._app(environ, catching_start_response)  # type: ignore[arg-type]
             response_body.extend(app_iter)
             if hasattr(app_iter, "close"):
-                app_iter.close() # type: ignore[attr-defined]
-            return [b"".join(response_body)]
+                app_iter.close()  # type: ignore[attr-defined]
 
-        else:
-            return super().__call__(environ, start_response)
+        profile = Profile()
+        start = time.time()
+        profile.runcall(runapp)
+        body = b"".join(response_body)
+        elapsed = time.time() - start
+
+        if self._profile_dir is not None:
+            filename = os.path.join(self._profile_dir, self._filename_format.format(
+                method=environ["REQUEST_METHOD"],
+                path=environ.get("PATH_INFO", "").strip("/").replace("/", ".") or "root",
+                elapsed=elapsed * 1000.0,
+                time=time.time(),
+            ))
+            profile.dump_stats(filename)
+            query_stats = environ.get(QUERY_STATS_KEY)
+            if query_stats is not None:
+                with open(filename + '.json', 'w') as f:
+                    json.dump(query_stats.as_dict(), f)
+            try:
+                index_profile(self._profile_dir, os.path.basename(filename))
+            except Exception:
+                # The profile is a bonus, the request has to succeed anyway
+                site_logger.exception('Unable to index profile %s', filename)
+
+        if self._stream is not None:
+            stats = Stats(profile, stream=self._stream)
+            stats.sort_stats(*self._sort_by)
+            print("-" * 80, file=self._stream)
+            print("PATH: {!r}".format(environ.get("PATH_INFO", "")), file=self._stream)
+            stats.print_stats(*self._restrictions)
+            print("-" * 80 + "\n", file=self._stream)
+
+        return [body]
@@ -4,13 +4,27 @@ from datetime import datetime
 import re
 
 import bcrypt
-from sqlalchemy import Column, Integer, String, Unicode, Boolean, DateTime, \
-    ForeignKey, Table, Float
-from sqlalchemy.orm import relationship, backref, reconstructor
+from sqlalchemy import Column, Integer, BigInteger, String, Unicode, Boolean, DateTime, \
+    ForeignKey, Table, Float, Index, UnicodeText, DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.engine import Dialect
+from sqlalchemy.orm import relationship, backref, reconstructor, deferred
+from sqlalchemy.types import TypeDecorator, TypeEngine
 
 from . import thumbnail
 from .database import Base
 
+class TSVector(TypeDecorator):
+    """A PostgreSQL tsvector, which degrades to plain text on other databases (i.e. the tests)"""
+    impl = UnicodeText
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect: Dialect) -> TypeEngine:
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(TSVECTOR())
+        return dialect.type_descriptor(UnicodeText())
+
+
 mod_followers = Table('mod_followers', Base.metadata,
                       Column('mod_id', Integer, ForeignKey('mod.id')),
                       Column('user_id', Integer, ForeignKey('user.id')))
@@ -161,13 +175,13 @@ class Game(Base):  # type: ignore
 class Mod(Base):  # type: ignore
     __tablename__ = 'mod'
     id = Column(Integer, primary_key=True)
-    created = Column(DateTime, default=datetime.now, index=True)
-    updated = Column(DateTime, default=datetime.now, index=True)
+    created = Column(DateTime, default=datetime.now, nullable=False, index=True)
+    updated = Column(DateTime, default=datetime.now, nullable=False, index=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship('User', backref=backref('mods', order_by=created), foreign_keys=user_id)
     game_id = Column(Integer, ForeignKey('game.id'))
     game = relationship('Game', backref='mods')
-    name = Column(String(100), index=True)
+    name = Column(String(100), nullable=False, index=True)
     description = Column(Unicode(100000))
     short_description = Column(Unicode(1000))
     published = Column(Boolean, default=False)
@@ -191,14 +205,48 @@ class Mod(Base):  # type: ignore
     follower_count = Column(Integer, nullable=False, default=0)
     download_count = Column(Integer, nullable=False, default=0)
     ckan = Column(Boolean)
+    # Weighted full text search document, maintained by a trigger on PostgreSQL (see below)
+    search_vector = deferred(Column(TSVector))
+
+    __table_args__ = (
+        Index('ix_mod_search_vector', search_vector, postgresql_using='gin'),
+        # Serves the substring matches of search.typeahead_mods
+        Index('ix_mod_name_trgm', name, postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
 
     def background_thumb(self) -> str:
-        return thumbnail.get_or_create(self.background)
+        return thumbnail.get_or_queue(self.background)
+
+    def background_thumb_set(self) -> str:
+        return thumbnail.image_set(self.background)
 
     def __repr__(self) -> str:
         return '<Mod %r %r>' % (self.id, self.name)
 
 
+# Needed by ix_mod_name_trgm
+event.listen(Mod.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+# Name matches rank above short descriptions, which rank above the long description.
+# Keep this in sync with the migration that introduced it.
+event.listen(Mod.__table__, 'after_create', DDL("""
+CREATE FUNCTION mod_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.short_description, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mod_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, short_description, description ON mod
+    FOR EACH ROW EXECUTE PROCEDURE mod_search_vector_update();
+""").execute_if(dialect='postgresql'))
+
+
 class ModList(Base):  # type: ignore
     __tablename__ = 'modlist'
     id = Column(Integer, primary_key=True)
@@ -260,6 +308,16 @@ class DownloadEvent(Base):  # type: ignore
         return '<Download Event %r>' % self.id
 
 
+class DownloadFlush(Base):  # type: ignore
+    """A batch of buffered downloads that has been written, so a retried flush doesn't count it again"""
+    __tablename__ = 'downloadflush'
+    id = Column(String(32), primary_key=True)
+    created = Column(DateTime, default=datetime.now, index=True)
+
+    def __repr__(self) -> str:
+        return '<Download Flush %r>' % self.id
+
+
 class FollowEvent(Base):  # type: ignore
     __tablename__ = 'followevent'
     id = Column(Integer, primary_key=True)
@@ -288,6 +346,27 @@ class ReferralEvent(Base):  # type: ignore
         return '<Download Event %r>' % self.id
 
 
+class ModChange(Base):  # type: ignore
+    """A change to a mod that mirrors need to know about, see /api/changes"""
+    __tablename__ = 'modchange'
+    id = Column(Integer, primary_key=True)
+    # No foreign key, deletions are logged too
+    mod_id = Column(Integer, index=True)
+    game_id = Column(Integer, ForeignKey('game.id'))
+    event_type = Column(String(32))
+    created = Column(DateTime, default=datetime.now, index=True)
+    # The transaction that added it, see changes.log_mod_change
+    txid = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        # /api/changes reads them in this order
+        Index('ix_modchange_txid_id', txid, id),
+    )
+
+    def __repr__(self) -> str:
+        return '<Mod Change %r>' % self.id
+
+
 class ModVersion(Base):  # type: ignore
     __tablename__ = 'modversion'
     id = Column(Integer, primary_key=True)
@@ -300,6 +379,9 @@ class ModVersion(Base):  # type: ignore
     gameversion = relationship('GameVersion', backref=backref('mod_versions', order_by=id))
     created = Column(DateTime, default=datetime.now)
     download_path = Column(String(512))
+    # Size in bytes and SHA-256 of the zip file, so we don't have to stat it for every page view
+    download_size = Column(BigInteger)
+    download_hash = Column(String(64))
     changelog = Column(Unicode(10000))
     sort_index = Column(Integer, default=0)
     download_count = Column(Integer, default=0)
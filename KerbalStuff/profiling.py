@@ -1,14 +1,210 @@
+import datetime
+import fcntl
+import os
 import random
-from typing import TYPE_CHECKING
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
 
-from .config import _cfgi
+from .config import _cfgi, site_logger
+from .sampler import FOLDED_SUFFIX, merge_days
 
 if TYPE_CHECKING:
     from wsgiref.types import StartResponse, WSGIEnvironment
 
+# Where the database.QueryStats of a request are kept in its WSGI environment
+QUERY_STATS_KEY = 'spacedock.query_stats'
+
+# Catalog of the profiles in profile-dir, so we don't have to list the directory to find them
+INDEX_NAME = 'profiles.sqlite'
+# Delete profiles and samples that are older than this many days, unless configured otherwise
+PROFILE_RETENTION_DAYS = 14
+# Seconds between two prunings of profile-dir, by any of the web processes sharing it
+PRUNE_INTERVAL = 60 * 60
+# Locked while pruning, holds the time it was done last
+PRUNE_LOCK_NAME = 'prune.lock'
+# Files that belong to a profile, next to its .prof file
+PROFILE_SUFFIXES = ('', '.json', '.svg')
+
+
 def sampling_function(environ: "WSGIEnvironment") -> bool:
     # Don't bother profiling admin pages or static files
     if environ.get('PATH_INFO', '').startswith(("/admin", "/content", "/static")):
         return False
     max = _cfgi('requests-per-profile', 1)
     return random.randrange(0, max) == 0
+
+
+def parse_prof_filename(name: str) -> Tuple[str, float, int]:
+    """The route, start time and duration in milliseconds of a profile, from its file name"""
+    pieces = name.split('.')
+    route_pieces = pieces[1:-3]
+    # ProfilerMiddleware uses 'root' as the route when it's '/', which doesn't help us
+    if len(route_pieces) == 1 and route_pieces[0] == 'root':
+        route_pieces = []
+    # The 'ms' suffix is hard coded in the default format string, it's always milliseconds
+    return '/' + '/'.join(route_pieces), float(pieces[-2]), int(pieces[-3].replace('ms', ''))
+
+
+def _parse_prof_filenames(paths: Iterable[Path]) -> Iterator[Tuple[str, str, float, int]]:
+    for path in paths:
+        try:
+            yield (path.name, *parse_prof_filename(path.name))
+        except (ValueError, IndexError):
+            # Not written by ConditionalProfilerMiddleware
+            pass
+
+
+def _connect(prof_dir: str) -> sqlite3.Connection:
+    path = Path(prof_dir) / INDEX_NAME
+    new = not path.exists()
+    conn = sqlite3.connect(str(path), timeout=10)
+    conn.execute('CREATE TABLE IF NOT EXISTS profiles '
+                 '(name TEXT PRIMARY KEY, route TEXT NOT NULL, started REAL NOT NULL, duration_ms INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS profiles_started ON profiles (started)')
+    if new:
+        # Catalog the profiles that were written before there was an index
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO profiles VALUES (?, ?, ?, ?)',
+                             _parse_prof_filenames(Path(prof_dir).glob('*.prof')))
+    return conn
+
+
+def index_profile(prof_dir: str, name: str) -> None:
+    """Add a profile that was just written to the index"""
+    conn = _connect(prof_dir)
+    try:
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)',
+                         (name, *parse_prof_filename(name)))
+    finally:
+        conn.close()
+
+
+def prune(prof_dir: str) -> int:
+    """Delete the profiles and samples older than profile-retention-days, returns how many profiles"""
+    cutoff = time.time() - _cfgi('profile-retention-days', PROFILE_RETENTION_DAYS) * 24 * 60 * 60
+    conn = _connect(prof_dir)
+    try:
+        names = [name for name, in conn.execute('SELECT name FROM profiles WHERE started < ?', (cutoff,))]
+        for name in names:
+            for suffix in PROFILE_SUFFIXES:
+                _remove(Path(prof_dir) / (name + suffix))
+        with conn:
+            conn.execute('DELETE FROM profiles WHERE started < ?', (cutoff,))
+    finally:
+        conn.close()
+    for path in Path(prof_dir).glob('*' + FOLDED_SUFFIX):
+        try:
+            if path.stat().st_mtime < cutoff:
+                _remove(path)
+        except FileNotFoundError:
+            pass
+    if names:
+        site_logger.info('Deleted %s profiles older than %s', len(names), datetime.date.fromtimestamp(cutoff))
+    return len(names)
+
+
+def prune_if_due(prof_dir: str) -> bool:
+    """
+    prune() and merge_days(), unless another process did that less than PRUNE_INTERVAL seconds ago
+    or is doing it right now. Returns whether it pruned.
+    """
+    lock_path = Path(prof_dir) / PRUNE_LOCK_NAME
+    with open(lock_path, 'a+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        f.seek(0)
+        try:
+            if time.time() - float(f.read()) < PRUNE_INTERVAL:
+                return False
+        except ValueError:
+            # Never pruned
+            pass
+        prune(prof_dir)
+        merge_days(prof_dir)
+        f.seek(0)
+        f.truncate()
+        f.write(str(time.time()))
+    # Closing the file unlocks it
+    return True
+
+
+def prune_in_background(prof_dir: str) -> None:
+    """
+    Have a thread prune_if_due(), if it looks like it's time.
+    Cheap enough for every request, it only looks at when the lock file was written.
+    """
+    try:
+        if time.time() - (Path(prof_dir) / PRUNE_LOCK_NAME).stat().st_mtime < PRUNE_INTERVAL:
+            return
+    except FileNotFoundError:
+        pass
+    threading.Thread(target=_prune_in_background, args=(prof_dir,), name='profile-pruner', daemon=True).start()
+
+
+def _prune_in_background(prof_dir: str) -> None:
+    try:
+        prune_if_due(prof_dir)
+    except Exception:
+        site_logger.exception('Unable to prune %s', prof_dir)
+
+
+def _remove(path: Path) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _term_condition(term: str) -> Tuple[str, List[object]]:
+    """The SQL condition and its parameters for one term of a search query"""
+    try:
+        if term.startswith('<'):
+            # Durations less than remainder of string
+            return 'duration_ms <= ?', [int(term[1:])]
+        elif term.startswith('>'):
+            # Durations greater than remainder of string
+            return 'duration_ms >= ?', [int(term[1:])]
+        elif term.startswith('start:'):
+            # Started on or after this date
+            year, month, day = map(int, term[6:].split('-'))
+            min_date = datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc)
+            return 'started >= ?', [min_date.timestamp()]
+        elif term.startswith('end:'):
+            # Started on or before this date
+            year, month, day = map(int, term[4:].split('-'))
+            max_date = datetime.datetime(year, month, day, tzinfo=datetime.timezone.utc)
+            return 'started < ?', [(max_date + datetime.timedelta(days=1)).timestamp()]
+        elif term.startswith('!'):
+            # Match the route, inverted
+            return 'instr(route, ?) = 0', [term[1:]]
+        else:
+            # Match the route
+            return 'instr(route, ?) > 0', [term]
+    except (ValueError, TypeError, OverflowError):
+        # Malformed search string
+        return '0', []
+
+
+def search_profiles(prof_dir: str, query: Optional[str],
+                    offset: int, limit: int) -> Tuple[int, List[Tuple[str, str, float, int]]]:
+    """
+    The number of profiles matching a search query, and the (name, route, started, duration_ms)
+    of limit of them after skipping offset, newest first
+    """
+    conditions = [_term_condition(term) for term in query.split(' ')] if query else []
+    where = ' AND '.join(sql for sql, _ in conditions) or '1'
+    params = [param for _, term_params in conditions for param in term_params]
+    conn = _connect(prof_dir)
+    try:
+        total = conn.execute(f'SELECT count(*) FROM profiles WHERE {where}', params).fetchone()[0]
+        rows = conn.execute(f'SELECT name, route, started, duration_ms FROM profiles WHERE {where} '
+                            'ORDER BY started DESC LIMIT ? OFFSET ?', params + [limit, offset]).fetchall()
+    finally:
+        conn.close()
+    return total, rows
@@ -0,0 +1,219 @@
+import html
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .config import site_logger
+
+# Milliseconds between two looks at the stacks of the threads handling requests
+SAMPLE_INTERVAL_MS = 10
+# Seconds of samples to collect before writing them to a file
+SAMPLE_WINDOW = 300
+# Sample files are named {start of window}.{pid}.folded
+FOLDED_SUFFIX = '.folded'
+# Those of days before today are merged into {start of day}.day.folded, see merge_days
+DAY_SUFFIX = '.day' + FOLDED_SUFFIX
+DAY = 24 * 60 * 60
+
+FLAME_GRAPH_WIDTH = 1200
+FLAME_GRAPH_FRAME_HEIGHT = 16
+
+
+def _label(code: CodeType) -> str:
+    # The folded format separates frames with ';' and the count with ' '
+    path = '/'.join(Path(code.co_filename).parts[-2:])
+    return f'{code.co_name} ({path}:{code.co_firstlineno})'.replace(';', ':')
+
+
+class StackSampler:
+    """
+    Looks at the stacks of the threads that are handling a request every interval seconds,
+    from a background thread, and counts how often it saw each stack per route.
+    Unlike cProfile this doesn't slow down the requests themselves,
+    so it can run all the time on every request.
+    Every window seconds the counts are written to a file in profile_dir,
+    in the folded format of flamegraph.pl with the route as the outermost frame.
+    """
+
+    def __init__(self, profile_dir: str,
+                 interval: float = SAMPLE_INTERVAL_MS / 1000, window: float = SAMPLE_WINDOW) -> None:
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.window = window
+        # Thread ident -> route it is handling
+        self._routes: Dict[int, str] = dict()
+        self._stacks: 'Counter[str]' = Counter()
+        self._window_start = time.time()
+        self._labels: Dict[CodeType, str] = dict()
+        self._lock = threading.Lock()
+        # The process that started the sampling thread, threads don't survive a fork
+        self._pid: Optional[int] = None
+
+    def start(self, route: str) -> None:
+        """Sample the current thread as handling route, until stop()"""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stacks.clear()
+                self._window_start = time.time()
+                threading.Thread(target=self._run, name='stack-sampler', daemon=True).start()
+            # The folded format separates frames with ';'
+            self._routes[threading.get_ident()] = route.replace(';', ':')
+
+    def stop(self) -> None:
+        with self._lock:
+            self._routes.pop(threading.get_ident(), None)
+
+    def sample(self) -> None:
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, route in self._routes.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._stacks[route + ';' + self._fold(frame)] += 1
+
+    def _fold(self, frame: Optional[FrameType]) -> str:
+        labels: List[str] = list()
+        while frame is not None:
+            label = self._labels.get(frame.f_code)
+            if label is None:
+                label = self._labels[frame.f_code] = _label(frame.f_code)
+            labels.append(label)
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def flush(self) -> None:
+        """Write the samples of the current window to profile_dir and start a new window"""
+        with self._lock:
+            stacks, self._stacks = self._stacks, Counter()
+            window_start, self._window_start = self._window_start, time.time()
+        if not stacks:
+            return
+        path = Path(self.profile_dir) / f'{window_start:.0f}.{os.getpid()}{FOLDED_SUFFIX}'
+        try:
+            _write(path, (f'{stack} {count}\n' for stack, count in stacks.items()))
+        except OSError:
+            site_logger.exception('Unable to write samples to %s', path)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if time.time() - self._window_start >= self.window:
+                self.flush()
+
+
+def _write(path: Path, lines: Iterable[str]) -> None:
+    # Write to a temporary file first, so nobody reads half of it
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def window_start(path: Path) -> float:
+    return float(path.name.split('.')[0])
+
+
+def sample_files(prof_dir: str, since: float) -> List[Path]:
+    """The sample files with samples taken after since"""
+    return [path for path in Path(prof_dir).glob('*' + FOLDED_SUFFIX)
+            if window_start(path) + (DAY if path.name.endswith(DAY_SUFFIX) else 0) >= since]
+
+
+def load_folded(paths: Iterable[Path]) -> Dict[str, 'Counter[str]']:
+    """Merge sample files into route -> stack -> count"""
+    routes: Dict[str, 'Counter[str]'] = dict()
+    for path in paths:
+        try:
+            with open(path) as f:
+                for line in f:
+                    stack, _, count = line.rstrip('\n').rpartition(' ')
+                    route, _, frames = stack.partition(';')
+                    routes.setdefault(route, Counter())[frames] += int(count)
+        except FileNotFoundError:
+            # Merged into a day in the meantime
+            pass
+    return routes
+
+
+def merge_days(prof_dir: str) -> int:
+    """
+    Merge the sample files of each day before today (UTC) into one, so looking at
+    a month of samples doesn't mean reading thousands of files.
+    Only one process at a time may do this. Returns how many days were merged.
+    """
+    today = time.time() // DAY * DAY
+    days: Dict[float, List[Path]] = dict()
+    for path in Path(prof_dir).glob('*' + FOLDED_SUFFIX):
+        if not path.name.endswith(DAY_SUFFIX) and window_start(path) < today:
+            days.setdefault(window_start(path) // DAY * DAY, list()).append(path)
+    for day, paths in days.items():
+        day_path = Path(prof_dir) / f'{day:.0f}{DAY_SUFFIX}'
+        # Windows that were still running when the day was merged last time
+        routes = load_folded([day_path, *paths])
+        _write(day_path, (f'{route};{stack} {count}\n'
+                          for route, stacks in routes.items() for stack, count in stacks.items()))
+        for path in paths:
+            os.remove(path)
+    return len(days)
+
+
+class _Node:
+    __slots__ = ('name', 'count', 'children')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.children: Dict[str, '_Node'] = dict()
+
+
+def render_svg(stacks: 'Counter[str]', title: str) -> str:
+    """Draw a flame graph of folded stacks"""
+    root = _Node(title)
+    depth = 0
+    for stack, count in stacks.items():
+        node = root
+        node.count += count
+        frames = stack.split(';')
+        depth = max(depth, len(frames))
+        for frame in frames:
+            node = node.children.setdefault(frame, _Node(frame))
+            node.count += count
+
+    width, frame_height = FLAME_GRAPH_WIDTH, FLAME_GRAPH_FRAME_HEIGHT
+    height = (depth + 1) * frame_height
+    boxes: List[str] = list()
+    # (node, x, level), the root at the bottom, callees stacked on top of their callers
+    todo: List[Tuple[_Node, float, int]] = [(root, 0.0, 0)]
+    while todo:
+        node, x, level = todo.pop()
+        w = node.count / max(root.count, 1) * width
+        if w < 0.5:
+            # Too narrow to see
+            continue
+        y = height - (level + 1) * frame_height
+        crc = zlib.crc32(node.name.encode('utf-8'))
+        color = f'rgb({205 + crc % 50},{(crc >> 8) % 230},{(crc >> 16) % 55})'
+        chars = int(w / 7)
+        label = node.name if len(node.name) <= chars else node.name[:chars - 2] + '..' if chars > 2 else ''
+        boxes.append(f'<g><title>{html.escape(node.name)} ({node.count} samples, '
+                     f'{100 * node.count / max(root.count, 1):.2f}%)</title>'
+                     f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{frame_height - 1}" fill="{color}"/>'
+                     f'<text x="{x + 3:.1f}" y="{y + frame_height - 4}">{html.escape(label)}</text></g>')
+        for child in sorted(node.children.values(), key=lambda c: c.name):
+            todo.append((child, x, level + 1))
+            x += child.count / max(root.count, 1) * width
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'font-family="Verdana" font-size="12">' + ''.join(boxes) + '</svg>')
@@ -1,15 +1,47 @@
+import bisect
 import math
+import re
+import time
 from datetime import datetime
-from typing import List, Iterable, Tuple, Optional
+from typing import Any, Dict, List, Iterable, Tuple, Optional
 
 from packaging import version
-from sqlalchemy import and_, or_, desc
+from sqlalchemy import Float, cast, or_, desc, func
+from sqlalchemy.orm import Query, aliased, joinedload
 
-from .database import db
-from .objects import Mod, ModVersion, User, Game, GameVersion
+from . import metrics
+from .database import db, is_postgresql
+from .objects import Mod, ModVersion, Media, User, GameVersion
 
+# Text search configuration used to build Mod.search_vector
+TS_CONFIG = 'english'
+WORD_PATTERN = re.compile(r'[^\W_]+')
+# Maximum number of suggestions returned by typeahead_mods
+TYPEAHEAD_LIMIT = 10
+# Seconds a process keeps using its parsed versions of a game
+GAME_VERSIONS_CACHE_TTL = 300
 
-def get_mod_score(mod: Mod) -> int:
+# game id -> (time.monotonic() when loaded, parsed versions in ascending order)
+_game_versions_cache: Dict[int, Tuple[float, List[version.Version]]] = dict()
+
+
+def get_mod_score(mod: Mod) -> float:
+    if mod.default_version is None:
+        return 0
+    return mod_score(follower_count=mod.follower_count,
+                     download_count=mod.download_count,
+                     version_count=len(mod.versions),
+                     media_count=len(mod.media),
+                     description_length=len(mod.description),
+                     updated=mod.updated,
+                     created=mod.created,
+                     has_source=bool(mod.source_link),
+                     num_incompat=versions_behind(mod))
+
+
+def mod_score(follower_count: int, download_count: int, version_count: int, media_count: int,
+              description_length: int, updated: Optional[datetime], created: datetime,
+              has_source: bool, num_incompat: int, now: Optional[datetime] = None) -> float:
     # Factors considered, * indicates important factors:
     # High followers and high downloads get bumped*
     # Mods with a long version history get bumped
@@ -19,97 +51,230 @@ def get_mod_score(mod: Mod) -> int:
     # Mods get points for supporting the latest KSP version
     # Mods get points for being open source
     # New mods are given a hefty bonus to avoid drowning among established mods
-    score = 0
-    if mod.default_version is None:
-        return score
-    score += mod.follower_count * 10
-    score += mod.download_count
-    score += len(mod.versions) // 5
-    score += len(mod.media)
-    if len(mod.description) < 100:
+    if now is None:
+        now = datetime.now()
+    score: float = 0
+    score += follower_count * 10
+    score += download_count
+    score += version_count // 5
+    score += media_count
+    if description_length < 100:
         score -= 10
-    if mod.updated:
-        delta = (datetime.now() - mod.updated).days
+    if updated:
+        delta = (now - updated).days
         if delta > 100:
             delta = 100  # Don't penalize for oldness past a certain point
         score -= delta / 5
-    if mod.source_link:
+    if has_source:
         score += 10
-    if (mod.created - datetime.now()).days < 30:
+    if (created - now).days < 30:
         score += 100
     # 5% penalty for each game version newer than the latest compatible (capped at 90%)
-    num_incompat = versions_behind(mod)
     if num_incompat > 0:
         penalty = min(0.05 * num_incompat, 0.9)
         score = int(score * (1.0 - penalty))
     return score
 
 
-def versions_behind(mod: Mod) -> int:
-    try:
-        all = game_versions(mod.game)
-        compat = version.Version(mod.default_version.gameversion.friendly_version)
-        return sum(1 for v in all if v > compat)
-    except version.InvalidVersion:
-        return 0
+def update_mod_scores(mod_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Recalculate Mod.score for the given mods (all of them by default) and write them back in bulk.
+    Computes the same thing as get_mod_score, but the inputs are fetched with a single aggregate
+    query instead of lazy loading relationships mod by mod,
+    and each game's versions are parsed only once.
+    Returns the number of mods whose score changed.
+    """
+    version_counts = db.query(ModVersion.mod_id, func.count(ModVersion.id).label('count')) \
+        .group_by(ModVersion.mod_id).subquery()
+    media_counts = db.query(Media.mod_id, func.count(Media.id).label('count')) \
+        .group_by(Media.mod_id).subquery()
+    default_version = aliased(ModVersion)
+    query = db.query(Mod.id, Mod.game_id, Mod.score, Mod.follower_count, Mod.download_count,
+                     func.coalesce(version_counts.c.count, 0),
+                     func.coalesce(media_counts.c.count, 0),
+                     func.coalesce(func.length(Mod.description), 0),
+                     Mod.updated, Mod.created, Mod.source_link,
+                     GameVersion.friendly_version) \
+        .join(default_version, Mod.default_version_id == default_version.id) \
+        .outerjoin(GameVersion, default_version.gameversion_id == GameVersion.id) \
+        .outerjoin(version_counts, version_counts.c.mod_id == Mod.id) \
+        .outerjoin(media_counts, media_counts.c.mod_id == Mod.id)
+    if mod_ids is not None:
+        mod_ids = list(mod_ids)
+        if not mod_ids:
+            return 0
+        query = query.filter(Mod.id.in_(mod_ids))
 
+    versions_by_game = _sorted_game_versions()
+    now = datetime.now()
+    computed = 0
+    updates = list()
+    for (mod_id, game_id, old_score, follower_count, download_count, version_count, media_count,
+         description_length, updated, created, source_link, compat) in query:
+        score = mod_score(follower_count=follower_count,
+                          download_count=download_count,
+                          version_count=version_count,
+                          media_count=media_count,
+                          description_length=description_length,
+                          updated=updated,
+                          created=created,
+                          has_source=bool(source_link),
+                          num_incompat=_count_newer(versions_by_game.get(game_id, []), compat),
+                          now=now)
+        computed += 1
+        if score != old_score:
+            updates.append({'id': mod_id, 'score': score})
+    metrics.count('spacedock_mod_scores_computed_total', computed)
+    # Mods without a default version score 0 in get_mod_score
+    unscored = db.query(Mod.id).filter(Mod.default_version_id == None, Mod.score != 0)
+    if mod_ids is not None:
+        unscored = unscored.filter(Mod.id.in_(mod_ids))
+    updates.extend({'id': mod_id, 'score': 0} for mod_id, in unscored)
 
-def game_versions(game: Game) -> Iterable[version.Version]:
-    for gv in game.versions:
+    if updates:
+        db.bulk_update_mappings(Mod, updates)
+    return len(updates)
+
+
+def _sorted_game_versions() -> Dict[int, List[version.Version]]:
+    """Sorted versions of all games, loaded in one query. Refreshes the per-game cache too."""
+    versions_by_game: Dict[int, List[version.Version]] = dict()
+    for game_id, friendly_version in db.query(GameVersion.game_id, GameVersion.friendly_version):
+        versions_by_game.setdefault(game_id, [])
+        try:
+            versions_by_game[game_id].append(version.Version(friendly_version))
+        except version.InvalidVersion:
+            pass
+    loaded = time.monotonic()
+    for game_id, versions in versions_by_game.items():
+        versions.sort()
+        _game_versions_cache[game_id] = (loaded, versions)
+    return versions_by_game
+
+
+def sorted_game_versions(game_id: int) -> List[version.Version]:
+    """
+    The parsable versions of a game in ascending order.
+    Cached per process; call invalidate_game_versions after adding versions.
+    Other processes pick up changes after GAME_VERSIONS_CACHE_TTL seconds.
+    """
+    cached = _game_versions_cache.get(game_id)
+    if cached and time.monotonic() - cached[0] < GAME_VERSIONS_CACHE_TTL:
+        return cached[1]
+    versions = list()
+    for friendly_version, in db.query(GameVersion.friendly_version).filter(GameVersion.game_id == game_id):
         try:
-            ver = version.Version(gv.friendly_version)
-            yield ver
+            versions.append(version.Version(friendly_version))
         except version.InvalidVersion:
             pass
+    versions.sort()
+    _game_versions_cache[game_id] = (time.monotonic(), versions)
+    return versions
+
+
+def invalidate_game_versions(game_id: Optional[int] = None) -> None:
+    if game_id is None:
+        _game_versions_cache.clear()
+    else:
+        _game_versions_cache.pop(game_id, None)
+
+
+def _count_newer(sorted_versions: List[version.Version], friendly_version: Optional[str]) -> int:
+    if friendly_version is None:
+        return 0
+    try:
+        compat = version.Version(friendly_version)
+    except version.InvalidVersion:
+        return 0
+    return len(sorted_versions) - bisect.bisect_right(sorted_versions, compat)
+
+
+def versions_behind(mod: Mod) -> int:
+    return _count_newer(sorted_game_versions(mod.game_id),
+                        mod.default_version.gameversion.friendly_version)
 
 
 def search_mods(game_id: Optional[int], text: str, page: int, limit: int) -> Tuple[List[Mod], int]:
-    terms = text.split(' ')
+    query, keys = search_mods_query(game_id, text)
+    return _fetch_page(query.order_by(*(desc(key) for key in keys)), page, limit)
+
+
+def search_mods_query(game_id: Optional[int], text: str) -> Tuple[Query, List[Any]]:
+    """
+    The query for mods matching the search text, and the keys to sort it by, in descending order.
+    The keys end with Mod.id, so they can be used for keyset pagination.
+    """
     query = db.query(Mod).join(Mod.user).join(Mod.game)
     if game_id:
         query = query.filter(Mod.game_id == game_id)
     query = query.filter(Mod.published)
     # ALL of the special search parameters have to match
-    and_filters = list()
-    for term in terms:
+    terms = list()
+    for term in text.split(' '):
         if term.startswith("ver:"):
-            and_filters.append(Mod.versions.any(ModVersion.gameversion.has(
+            query = query.filter(Mod.versions.any(ModVersion.gameversion.has(
                 GameVersion.friendly_version == term[4:])))
         elif term.startswith("user:"):
-            and_filters.append(User.username == term[5:])
+            query = query.filter(User.username == term[5:])
         elif term.startswith("game:"):
-            and_filters.append(Mod.game_id == int(term[5:]))
+            query = query.filter(Mod.game_id == int(term[5:]))
         elif term.startswith("downloads:>"):
-            and_filters.append(Mod.download_count > int(term[11:]))
+            query = query.filter(Mod.download_count > int(term[11:]))
         elif term.startswith("downloads:<"):
-            and_filters.append(Mod.download_count < int(term[11:]))
+            query = query.filter(Mod.download_count < int(term[11:]))
         elif term.startswith("followers:>"):
-            and_filters.append(Mod.follower_count > int(term[11:]))
+            query = query.filter(Mod.follower_count > int(term[11:]))
         elif term.startswith("followers:<"):
-            and_filters.append(Mod.follower_count < int(term[11:]))
-        else:
-            continue
-        terms.remove(term)
-    query = query.filter(and_(*and_filters))
+            query = query.filter(Mod.follower_count < int(term[11:]))
+        elif term:
+            terms.append(term)
     # Now the leftover is probably what the user thinks the mod name is.
     # ALL of them have to match again, however we don't care if it's in the name or description.
-    for term in terms:
-        or_filters = list()
-        or_filters.append(Mod.name.ilike('%' + term + '%'))
-        or_filters.append(Mod.short_description.ilike('%' + term + '%'))
-        or_filters.append(Mod.description.ilike('%' + term + '%'))
-        query = query.filter(or_(*or_filters))
+    keys: List[Any] = list()
+    if is_postgresql():
+        ts_query = tsquery_text(terms)
+        if ts_query:
+            ts_query_expr = func.to_tsquery(TS_CONFIG, ts_query)
+            query = query.filter(Mod.search_vector.op('@@')(ts_query_expr))
+            # ts_rank_cd returns a real, which doesn't survive the round trip through a cursor exactly
+            keys.append(cast(func.ts_rank_cd(Mod.search_vector, ts_query_expr), Float))
+    else:
+        for term in terms:
+            query = query.filter(or_(Mod.name.ilike('%' + term + '%'),
+                                     Mod.short_description.ilike('%' + term + '%'),
+                                     Mod.description.ilike('%' + term + '%')))
+
+    keys += [Mod.score, Mod.id]
+    return query, keys
+
 
-    query = query.order_by(desc(Mod.score))
+def tsquery_text(terms: Iterable[str]) -> str:
+    """
+    Turn search terms into the text for a to_tsquery() that requires every word of every term
+    to match as a prefix, similar to what the previous ILIKE based search did.
+    Anything that isn't a letter or digit would be tsquery syntax, so we split on it.
+    """
+    return ' & '.join(word + ':*'
+                      for term in terms
+                      for word in WORD_PATTERN.findall(term))
 
-    total_pages = math.ceil(query.count() / limit)
-    if page > total_pages:
-        page = total_pages
+
+def _fetch_page(query: Query, page: int, limit: int) -> Tuple[List[Mod], int]:
+    """
+    Get a page of results along with the number of pages.
+    The total is computed with a window function in the same statement,
+    we only need a separate count if the requested page is past the end.
+    """
     if page < 1:
         page = 1
-    mods = query.offset(limit * (page - 1)).limit(limit).all()
-
-    return mods, total_pages
+    rows = query.add_columns(func.count().over()).offset(limit * (page - 1)).limit(limit).all()
+    if not rows and page > 1:
+        total_pages = math.ceil(query.count() / limit)
+        if total_pages < 1:
+            return [], 0
+        rows = query.add_columns(func.count().over()).offset(limit * (total_pages - 1)).limit(limit).all()
+    total = rows[0][1] if rows else 0
+    return [row[0] for row in rows], math.ceil(total / limit)
 
 
 def search_users(text: str, page: int) -> Iterable[User]:
@@ -131,12 +296,15 @@ def search_users(text: str, page: int) -> Iterable[User]:
     return results[page * 10:page * 10 + 10]
 
 
-def typeahead_mods(game_id: str, text: str) -> Iterable[Mod]:
-    query = db.query(Mod)
-    filters = list()
-    filters.append(Mod.name.ilike('%' + text + '%'))
-    query = query.filter(or_(*filters))
-    query = query.filter(Mod.game_id == game_id, Mod.published == True)
-    query = query.order_by(desc(Mod.score))
-    results = query.all()
-    return results
+def typeahead_mods(game_id: str, text: str, limit: int = TYPEAHEAD_LIMIT) -> List[Mod]:
+    # On PostgreSQL the ILIKE is served by the ix_mod_name_trgm trigram index.
+    # Names starting with the text come first, then the rest by popularity.
+    query = db.query(Mod) \
+        .options(joinedload(Mod.user),
+                 joinedload(Mod.game),
+                 joinedload(Mod.default_version).joinedload(ModVersion.gameversion)) \
+        .filter(Mod.name.ilike('%' + text + '%')) \
+        .filter(Mod.game_id == game_id, Mod.published == True) \
+        .order_by(desc(Mod.name.ilike(text + '%')), desc(Mod.score)) \
+        .limit(limit)
+    return query.all()
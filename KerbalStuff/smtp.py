@@ -0,0 +1,80 @@
+import os
+import smtplib
+import threading
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from .config import _cfg, _cfgi, _cfgb, site_logger
+
+# Seconds a connection may sit unused before we check with a NOOP that it's still open
+SMTP_KEEPALIVE = 60
+
+# One connection per process, reused by every mail it sends
+_smtp: Optional[smtplib.SMTP] = None
+_smtp_pid: Optional[int] = None
+_last_used = 0.0
+_lock = threading.Lock()
+
+
+def _connect() -> smtplib.SMTP:
+    host = _cfg('smtp-host')
+    if not host:
+        raise smtplib.SMTPConnectError(0, 'No smtp-host configured')
+    smtp = smtplib.SMTP(host=host, port=_cfgi("smtp-port"))
+    if _cfgb("smtp-tls"):
+        smtp.starttls()
+    user = _cfg('smtp-user')
+    passwd = _cfg('smtp-password')
+    if user and passwd:
+        # If there's a user and no password, let the connection attempt fail hard so that it logs the message.
+        smtp.login(user, passwd)
+    return smtp
+
+
+def _get_connection() -> smtplib.SMTP:
+    global _smtp, _smtp_pid
+    if _smtp is not None and _smtp_pid != os.getpid():
+        # Inherited from the parent process, leave its socket alone
+        _smtp = None
+    if _smtp is not None and time.monotonic() - _last_used > SMTP_KEEPALIVE:
+        try:
+            if _smtp.noop()[0] != 250:
+                close()
+        except (smtplib.SMTPException, OSError):
+            close()
+    if _smtp is None:
+        _smtp = _connect()
+        _smtp_pid = os.getpid()
+    return _smtp
+
+
+def close() -> None:
+    """Close this process's SMTP connection, if it has one"""
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp = None
+
+
+def send_messages(messages: Iterable[Tuple[str, List[str], str]]) -> None:
+    """
+    Send (sender, recipients, message) tuples over this process's SMTP connection,
+    opening it if needed and reconnecting once if the server dropped it.
+    A message the server doesn't take is logged and skipped, so it doesn't cost the others.
+    """
+    global _last_used
+    with _lock:
+        for sender, recipients, message in messages:
+            site_logger.info("Sending email from %s to %s recipients", sender, len(recipients))
+            try:
+                try:
+                    _get_connection().sendmail(sender, recipients, message)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    close()
+                    _get_connection().sendmail(sender, recipients, message)
+            except smtplib.SMTPException:
+                site_logger.exception('Unable to send email from %s', sender)
+            _last_used = time.monotonic()
@@ -0,0 +1,43 @@
+import gzip
+import json
+import os
+import tempfile
+from typing import List
+
+from .blueprints.api import serialize_mod_list
+from .custom_json import CustomJSONEncoder
+from .database import db
+from .objects import Mod
+
+# Where the snapshot goes, relative to the storage directory so it's served under /content
+SNAPSHOT_PATH = 'snapshots/mods.ndjson.gz'
+# Number of mods loaded and serialized at once
+SNAPSHOT_CHUNK_SIZE = 500
+
+
+def write_snapshot(storage: str) -> str:
+    """
+    Write all published mods to a gzipped file with one JSON object per line,
+    in the same format as the /api/browse results. Needs a request context for url_for.
+    The previous snapshot is only replaced when the new one is complete.
+    Returns the path of the snapshot.
+    """
+    path = os.path.join(storage, SNAPSHOT_PATH)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mod_ids: List[int] = [mod_id for mod_id, in db.query(Mod.id).filter(Mod.published).order_by(Mod.id)]
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            for i in range(0, len(mod_ids), SNAPSHOT_CHUNK_SIZE):
+                chunk = Mod.query.filter(Mod.id.in_(mod_ids[i:i + SNAPSHOT_CHUNK_SIZE])).order_by(Mod.id)
+                for mod in serialize_mod_list(chunk):
+                    gz.write(json.dumps(mod, cls=CustomJSONEncoder, separators=(',', ':')).encode('utf-8'))
+                    gz.write(b'\n')
+                # Don't keep the whole catalog in the session
+                db.expunge_all()
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+    return path
@@ -1,28 +1,68 @@
 import os.path
+import tempfile
+import time
+from typing import Dict, List, Set, Tuple
 
 from PIL import Image
 
+from KerbalStuff import metrics
 from KerbalStuff.config import _cfg, _cfgi, site_logger
 
+# Multiples of thumbnail_size to create, for high resolution screens
+THUMBNAIL_SCALES = (1, 2)
+# Shown instead of a thumbnail until it has been created
+PLACEHOLDER_URL = '/static/background-s.png'
+
+# Seconds before we look for a missing thumbnail again
+THUMBNAIL_RECHECK = 30
+# Seconds before we queue a missing thumbnail again, in case the task got lost or failed
+THUMBNAIL_REQUEUE = 10 * 60
+# Backgrounds to remember the thumbnail state of, in this process
+THUMBNAIL_STATE_SIZE = 10000
+
+# Background -> time.monotonic() when this process queued its thumbnails
+_queued: Dict[str, float] = dict()
+# Backgrounds whose thumbnails all exist. Their file names change with every upload,
+# so once a thumbnail is there, it stays there.
+_ready: Set[str] = set()
+# Background -> (time.monotonic() when its thumbnails were last found missing, whether the plain JPEG exists)
+_missing: Dict[str, Tuple[float, bool]] = dict()
 
-def create(background_path: str, thumbnail_path: str) -> None:
-    if not os.path.isfile(background_path):
-        return
 
+def thumbnail_size() -> Tuple[int, int]:
     size_str = _cfg('thumbnail_size')
     if not size_str:
         size_str = "320x195"
     size_str_tuple = size_str.split('x')
-    size = (int(size_str_tuple[0]), int(size_str_tuple[1]))
+    return int(size_str_tuple[0]), int(size_str_tuple[1])
 
+
+def thumbnail_quality() -> int:
     quality = _cfgi('thumbnail_quality')
     # Docs say the quality shouldn't be above 95:
     # https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#jpeg
     if not quality or not (0 <= quality <= 95):
         quality = 80
+    return quality
+
 
-    im = Image.open(background_path)
+def thumbnail_url(background_url: str, scale: int = 1, extension: str = 'jpg') -> str:
+    (background_directory, background_file_name) = os.path.split(background_url)
+    suffix = '' if scale == 1 else f'@{scale}x'
+    thumb_file_name = f'{os.path.splitext(background_file_name)[0]}{suffix}.{extension}'
+    return os.path.join(background_directory, 'thumb_' + thumb_file_name)
 
+
+def _disk_path(storage: str, url: str) -> str:
+    return os.path.join(storage, url.replace('/content/', ''))
+
+
+def _thumbnail_urls(background_url: str) -> List[str]:
+    return [thumbnail_url(background_url, scale, extension)
+            for scale in THUMBNAIL_SCALES for extension in ('webp', 'jpg')]
+
+
+def _resize_and_crop(im: Image.Image, size: Tuple[int, int]) -> Image.Image:
     # We want to resize the image to the desired size in the least costly way,
     # while not distorting it. This means we first check which side needs _less_ rescaling to reach
     # the target size. After that we scale it down while keeping the original aspect ratio.
@@ -40,34 +80,161 @@ def create(background_path: str, thumbnail_path: str) -> None:
     # We basically define the upper left and the lower right corner of the area to crop out here,
     # but we have to serve them separately (better: in one 4-tuple) to im.crop():
     # https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.crop
-    box_left = round(0.5 * (im.width - size[0]))
-    box_upper = round(0.5 * (im.height - size[1]))
-    box_right = round(0.5 * (im.width + size[0]))
-    box_lower = round(0.5 * (im.height + size[1]))
-    im = im.crop((box_left, box_upper, box_right, box_lower))
-
-    if im.mode != "RGB":
-        im = im.convert("RGB")
-    im.save(thumbnail_path, 'jpeg', quality=quality, optimize=True)
-
+    # Rounding both corners separately can make the result a pixel too large, so derive the second one.
+    box_left = (im.width - size[0]) // 2
+    box_upper = (im.height - size[1]) // 2
+    box_right = box_left + size[0]
+    box_lower = box_upper + size[1]
+    return im.crop((box_left, box_upper, box_right, box_lower))
+
+
+def _save(im: Image.Image, path: str, image_format: str, quality: int) -> None:
+    # Write to a temporary file first, so nobody gets to see half of a thumbnail
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            im.save(f, image_format, quality=quality, optimize=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def create(background_url: str) -> None:
+    """
+    Create the thumbnails of a background, as JPEG and WebP in each of THUMBNAIL_SCALES.
+    The plain JPEG comes last, so once it exists the others do too.
+    """
+    storage = _cfg('storage')
+    if not storage:
+        return
+    background_path = _disk_path(storage, background_url)
+    if not os.path.isfile(background_path):
+        return
 
-def get_or_create(background_url: str) -> str:
+    size = thumbnail_size()
+    quality = thumbnail_quality()
+    scales = sorted(THUMBNAIL_SCALES, reverse=True)
+    with Image.open(background_path) as im:
+        # JPEGs can be decoded at a fraction of their size, which is a lot faster than
+        # decoding all of it only to scale it down. Ask for at least what the largest thumbnail needs.
+        ratio = min(im.width / (size[0] * scales[0]), im.height / (size[1] * scales[0]))
+        if ratio > 1:
+            im.draft('RGB', (round(im.width / ratio), round(im.height / ratio)))
+        rgb: Image.Image = im.convert("RGB") if im.mode != "RGB" else im
+        for scale in scales:
+            thumb = _resize_and_crop(rgb, (size[0] * scale, size[1] * scale))
+            _save(thumb, _disk_path(storage, thumbnail_url(background_url, scale, 'webp')), 'webp', quality)
+            _save(thumb, _disk_path(storage, thumbnail_url(background_url, scale, 'jpg')), 'jpeg', quality)
+    _ready.add(background_url)
+    metrics.count('spacedock_thumbnails_created_total')
+
+
+def needs_update(background_url: str, force: bool = False) -> bool:
+    """
+    Whether the background exists and its thumbnails are missing, older than it
+    or of another size than configured. With force, only whether the background exists.
+    """
+    storage = _cfg('storage')
+    if not storage:
+        return False
+    background_path = _disk_path(storage, background_url)
+    if not os.path.isfile(background_path):
+        return False
+    if force:
+        return True
+    size = thumbnail_size()
+    background_mtime = os.path.getmtime(background_path)
+    for scale in THUMBNAIL_SCALES:
+        for extension in ('webp', 'jpg'):
+            path = _disk_path(storage, thumbnail_url(background_url, scale, extension))
+            if not os.path.isfile(path) or os.path.getmtime(path) < background_mtime:
+                return True
+            with Image.open(path) as im:
+                # Only reads the header
+                if im.size != (size[0] * scale, size[1] * scale):
+                    return True
+    return False
+
+
+def queue(background_url: str) -> bool:
+    """
+    Have a Celery worker create the thumbnails of a background,
+    unless this process asked for it less than THUMBNAIL_REQUEUE seconds ago.
+    Returns whether they're queued.
+    """
+    now = time.monotonic()
+    queued_at = _queued.get(background_url)
+    if queued_at is not None and now - queued_at < THUMBNAIL_REQUEUE:
+        return True
+    if len(_queued) >= THUMBNAIL_STATE_SIZE:
+        _queued.clear()
+    _queued[background_url] = now
+    from .celery import create_thumbnails
+    try:
+        create_thumbnails.delay(background_url)
+    except Exception as e:
+        site_logger.exception(e)
+        # Try again next time
+        del _queued[background_url]
+        return False
+    return True
+
+
+def _is_ready(storage: str, background_url: str) -> Tuple[bool, bool]:
+    """
+    Whether all thumbnails of a background exist, and whether at least the plain JPEG does.
+    Thumbnails from before WebP and high resolution ones only have the plain JPEG.
+    Doesn't touch the disk except for the first time and every THUMBNAIL_RECHECK seconds while they're missing.
+    """
+    if background_url in _ready:
+        return True, True
+    now = time.monotonic()
+    missing = _missing.get(background_url)
+    if missing is not None and now - missing[0] < THUMBNAIL_RECHECK:
+        return False, missing[1]
+    if all(os.path.isfile(_disk_path(storage, url)) for url in _thumbnail_urls(background_url)):
+        if len(_ready) >= THUMBNAIL_STATE_SIZE:
+            _ready.clear()
+        _ready.add(background_url)
+        _missing.pop(background_url, None)
+        _queued.pop(background_url, None)
+        return True, True
+    has_jpeg = os.path.isfile(_disk_path(storage, thumbnail_url(background_url)))
+    if len(_missing) >= THUMBNAIL_STATE_SIZE:
+        _missing.clear()
+    _missing[background_url] = (now, has_jpeg)
+    return False, has_jpeg
+
+
+def get_or_queue(background_url: str) -> str:
+    """
+    The URL of a background's thumbnail, or of a placeholder while it's being created.
+    If it can't be queued, the background itself.
+    Missing thumbnails are queued, also if only the plain JPEG exists, which is shown meanwhile.
+    """
     storage = _cfg('storage')
     if not storage:
         return background_url
 
-    (background_directory, background_file_name) = os.path.split(background_url)
-
-    thumb_file_name = os.path.splitext(background_file_name)[0] + '.jpg'
-    thumb_url = os.path.join(background_directory, 'thumb_' + thumb_file_name)
+    ready, has_jpeg = _is_ready(storage, background_url)
+    if ready:
+        return thumbnail_url(background_url)
+    queued = queue(background_url)
+    if has_jpeg:
+        return thumbnail_url(background_url)
+    return PLACEHOLDER_URL if queued else background_url
 
-    thumb_disk_path = os.path.join(storage, thumb_url.replace('/content/', ''))
-    background_disk_path = os.path.join(storage, background_url.replace('/content/', ''))
 
-    if not os.path.isfile(thumb_disk_path):
-        try:
-            create(background_disk_path, thumb_disk_path)
-        except Exception as e:
-            site_logger.exception(e)
-            return background_url
-    return thumb_url
+def image_set(background_url: str) -> str:
+    """
+    A CSS background-image declaration offering all thumbnails of a background,
+    to override the plain JPEG in browsers that understand it. Empty until they're all created.
+    """
+    storage = _cfg('storage')
+    if not storage or not _is_ready(storage, background_url)[0]:
+        return ''
+    images = ', '.join(f"url('{thumbnail_url(background_url, scale, extension)}') type('{mime}') {scale}x"
+                       for extension, mime in (('webp', 'image/webp'), ('jpg', 'image/jpeg'))
+                       for scale in THUMBNAIL_SCALES)
+    return f'background-image: image-set({images});'
@@ -0,0 +1,108 @@
+import glob
+import hashlib
+import os
+import shutil
+import time
+from typing import IO, NamedTuple
+
+from .database import db
+from .objects import ModVersion
+
+# Bytes copied at once, so uploads never have to fit in memory
+COPY_BUFFER_SIZE = 1024 * 1024
+# Seconds after which the part file of an upload that stopped getting chunks is removed
+ABANDONED_PART_AGE = 24 * 60 * 60
+
+
+class FileInfo(NamedTuple):
+    size: int
+    sha256: str
+
+
+def write_chunk(path: str, stream: IO[bytes], offset: int = 0) -> FileInfo:
+    """
+    Copy stream into the file at path, starting at offset, COPY_BUFFER_SIZE bytes at a time.
+    The file is created if needed and never truncated, so chunks of the same upload can be
+    written in any order, even by parallel requests.
+    Returns the size and hash of the chunk.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        while True:
+            buf = stream.read(COPY_BUFFER_SIZE)
+            if not buf:
+                break
+            sha256.update(buf)
+            view = memoryview(buf)
+            while view:
+                written = os.pwrite(fd, view, offset + size)
+                view = view[written:]
+                size += written
+    finally:
+        os.close(fd)
+    return FileInfo(size, sha256.hexdigest())
+
+
+def remove_abandoned_parts(directory: str, max_age: float = ABANDONED_PART_AGE) -> int:
+    """
+    Remove the part files and chunk lists of uploads to directory
+    that didn't get a chunk for max_age seconds. Returns how many were removed.
+    """
+    removed = 0
+    cutoff = time.time() - max_age
+    pattern = os.path.join(glob.escape(directory), '*.part')
+    for path in glob.glob(pattern) + glob.glob(pattern + '.chunks'):
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            # Finished or removed by another request meanwhile
+            pass
+    return removed
+
+
+def file_info(path: str) -> FileInfo:
+    """The size and hash of a file, read COPY_BUFFER_SIZE bytes at a time"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(COPY_BUFFER_SIZE)
+            if not buf:
+                break
+            sha256.update(buf)
+            size += len(buf)
+    return FileInfo(size, sha256.hexdigest())
+
+
+def backfill_version_files(storage: str, batch_size: int = 100) -> int:
+    """
+    Fill in download_size and download_hash of versions uploaded before we stored them,
+    batch_size versions at a time with a commit after each batch.
+    Versions whose file is missing are left alone.
+    Returns the number of versions updated.
+    """
+    updated = 0
+    last_id = 0
+    while True:
+        batch = ModVersion.query \
+            .filter(ModVersion.download_size == None, ModVersion.id > last_id) \
+            .order_by(ModVersion.id) \
+            .limit(batch_size) \
+            .all()
+        if not batch:
+            return updated
+        for version in batch:
+            path = os.path.join(storage, version.download_path or '')
+            if os.path.isfile(path):
+                version.download_size, version.download_hash = file_info(path)
+                updated += 1
+        last_id = batch[-1].id
+        db.commit()
@@ -0,0 +1,53 @@
+"""Add Mod.search_vector for full text search
+
+Revision ID: 3c1e5f0a9b42
+Revises: 73c9d707134b
+Create Date: 2026-10-18 10:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c1e5f0a9b42'
+down_revision = '73c9d707134b'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade() -> None:
+    op.add_column('mod', sa.Column('search_vector', postgresql.TSVECTOR(), nullable=True))
+
+    # Same as the DDL attached to the Mod table in KerbalStuff/objects.py
+    op.execute("""
+        CREATE FUNCTION mod_search_vector_update() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('english', coalesce(NEW.name, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(NEW.short_description, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(NEW.description, '')), 'C');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER mod_search_vector_trigger
+            BEFORE INSERT OR UPDATE OF name, short_description, description ON mod
+            FOR EACH ROW EXECUTE PROCEDURE mod_search_vector_update()
+    """)
+
+    # Fill it for the existing mods, the trigger only handles future changes
+    op.execute("""
+        UPDATE mod SET search_vector =
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(short_description, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(description, '')), 'C')
+    """)
+    op.create_index('ix_mod_search_vector', 'mod', ['search_vector'], unique=False, postgresql_using='gin')
+
+
+def downgrade() -> None:
+    op.drop_index('ix_mod_search_vector', table_name='mod')
+    op.execute('DROP TRIGGER mod_search_vector_trigger ON mod')
+    op.execute('DROP FUNCTION mod_search_vector_update()')
+    op.drop_column('mod', 'search_vector')
@@ -0,0 +1,25 @@
+"""Add trigram index on Mod.name for typeahead
+
+Revision ID: 74d9dac39305
+Revises: 3c1e5f0a9b42
+Create Date: 2026-10-18 11:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '74d9dac39305'
+down_revision = '3c1e5f0a9b42'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    # Needs the postgresql-contrib package on the database server
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_mod_name_trgm', 'mod', ['name'], unique=False,
+                    postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'})
+
+
+def downgrade() -> None:
+    op.drop_index('ix_mod_name_trgm', table_name='mod')
@@ -0,0 +1,31 @@
+"""Add ModChange log for /api/changes
+
+Revision ID: 5b8e2d41c7a3
+Revises: 74d9dac39305
+Create Date: 2026-10-18 12:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2d41c7a3'
+down_revision = '74d9dac39305'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    op.create_table('modchange',
+                    sa.Column('id', sa.Integer(), primary_key=True),
+                    sa.Column('mod_id', sa.Integer(), nullable=True),
+                    sa.Column('game_id', sa.Integer(), sa.ForeignKey('game.id'), nullable=True),
+                    sa.Column('event_type', sa.String(length=32), nullable=True),
+                    sa.Column('created', sa.DateTime(), nullable=True))
+    op.create_index('ix_modchange_mod_id', 'modchange', ['mod_id'], unique=False)
+    op.create_index('ix_modchange_created', 'modchange', ['created'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_modchange_created', table_name='modchange')
+    op.drop_index('ix_modchange_mod_id', table_name='modchange')
+    op.drop_table('modchange')
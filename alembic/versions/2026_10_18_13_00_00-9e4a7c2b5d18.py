@@ -0,0 +1,26 @@
+"""Add ModVersion.download_size and download_hash
+
+Revision ID: 9e4a7c2b5d18
+Revises: 5b8e2d41c7a3
+Create Date: 2026-10-18 13:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e4a7c2b5d18'
+down_revision = '5b8e2d41c7a3'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    op.add_column('modversion', sa.Column('download_size', sa.BigInteger(), nullable=True))
+    op.add_column('modversion', sa.Column('download_hash', sa.String(length=64), nullable=True))
+    # The values for existing versions need the files in storage,
+    # run `./spacedock migrate version_files` to fill them in batches
+
+
+def downgrade() -> None:
+    op.drop_column('modversion', 'download_hash')
+    op.drop_column('modversion', 'download_size')
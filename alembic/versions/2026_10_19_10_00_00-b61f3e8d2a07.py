@@ -0,0 +1,26 @@
+"""Add DownloadFlush to make flushing buffered downloads safe to retry
+
+Revision ID: b61f3e8d2a07
+Revises: 9e4a7c2b5d18
+Create Date: 2026-10-19 10:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b61f3e8d2a07'
+down_revision = '9e4a7c2b5d18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    op.create_table('downloadflush',
+                    sa.Column('id', sa.String(length=32), primary_key=True),
+                    sa.Column('created', sa.DateTime(), nullable=True))
+    op.create_index('ix_downloadflush_created', 'downloadflush', ['created'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_downloadflush_created', table_name='downloadflush')
+    op.drop_table('downloadflush')
@@ -0,0 +1,30 @@
+"""Make the sort keys of mod lists NOT NULL
+
+Revision ID: c4a9e2f17b36
+Revises: b61f3e8d2a07
+Create Date: 2026-10-19 11:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4a9e2f17b36'
+down_revision = 'b61f3e8d2a07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    # Keyset pagination compares these, a NULL would never be listed
+    op.execute('UPDATE mod SET created = COALESCE(updated, now()) WHERE created IS NULL')
+    op.execute('UPDATE mod SET updated = created WHERE updated IS NULL')
+    op.execute("UPDATE mod SET name = '' WHERE name IS NULL")
+    op.alter_column('mod', 'created', existing_type=sa.DateTime(), nullable=False)
+    op.alter_column('mod', 'updated', existing_type=sa.DateTime(), nullable=False)
+    op.alter_column('mod', 'name', existing_type=sa.String(length=100), nullable=False)
+
+
+def downgrade() -> None:
+    op.alter_column('mod', 'name', existing_type=sa.String(length=100), nullable=True)
+    op.alter_column('mod', 'updated', existing_type=sa.DateTime(), nullable=True)
+    op.alter_column('mod', 'created', existing_type=sa.DateTime(), nullable=True)
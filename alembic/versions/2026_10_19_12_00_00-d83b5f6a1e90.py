@@ -0,0 +1,25 @@
+"""Add ModChange.txid to read changes in commit order
+
+Revision ID: d83b5f6a1e90
+Revises: c4a9e2f17b36
+Create Date: 2026-10-19 12:00:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd83b5f6a1e90'
+down_revision = 'c4a9e2f17b36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade() -> None:
+    # Changes from before come first, in the order of their ids
+    op.add_column('modchange', sa.Column('txid', sa.BigInteger(), nullable=False, server_default='0'))
+    op.create_index('ix_modchange_txid_id', 'modchange', ['txid', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_modchange_txid_id', table_name='modchange')
+    op.drop_column('modchange', 'txid')
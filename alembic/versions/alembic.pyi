@@ -8,7 +8,7 @@
     - https://github.com/miguelgrinberg/Flask-Migrate/issues/155
 """
 
-from typing import List, Optional
+from typing import Any, List, Optional
 from sqlalchemy import sa
 
 
@@ -21,11 +21,27 @@ class op:
     def f(cls,
           s: str) -> str: ...
 
+    @classmethod
+    def create_table(cls,
+                     table_name: str,
+                     *columns: sa.Column) -> None: ...
+
+    @classmethod
+    def drop_table(cls,
+                   table_name: str) -> None: ...
+
     @classmethod
     def add_column(cls,
                    table_name: str,
                    column: sa.Column) -> None: ...
 
+    @classmethod
+    def alter_column(cls,
+                     table_name: str,
+                     column_name: str,
+                     nullable: Optional[bool] = None,
+                     **kw: Any) -> None: ...
+
     @classmethod
     def drop_column(cls,
                     table_name: str,
@@ -36,7 +52,12 @@ class op:
                      index_name: str,
                      table_name: str,
                      columns: List[str],
-                     unique: Optional[bool] = False) -> None: ...
+                     unique: Optional[bool] = False,
+                     **kw: Any) -> None: ...
+
+    @classmethod
+    def execute(cls,
+                sqltext: str) -> None: ...
 
     @classmethod
     def drop_index(cls,
@@ -1,6 +1,20 @@
 from .test_api_browse import *
 from .test_api_mod import *
+from .test_api_changes import *
 from .test_api_errors import *
+from .test_ckan import *
+from .test_downloads import *
 from .test_errors import *
+from .test_game_page import *
+from .test_metrics import *
+from .test_mod_scores import *
 from .test_objects_user import *
+from .test_profiling import *
+from .test_render_cache import *
+from .test_sampler import *
+from .test_search import *
+from .test_snapshot import *
+from .test_smtp import *
+from .test_thumbnail import *
+from .test_uploads import *
 from .test_version import *
@@ -5,7 +5,9 @@ from flask import Response
 
 from .fake_config import dummy
 from KerbalStuff.database import create_database, create_tables, drop_database, drop_tables
+from KerbalStuff import cache
 from KerbalStuff.app import app
+from KerbalStuff.search import invalidate_game_versions
 
 # FlaskClient requires a type parameter in mypy, but errors out with one at runtime
 @pytest.fixture
@@ -16,3 +18,6 @@ def client() -> Generator['FlaskClient[Response]', None, None]:
     with app.test_client() as client:
         yield client
     drop_tables()
+    # The next test's database reuses the same game ids
+    invalidate_game_versions()
+    cache._local_counts.clear()
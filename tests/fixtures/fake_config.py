@@ -10,5 +10,6 @@ config[env]['connection-string'] = 'sqlite:///:memory:'
 config[env]['protocol'] = 'https'
 config[env]['domain'] = 'tests.spacedock.info'
 config[env]['ksp-game-id'] = '1'
+config[env]['secret-key'] = 'tests'
 
 dummy = ''
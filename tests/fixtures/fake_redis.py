@@ -0,0 +1,88 @@
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
+
+import pytest
+import redis
+
+from KerbalStuff import cache
+
+
+class FakeRedis:
+    """Just enough of redis.Redis with decode_responses for our code, in memory"""
+
+    def __init__(self) -> None:
+        self.data: Dict[str, Any] = dict()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.data.get(key)
+
+    def set(self, key: str, value: Any) -> bool:
+        self.data[key] = str(value)
+        return True
+
+    def setex(self, key: str, ttl: int, value: Any) -> bool:
+        return self.set(key, value)
+
+    def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def exists(self, *keys: str) -> int:
+        return sum(key in self.data for key in keys)
+
+    def rename(self, src: str, dst: str) -> bool:
+        if src not in self.data:
+            raise redis.ResponseError('no such key')
+        self.data[dst] = self.data.pop(src)
+        return True
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        hash = self.data.setdefault(key, dict())
+        hash[field] = str(int(hash.get(field, 0)) + amount)
+        return int(hash[field])
+
+    def hgetall(self, key: str) -> Dict[str, str]:
+        return dict(self.data.get(key, dict()))
+
+    def pipeline(self) -> 'FakePipeline':
+        return FakePipeline(self)
+
+    def lock(self, name: str, timeout: Optional[float] = None) -> 'FakeLock':
+        return FakeLock()
+
+
+class FakePipeline:
+    def __init__(self, r: FakeRedis) -> None:
+        self.r = r
+        self.commands: List[Tuple[Callable[..., Any], Tuple[Any, ...]]] = list()
+
+    def __enter__(self) -> 'FakePipeline':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Callable[..., 'FakePipeline']:
+        def queue(*args: Any) -> 'FakePipeline':
+            self.commands.append((getattr(self.r, name), args))
+            return self
+        return queue
+
+    def execute(self) -> List[Any]:
+        return [command(*args) for command, args in self.commands]
+
+
+class FakeLock:
+    def acquire(self, blocking: bool = True) -> bool:
+        return True
+
+    def release(self) -> None:
+        pass
+
+
+@pytest.fixture
+def fake_redis() -> Generator[FakeRedis, None, None]:
+    r = FakeRedis()
+    cache._redis = r  # type: ignore[assignment]
+    try:
+        yield r
+    finally:
+        cache._redis = None
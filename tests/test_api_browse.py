@@ -1,13 +1,17 @@
+import base64
 from datetime import datetime
+from typing import Any
 
 import pytest
 from flask.testing import FlaskClient
-from flask import Response
+from flask import Response, url_for
 from flask_api import status
+from sqlalchemy import desc, event
 
 from .fixtures.client import client
+from KerbalStuff.app import app
 from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion
-from KerbalStuff.database import db
+from KerbalStuff.database import db, engine
 
 
 @pytest.mark.usefixtures("client")
@@ -22,7 +26,7 @@ def test_api_browse(client: 'FlaskClient[Response]') -> None:
 
     # Assert
     assert browse_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
-    assert browse_resp.data == b'{"total":0,"count":30,"pages":1,"page":1,"result":[]}', 'Should be a simple empty db'
+    assert browse_resp.data == b'{"total":0,"count":30,"pages":1,"page":1,"next_after":null,"result":[]}', 'Should be a simple empty db'
 
     assert new_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
     assert new_resp.data == b'[]', 'Should return empty list'
@@ -32,3 +36,158 @@ def test_api_browse(client: 'FlaskClient[Response]') -> None:
 
     assert featured_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
     assert featured_resp.data == b'[]', 'Should return empty list'
+
+
+def _add_mods(game: Game, user: User, count: int) -> None:
+    for i in range(count):
+        mod = Mod(
+            name=f'Test Mod {i}',
+            short_description='A mod for testing',
+            description='A mod that we will use to test the API',
+            user=user,
+            license='MIT',
+            game=game,
+            ckan=False,
+            published=True,
+        )
+        for friendly_version in ['0.9', '1.0 beta+1']:
+            mod.default_version = ModVersion(
+                mod=mod,
+                friendly_version=friendly_version,
+                gameversion=GameVersion(friendly_version=f'1.{i}', game=game),
+                download_path=f'/tmp/{i}.zip',
+                created=datetime.now(),
+            )
+        db.add(mod)
+    db.commit()
+
+
+def _count_queries(client: 'FlaskClient[Response]', url: str) -> int:
+    queries = list()
+
+    def count(*args: Any, **kwargs: Any) -> None:
+        queries.append(args)
+
+    # Page counts are cached, make sure that's not what we measure
+    client.get(url)
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    return len(queries)
+
+
+@pytest.mark.usefixtures("client")
+def test_api_browse_query_count(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    db.add(game)
+    _add_mods(game, user, 1)
+    urls = ['/api/browse', '/api/browse/new', '/api/browse/top', '/api/search/mod?query=Test']
+
+    # Act
+    few_mods = [_count_queries(client, url) for url in urls]
+    _add_mods(game, user, 5)
+    db.expire_all()
+    more_mods = [_count_queries(client, url) for url in urls]
+    browse_resp = client.get('/api/browse/new')
+
+    # Assert
+    assert few_mods == more_mods, 'Number of queries should not depend on the number of mods'
+    assert max(more_mods) <= 6, 'Mod lists should be loaded with a handful of queries'
+    with app.test_request_context():
+        expected = [url_for('mods.download', mod_id=m.id, mod_name=m.name, version=v.friendly_version)
+                    for m in Mod.query.order_by(desc(Mod.created)) for v in m.versions]
+    assert [v['download_path'] for m in browse_resp.json for v in m['versions']] == expected, \
+        'Download paths should match url_for'
+
+
+@pytest.mark.usefixtures("client")
+def test_api_browse_cursor(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    db.add(game)
+    _add_mods(game, user, 5)
+    # Same creation time for some of them, the id has to break the tie
+    for mod in Mod.query.filter(Mod.id < 4):
+        mod.created = datetime(2020, 1, 1)
+    db.commit()
+    expected = [m.id for m in Mod.query.order_by(desc(Mod.created), desc(Mod.id))]
+
+    # Act
+    first_resp = client.get('/api/browse?count=2&order=desc')
+    pages = [first_resp.json]
+    while pages[-1]['next_after']:
+        pages.append(client.get(f'/api/browse?count=2&order=desc&after={pages[-1]["next_after"]}').json)
+    bad_cursor_resp = client.get('/api/browse?count=2&order=desc&after=garbage')
+    new_resp = client.get('/api/browse/new')
+    html_resp = client.get(f'/browse/new?page=2&after={first_resp.json["next_after"]}')
+
+    # Assert
+    assert [m['id'] for page in pages for m in page['result']] == expected, \
+        'Following the cursors should list every mod once, in order'
+    assert len(pages) == 3, 'Five mods should take three pages of two'
+    assert bad_cursor_resp.json['result'] == first_resp.json['result'], \
+        'An invalid cursor should be ignored'
+    assert 'Link' not in new_resp.headers, 'A single page should not link to a next one'
+    assert html_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+
+
+@pytest.mark.usefixtures("client")
+def test_api_browse_cursor_mismatch(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(name='Kerbal Space Program', publisher=Publisher(name='SQUAD'),
+                short='kerbal-space-program', active=True)
+    user = User(username='TestModAuthor', email='webmaster@spacedock.info', public=True)
+    db.add(game)
+    _add_mods(game, user, 5)
+    # Updated at the same time, only the id tells them apart
+    same_time = datetime.now()
+    for mod in Mod.query.filter(Mod.id < 4):
+        mod.updated = same_time
+    db.commit()
+    wrong_types = base64.urlsafe_b64encode(b'["x",1]').decode('ascii')
+
+    # Act
+    first_resp = client.get('/api/browse?count=2&orderby=updated')
+    pages = [first_resp.json]
+    while pages[-1]['next_after']:
+        pages.append(client.get(f'/api/browse?count=2&orderby=updated&after={pages[-1]["next_after"]}').json)
+    wrong_types_resp = client.get(f'/api/browse?count=2&orderby=updated&after={wrong_types}')
+    other_order_resp = client.get(f'/api/browse?count=2&orderby=name&after={first_resp.json["next_after"]}')
+
+    # Assert
+    assert sorted(m['id'] for page in pages for m in page['result']) == [1, 2, 3, 4, 5], \
+        'Mods with the same sort value should all be listed'
+    assert wrong_types_resp.status_code == status.HTTP_200_OK, 'Cursors with the wrong types should be ignored'
+    assert wrong_types_resp.json['result'] == first_resp.json['result'], 'Invalid cursor should show the first page'
+    assert other_order_resp.status_code == status.HTTP_200_OK, 'Cursors of another order should be ignored'
+    assert other_order_resp.json['page'] == 1, 'Invalid cursor should show the first page'
@@ -0,0 +1,82 @@
+from datetime import datetime
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from flask_api import status
+
+from .fixtures.client import client
+from KerbalStuff.ckan import notify_ckan
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion
+from KerbalStuff.database import db
+
+
+@pytest.mark.usefixtures("client")
+def test_api_changes(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    mods = list()
+    for name, published in [('Public Mod', True), ('Hidden Mod', False)]:
+        mod = Mod(
+            name=name,
+            short_description='A mod for testing',
+            description='A mod that we will use to test the API',
+            user=user,
+            license='MIT',
+            game=game,
+            ckan=False,
+            published=published,
+        )
+        mod.default_version = ModVersion(
+            mod=mod,
+            friendly_version='1.0',
+            gameversion=GameVersion(friendly_version='1.12.2', game=game),
+            download_path='/tmp/blah.zip',
+            created=datetime.now(),
+        )
+        mods.append(mod)
+    db.add(game)
+    db.add_all(mods)
+    db.commit()
+    public_mod, hidden_mod = mods
+
+    # Act
+    notify_ckan(public_mod, 'edit')
+    notify_ckan(hidden_mod, 'edit')
+    notify_ckan(hidden_mod, 'locked', True)
+    db.commit()
+    all_resp = client.get('/api/changes')
+    notify_ckan(public_mod, 'update')
+    db.commit()
+    since_resp = client.get(f'/api/changes?since={all_resp.json["changes"][0]["id"]}')
+    done_resp = client.get(f'/api/changes?since={all_resp.json["next_since"]}')
+    last_resp = client.get(f'/api/changes?since={done_resp.json["next_since"]}')
+
+    # Assert
+    assert all_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    assert [(c['mod_id'], c['event_type']) for c in all_resp.json['changes']] \
+        == [(public_mod.id, 'edit'), (hidden_mod.id, 'locked')], \
+        'Changes of public mods and forced events should be logged'
+    assert [m['id'] for m in all_resp.json['mods']] == [public_mod.id], \
+        'Only public mods should be included'
+    assert [c['event_type'] for c in since_resp.json['changes']] == ['locked', 'update'], \
+        'Only changes after since should be returned, also for plain ids'
+    assert [c['event_type'] for c in done_resp.json['changes']] == ['update'], \
+        'Changes after the cursor should be returned'
+    assert [c['event_type'] for c in last_resp.json['changes']] == [], 'There should be nothing after the last change'
+    assert last_resp.json['next_since'] == done_resp.json['next_since'], \
+        'The cursor should stay put when there are no changes'
+    assert not all_resp.json['more'], 'Everything should fit in one response'
@@ -89,7 +89,7 @@ def test_api_mod(client: 'FlaskClient[Response]') -> None:
     check_user(user_resp.json)
 
     assert typeahead_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
-    check_mod(typeahead_resp.json[0])
+    check_typeahead_mod(typeahead_resp.json[0])
 
     assert search_mod_resp.status_code == status.HTTP_200_OK, 'Request should succeed'
     check_mod(search_mod_resp.json[0])
@@ -124,6 +124,16 @@ def check_mod(mod_json: Dict[str, Any]) -> None:
     assert mod_json['versions'][0]['game_version'] == '1.2.3', 'Game version should match'
 
 
+def check_typeahead_mod(mod_json: Dict[str, Any]) -> None:
+    assert mod_json['name'] == 'Test Mod', 'Name should match'
+    assert mod_json['id'] == 1, 'ID number should match'
+    assert mod_json['author'] == 'TestModAuthor', 'Author should match'
+    assert mod_json['url'] == '/mod/1/Test%20Mod', 'URL should match'
+    assert mod_json['default_version']['friendly_version'] == '1.0.0.0', 'Version should match'
+    assert mod_json['default_version']['game_version'] == '1.2.3', 'Game version should match'
+    assert 'versions' not in mod_json, 'Should not serialize every version'
+
+
 def check_mod_version(mod_version_json: Dict[str, Any]) -> None:
     assert mod_version_json['friendly_version'] == '1.0.0.0', 'Version should match'
     assert mod_version_json['game_version'] == '1.2.3', 'Game version should match'
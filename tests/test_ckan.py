@@ -0,0 +1,127 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Generator, List, Tuple
+from urllib.parse import parse_qsl
+
+import pytest
+
+from KerbalStuff.ckan import NotificationDispatcher
+
+
+@pytest.fixture
+def notify_server() -> Generator[Tuple[str, List[dict]], None, None]:
+    received: List[dict] = list()
+    failures = [503]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            # Fail the first request to a flaky URL, to check that it's retried
+            if self.path.endswith('/flaky') and failures:
+                self.send_response(failures.pop())
+            else:
+                received.append(dict(parse_qsl(body.decode('utf-8'))))
+                self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args: object) -> None:
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/notify', received
+    server.shutdown()
+    server.server_close()
+
+
+def test_dispatcher_coalesces(notify_server: Tuple[str, List[dict]]) -> None:
+    # Arrange
+    url, received = notify_server
+    dispatcher = NotificationDispatcher(delay=3600, max_size=3)
+
+    # Act
+    for i in range(5):
+        dispatcher.post(url, ('edit', 1), {'mod_id': '1', 'event_type': 'edit', 'n': str(i)})
+    dispatcher.post(url, ('delete', 1), {'mod_id': '1', 'event_type': 'delete'})
+    dispatcher.post(url, ('edit', 2), {'mod_id': '2', 'event_type': 'edit'})
+    dispatcher.post(url, ('edit', 3), {'mod_id': '3', 'event_type': 'edit'})
+    dispatcher.flush()
+
+    # Assert
+    assert received == [
+        {'mod_id': '1', 'event_type': 'edit', 'n': '4'},
+        {'mod_id': '1', 'event_type': 'delete'},
+        {'mod_id': '2', 'event_type': 'edit'},
+    ], 'Repeated events should be merged and the queue should be bounded'
+
+
+def test_dispatcher_keeps_last_state(notify_server: Tuple[str, List[dict]]) -> None:
+    # Arrange
+    url, received = notify_server
+    dispatcher = NotificationDispatcher(delay=3600)
+
+    # Act
+    dispatcher.post(url, ('locked', 1), {'mod_id': '1', 'event_type': 'locked'})
+    dispatcher.post(url, ('unlocked', 1), {'mod_id': '1', 'event_type': 'unlocked'})
+    dispatcher.post(url, ('locked', 1), {'mod_id': '1', 'event_type': 'locked'})
+    dispatcher.flush()
+
+    # Assert
+    assert received == [
+        {'mod_id': '1', 'event_type': 'unlocked'},
+        {'mod_id': '1', 'event_type': 'locked'},
+    ], 'The last event should be sent last'
+
+
+def test_dispatcher_sends_when_due(notify_server: Tuple[str, List[dict]]) -> None:
+    # Arrange
+    url, received = notify_server
+    dispatcher = NotificationDispatcher(delay=0)
+
+    # Act
+    dispatcher.post(url.replace('/notify', '/flaky'), ('edit', 1), {'mod_id': '1', 'event_type': 'edit'})
+    for _ in range(100):
+        if received:
+            break
+        time.sleep(0.05)
+
+    # Assert
+    assert received == [{'mod_id': '1', 'event_type': 'edit'}], 'Worker thread should send it, retrying errors'
+
+
+def test_dispatcher_max_delay(notify_server: Tuple[str, List[dict]]) -> None:
+    # Arrange
+    url, received = notify_server
+    dispatcher = NotificationDispatcher(delay=3600, max_delay=0)
+
+    # Act
+    dispatcher.post(url, ('edit', 1), {'mod_id': '1', 'event_type': 'edit', 'n': '1'})
+    dispatcher.post(url, ('edit', 1), {'mod_id': '1', 'event_type': 'edit', 'n': '2'})
+    for _ in range(100):
+        if received:
+            break
+        time.sleep(0.05)
+
+    # Assert
+    assert received == [{'mod_id': '1', 'event_type': 'edit', 'n': '2'}], \
+        'Repeats should not hold back an event for longer than max_delay'
+
+
+def test_dispatcher_flush_deadline(notify_server: Tuple[str, List[dict]]) -> None:
+    # Arrange
+    url, received = notify_server
+    dispatcher = NotificationDispatcher(delay=3600)
+    dispatcher.post(url.replace('/notify', '/flaky'), ('edit', 1), {'mod_id': '1', 'event_type': 'edit'})
+    dispatcher.post(url, ('edit', 2), {'mod_id': '2', 'event_type': 'edit'})
+
+    # Act
+    dispatcher.flush()
+    dispatcher.post(url, ('edit', 3), {'mod_id': '3', 'event_type': 'edit'})
+    dispatcher.flush(timeout=0)
+
+    # Assert
+    assert received == [{'mod_id': '2', 'event_type': 'edit'}], \
+        'Shutting down should not retry errors, nor take longer than the timeout'
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytest
+import redis
+from flask.testing import FlaskClient
+from flask import Response
+
+from .fixtures.client import client
+from .fixtures.fake_redis import FakeRedis, fake_redis
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion, DownloadEvent
+from KerbalStuff.database import db
+from KerbalStuff.downloads import apply_downloads, flush_downloads, record_download, FLUSHING_KEY
+
+
+@pytest.mark.usefixtures("client")
+def test_apply_downloads(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    gv = GameVersion(friendly_version='1.12.2', game=game)
+    mod = Mod(
+        name='Test Mod',
+        short_description='A mod for testing',
+        description='A mod that we will use to test download counting',
+        user=User(
+            username='TestModAuthor',
+            description='Test author of a test mod',
+            email='webmaster@spacedock.info',
+            public=True,
+        ),
+        license='MIT',
+        game=game,
+        ckan=False,
+        published=True,
+    )
+    old_version = ModVersion(mod=mod, friendly_version='0.9', gameversion=gv,
+                             download_path='/tmp/old.zip', created=datetime.now())
+    mod.default_version = ModVersion(mod=mod, friendly_version='1.0', gameversion=gv,
+                                     download_path='/tmp/new.zip', created=datetime.now())
+    db.add(game)
+    db.add(mod)
+    db.flush()
+    # Too old to be added to
+    db.add(DownloadEvent(mod=mod, version=old_version, downloads=5,
+                         created=datetime.now() - timedelta(hours=2)))
+    db.commit()
+
+    # Act
+    apply_downloads({(mod.id, mod.default_version.id): 3, (mod.id, old_version.id): 1})
+    apply_downloads({(mod.id, mod.default_version.id): 2})
+    db.commit()
+    db.expire_all()
+
+    # Assert
+    assert mod.download_count == 6, 'Mod download count should include all versions'
+    assert mod.default_version.download_count == 5, 'Version download count should be incremented'
+    assert old_version.download_count == 1, 'Version download count should be incremented'
+    events = sorted((e.version_id, e.downloads) for e in DownloadEvent.query.all())
+    assert events == sorted([(old_version.id, 1), (old_version.id, 5), (mod.default_version.id, 5)]), \
+        'Downloads should be aggregated into hourly events'
+    assert mod.score > 0, 'Mod should be rescored'
+
+
+@pytest.mark.usefixtures("client")
+def test_flush_downloads(client: 'FlaskClient[Response]', fake_redis: FakeRedis) -> None:
+    # Arrange
+    game = Game(name='Kerbal Space Program', publisher=Publisher(name='SQUAD'),
+                short='kerbal-space-program', active=True)
+    mod = Mod(name='Test Mod', short_description='A mod for testing', description='A mod for testing',
+              user=User(username='TestModAuthor', email='webmaster@spacedock.info', public=True),
+              license='MIT', game=game, ckan=False, published=True)
+    mod.default_version = ModVersion(mod=mod, friendly_version='1.0',
+                                     gameversion=GameVersion(friendly_version='1.12.2', game=game),
+                                     download_path='/tmp/new.zip', created=datetime.now())
+    db.add(mod)
+    db.commit()
+    record_download(mod.id, mod.default_version.id)
+    record_download(mod.id, mod.default_version.id)
+    # Deleted before the flush
+    record_download(mod.id, mod.default_version.id + 1)
+    record_download(mod.id + 1, mod.default_version.id + 2)
+
+    # Act
+    delete = fake_redis.delete
+
+    def failing_delete(*keys: str) -> int:
+        fake_redis.delete = delete  # type: ignore[assignment]
+        raise redis.ConnectionError('Connection lost')
+    fake_redis.delete = failing_delete  # type: ignore[assignment]
+    with pytest.raises(redis.ConnectionError):
+        flush_downloads()
+    flush_downloads()
+    db.expire_all()
+
+    # Assert
+    assert mod.download_count == 2, 'Downloads should be counted once, even when the flush is retried'
+    assert not fake_redis.exists(FLUSHING_KEY), 'Flushed downloads should be removed from Redis'
+    assert [(e.version_id, e.downloads) for e in DownloadEvent.query.all()] == [(mod.default_version.id, 2)], \
+        'Downloads of deleted versions should be dropped'
@@ -0,0 +1,104 @@
+from datetime import datetime
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from flask_api import status
+
+from .fixtures.client import client
+from .fixtures.fake_redis import FakeRedis, fake_redis
+from KerbalStuff.cache import game_fragment_key
+from KerbalStuff.changes import log_mod_change
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion, Featured
+from KerbalStuff.database import db
+
+
+@pytest.mark.usefixtures("client")
+def test_game_page(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    for name, published in [('Published Mod', True), ('Hidden Mod', False)]:
+        mod = Mod(
+            name=name,
+            short_description='A mod for testing',
+            description='A mod that we will use to test the game page',
+            user=user,
+            license='MIT',
+            game=game,
+            ckan=False,
+            published=published,
+        )
+        mod.default_version = ModVersion(
+            mod=mod,
+            friendly_version='1.0',
+            gameversion=GameVersion(friendly_version='1.2.3', game=game),
+            download_path='/tmp/blah.zip',
+            created=datetime.now(),
+        )
+        db.add(mod)
+        if published:
+            db.add(Featured(mod=mod))
+    db.commit()
+
+    # Act
+    resp = client.get('/kerbal-space-program')
+
+    # Assert
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    html = resp.data.decode('utf-8')
+    assert html.count('<h2 class="group inner list-group-item-heading">\n                        Published Mod') == 2 * 3, \
+        'Published mod should be featured, new and top, but not updated'
+    assert 'Hidden Mod' not in html, 'Unpublished mod should not be shown'
+
+
+@pytest.mark.usefixtures("client")
+def test_game_page_cache(client: 'FlaskClient[Response]', fake_redis: FakeRedis) -> None:
+    # Arrange
+    game = Game(name='Kerbal Space Program', publisher=Publisher(name='SQUAD'),
+                short='kerbal-space-program', active=True)
+    user = User(username='TestModAuthor', email='webmaster@spacedock.info', public=True)
+    mod = Mod(name='Cached Mod', short_description='A mod for testing',
+              description='A mod that we will use to test the game page cache', user=user,
+              license='MIT', game=game, ckan=False, published=True)
+    mod.default_version = ModVersion(mod=mod, friendly_version='1.0',
+                                     gameversion=GameVersion(friendly_version='1.2.3', game=game),
+                                     download_path='/tmp/blah.zip', created=datetime.now())
+    db.add(mod)
+    db.commit()
+    new_key = 'fragment:' + game_fragment_key(game.id, 'new')
+
+    # Act
+    first_html = client.get('/kerbal-space-program').data.decode('utf-8')
+    cached = fake_redis.data.get(new_key)
+    # Another process renamed the mod, the cached sections still show the old name
+    db.query(Mod).filter(Mod.id == mod.id).update({'name': 'Renamed Mod'})
+    db.commit()
+    second_html = client.get('/kerbal-space-program').data.decode('utf-8')
+    mod.name = 'Edited Mod'
+    log_mod_change(mod, 'update')
+    cached_before_commit = fake_redis.data.get(new_key)
+    db.commit()
+    cached_after_commit = fake_redis.data.get(new_key)
+    third_html = client.get('/kerbal-space-program').data.decode('utf-8')
+
+    # Assert
+    assert cached is not None and 'Cached Mod' in cached, 'Sections should be cached for anonymous users'
+    assert 'Cached Mod' in first_html, 'Mod should be shown'
+    assert 'Renamed Mod' not in second_html and 'Cached Mod' in second_html, \
+        'Second render should come from the cache'
+    assert cached_before_commit == cached, 'Cache should be kept until the change is committed'
+    assert cached_after_commit is None, 'Cache should be invalidated when the change is committed'
+    assert 'Edited Mod' in third_html, 'Edited mod should be shown after invalidating'
@@ -0,0 +1,80 @@
+import json
+import socket
+import subprocess
+import sys
+from pathlib import Path
+from typing import Generator
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from flask_api import status
+from werkzeug.test import Client
+
+from .fixtures.client import client
+from KerbalStuff import metrics
+from KerbalStuff.app import app
+from KerbalStuff.config import config, env
+from KerbalStuff.middleware.metrics import MetricsMiddleware
+
+
+@pytest.fixture
+def metrics_dir(tmp_path: Path) -> Generator[Path, None, None]:
+    config[env]['metrics-dir'] = str(tmp_path)
+    try:
+        yield tmp_path
+    finally:
+        del config[env]['metrics-dir']
+
+
+@pytest.mark.usefixtures("client")
+def test_request_metrics(client: 'FlaskClient[Response]', metrics_dir: Path) -> None:
+    # Arrange
+    measured = Client(MetricsMiddleware(app.wsgi_app), Response)
+    # A worker process on another host
+    (metrics_dir / 'process-other-1-f00d.json').write_text(json.dumps({
+        'counters': [['spacedock_http_responses_total', {'endpoint': 'api.browse', 'status': '200'}, 2]],
+        'histograms': [],
+        'host': 'other',
+        'pid': 1,
+    }))
+    # A worker process on this host that ended without cleaning up
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    dead_pid = dead.pid
+    (metrics_dir / f'process-{socket.gethostname()}-{dead_pid}-cafe.json').write_text(json.dumps({
+        'counters': [['spacedock_http_responses_total', {'endpoint': 'api.browse', 'status': '200'}, 3]],
+        'histograms': [],
+        'host': socket.gethostname(),
+        'pid': dead_pid,
+    }))
+
+    # Act
+    resp = measured.get('/api/browse', buffered=True)
+    measured.get('/api/browse', buffered=True)
+    measured.get('/does/not/exist', buffered=True)
+    metrics.count('spacedock_downloads_total')
+    exported = metrics.collect().splitlines()
+    process_files = sorted(p.name for p in metrics_dir.glob('process-*.json'))
+    metrics.mark_process_dead()
+    left_file = (metrics_dir / metrics._file_name).exists()
+    exported_after_exit = metrics.collect().splitlines()
+
+    # Assert
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    assert process_files == sorted(['process-other-1-f00d.json', metrics._file_name]), \
+        'Metrics should be written per process, dead ones should be moved'
+    assert 'spacedock_http_responses_total{endpoint="api.browse",status="200"} 7' in exported, \
+        'Responses of all processes should be counted per endpoint and status'
+    assert exported_after_exit == exported, 'Metrics of ended processes should still be counted'
+    assert not left_file, 'Ended processes should not leave their file'
+    assert 'spacedock_http_responses_total{endpoint="none",status="404"} 1' in exported, \
+        'Unknown routes should be counted'
+    assert f'spacedock_http_response_bytes_total{{endpoint="api.browse"}} {2 * len(resp.data)}' in exported, \
+        'Response sizes should be counted'
+    assert 'spacedock_http_request_duration_seconds_count{endpoint="api.browse"} 2' in exported, \
+        'Latencies should be recorded'
+    assert 'spacedock_http_request_duration_seconds_bucket{endpoint="api.browse",le="+Inf"} 2' in exported, \
+        'Latency buckets should be cumulative'
+    assert 'spacedock_downloads_total 1' in exported, 'Hot paths should be counted'
+    assert '# TYPE spacedock_http_request_duration_seconds histogram' in exported, 'Types should be declared'
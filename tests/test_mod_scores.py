@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+
+from .fixtures.client import client
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion, Media
+from KerbalStuff.database import db
+from KerbalStuff.search import get_mod_score, update_mod_scores
+
+
+@pytest.mark.usefixtures("client")
+def test_update_mod_scores_matches_get_mod_score(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    game_versions = [GameVersion(friendly_version=v, game=game)
+                     for v in ['1.8.1', '1.9.1', '1.10.0', '1.12.2', 'not a version']]
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    now = datetime.now()
+    mods = list()
+    for i, gv in enumerate(game_versions):
+        mod = Mod(
+            name=f'Test Mod {i}',
+            short_description='A mod for testing',
+            description='Long description ' * (i * 5),
+            user=user,
+            license='MIT',
+            game=game,
+            ckan=False,
+            published=True,
+            follower_count=i * 3,
+            download_count=i * 1000 + 7,
+            source_link='https://github.com/KSP-SpaceDock/SpaceDock' if i % 2 else None,
+            created=now - timedelta(days=400 * i + 3),
+            updated=now - timedelta(days=60 * i + 1),
+        )
+        for j in range(i * 3):
+            ModVersion(mod=mod, friendly_version=f'0.{j}', gameversion=gv,
+                       download_path=f'/tmp/{i}-{j}.zip', created=now)
+        mod.default_version = ModVersion(mod=mod, friendly_version='1.0', gameversion=gv,
+                                         download_path=f'/tmp/{i}.zip', created=now)
+        for j in range(i):
+            Media(mod=mod, hash=f'{i}-{j}', type='image', data='')
+        mods.append(mod)
+    mods.append(Mod(name='Unreleased Mod', description='', user=user, license='MIT',
+                    game=game, ckan=False, published=False, score=42))
+    db.add(game)
+    db.add_all(mods)
+    db.commit()
+    expected = {mod.id: get_mod_score(mod) for mod in mods}
+
+    # Act
+    changed = update_mod_scores()
+    db.commit()
+    db.expire_all()
+
+    # Assert
+    actual = {mod.id: mod.score for mod in Mod.query.all()}
+    assert actual == expected, 'Bulk scores should match get_mod_score'
+    assert changed == len(mods), 'Every score should have been written'
+    assert update_mod_scores() == 0, 'Nothing should change on a second run'
+    assert update_mod_scores([]) == 0, 'No mods should be scored for an empty id list'
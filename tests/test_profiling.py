@@ -0,0 +1,145 @@
+import datetime
+import fcntl
+import json
+import time
+import tracemalloc
+from pathlib import Path
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from flask_api import status
+from werkzeug.test import Client
+
+from .fixtures.client import client
+from KerbalStuff.app import app, request_route
+from KerbalStuff.config import config, env
+from KerbalStuff.middleware.profiler import ConditionalProfilerMiddleware
+from KerbalStuff.profiling import PRUNE_LOCK_NAME, index_profile, prune, prune_if_due, search_profiles
+
+
+@pytest.mark.usefixtures("client")
+def test_server_timing(client: 'FlaskClient[Response]') -> None:
+    # Act
+    resp = client.get('/api/browse')
+
+    # Assert
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    assert resp.headers['Server-Timing'].startswith('db;dur='), 'Database time should be reported'
+    assert 'desc="2 queries"' in resp.headers['Server-Timing'], 'Queries should be counted'
+
+
+@pytest.mark.usefixtures("client")
+def test_profile_query_stats(client: 'FlaskClient[Response]', tmp_path: Path) -> None:
+    # Arrange
+    profiled = Client(ConditionalProfilerMiddleware(app.wsgi_app, stream=None, profile_dir=str(tmp_path),
+                                                    sampling_function=lambda environ: True),
+                      Response)
+
+    # Act
+    resp = profiled.get('/api/browse')
+
+    # Assert
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    profiles = list(tmp_path.glob('*.prof'))
+    assert len(profiles) == 1, 'Request should be profiled'
+    query_stats = json.loads(Path(str(profiles[0]) + '.json').read_text())
+    assert query_stats['route'] == 'GET /api/browse', 'Route should be recorded'
+    assert query_stats['queries'] == len(query_stats['slowest']) == 2, 'Queries should be counted'
+    assert 'FROM mod' in query_stats['slowest'][0]['statement'], 'Slowest statements should be recorded'
+    assert search_profiles(str(tmp_path), 'browse', 0, 10)[0] == 1, 'Profile should be indexed'
+
+
+@pytest.mark.usefixtures("client")
+def test_unprofiled_response_streams(client: 'FlaskClient[Response]', tmp_path: Path) -> None:
+    # Arrange
+    size = 64 * 1024 * 1024
+    with open(tmp_path / 'big.zip', 'wb') as f:
+        f.truncate(size)
+    config[env]['storage'] = str(tmp_path)
+    unprofiled = Client(ConditionalProfilerMiddleware(app.wsgi_app, stream=None, profile_dir=str(tmp_path),
+                                                      sampling_function=lambda environ: False),
+                        Response)
+
+    # Act
+    tracemalloc.start()
+    try:
+        resp = unprofiled.get('/content/big.zip', buffered=False)
+        received = 0
+        for chunk in resp.response:
+            received += len(chunk)
+        resp.close()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        del config[env]['storage']
+
+    # Assert
+    assert resp.status_code == status.HTTP_200_OK, 'Request should succeed'
+    assert received == size, 'The whole file should be sent'
+    assert peak < size / 16, 'The file should be streamed rather than loaded into memory'
+
+
+def test_profile_index(tmp_path: Path) -> None:
+    # Arrange
+    now = time.time()
+    today = datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc).date()
+    old = now - 30 * 24 * 60 * 60
+    (tmp_path / f'GET.mod.5ms.{old:.0f}.prof').touch()
+    (tmp_path / f'GET.mod.5ms.{old:.0f}.prof.json').touch()
+    (tmp_path / f'GET.api.browse.120ms.{now:.0f}.prof').touch()
+    (tmp_path / f'GET.root.30ms.{now + 1:.0f}.prof').touch()
+    # Not from the middleware
+    (tmp_path / 'notes.prof').touch()
+
+    # Act
+    index_profile(str(tmp_path), f'GET.root.30ms.{now + 1:.0f}.prof')
+    pruned = prune(str(tmp_path))
+
+    # Assert
+    assert [name for name, _, _, _ in search_profiles(str(tmp_path), None, 0, 10)[1]] == \
+        [f'GET.root.30ms.{now + 1:.0f}.prof', f'GET.api.browse.120ms.{now:.0f}.prof'], \
+        'Profiles written before the index should be found, newest first, and old ones pruned'
+    assert pruned == 1, 'Old profiles should be pruned'
+    assert not (tmp_path / f'GET.mod.5ms.{old:.0f}.prof.json').exists(), 'Pruned profiles should be deleted'
+    assert search_profiles(str(tmp_path), '>100', 0, 10)[0] == 1, 'Should filter by minimum duration'
+    assert search_profiles(str(tmp_path), '<100', 0, 10)[0] == 1, 'Should filter by maximum duration'
+    assert search_profiles(str(tmp_path), f'start:{today} end:{today}', 0, 10)[0] == 2, 'Should filter by date'
+    assert search_profiles(str(tmp_path), f'end:{today - datetime.timedelta(days=1)}', 0, 10)[0] == 0, \
+        'Should filter by date'
+    assert search_profiles(str(tmp_path), 'api !mod', 0, 10)[0] == 1, 'Should filter by route'
+    assert search_profiles(str(tmp_path), '<soon', 0, 10)[0] == 0, 'Malformed terms should match nothing'
+
+
+def test_request_route() -> None:
+    # Act
+    with app.test_request_context('/mod/1/Test'):
+        route = request_route()
+    with app.test_request_context('/no/such;page'):
+        unmatched_route = request_route()
+
+    # Assert
+    assert route == 'GET /mod/<int:mod_id>/<path:mod_name>', 'Requests should be grouped by route'
+    assert unmatched_route == 'GET none', 'Requests without a route should share one'
+
+
+def test_prune_if_due(tmp_path: Path) -> None:
+    # Arrange
+    old = time.time() - 30 * 24 * 60 * 60
+    (tmp_path / f'GET.mod.5ms.{old:.0f}.prof').touch()
+
+    # Act
+    with open(tmp_path / PRUNE_LOCK_NAME, 'a') as f:
+        # Another process is pruning
+        fcntl.flock(f, fcntl.LOCK_EX)
+        locked = prune_if_due(str(tmp_path))
+    first = prune_if_due(str(tmp_path))
+    (tmp_path / f'GET.mod.6ms.{old:.0f}.prof').touch()
+    second = prune_if_due(str(tmp_path))
+
+    # Assert
+    assert not locked, 'Only one process should prune at a time'
+    assert first, 'Profile directory should be pruned when it never was'
+    assert not second, 'Profile directory should be pruned once per interval'
+    assert [p.name for p in tmp_path.glob('*.prof')] == [f'GET.mod.6ms.{old:.0f}.prof'], \
+        'Old profiles should be deleted when pruning'
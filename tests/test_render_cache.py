@@ -0,0 +1,30 @@
+from typing import List
+
+from markupsafe import Markup
+
+from KerbalStuff.cache import RenderCache
+
+
+def test_render_cache() -> None:
+    # Arrange
+    calls: List[str] = list()
+
+    def render(text: str) -> str:
+        calls.append(text)
+        return f'<p>{text}</p>'
+
+    cache = RenderCache('test', render, 'v1', max_chars=30)
+
+    # Act
+    first = cache('hello')
+    second = cache('hello')
+    cache('a different text')
+    cache('hello')
+    empty = cache('')
+
+    # Assert
+    assert first == Markup('<p>hello</p>'), 'Should return the rendered text'
+    assert isinstance(second, Markup), 'Should return markup'
+    assert calls == ['hello', 'a different text', 'hello', ''], \
+        'Should only render again after being evicted'
+    assert empty == Markup('<p></p>'), 'Should render empty text'
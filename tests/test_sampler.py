@@ -0,0 +1,71 @@
+import time
+from collections import Counter
+from pathlib import Path
+
+from KerbalStuff.sampler import StackSampler, FOLDED_SUFFIX, DAY, load_folded, merge_days, render_svg, sample_files
+
+
+def busy_work(seconds: float) -> int:
+    end = time.monotonic() + seconds
+    n = 0
+    while time.monotonic() < end:
+        n += 1
+    return n
+
+
+def test_sampler_folds_stacks_per_route(tmp_path: Path) -> None:
+    # Arrange
+    sampler = StackSampler(str(tmp_path), interval=0.005, window=3600)
+
+    # Act
+    sampler.start('GET /busy')
+    busy_work(0.2)
+    sampler.stop()
+    busy_work(0.05)
+    sampler.flush()
+
+    # Assert
+    files = list(tmp_path.glob('*' + FOLDED_SUFFIX))
+    assert len(files) == 1, 'Samples should be written to one file per window'
+    routes = load_folded(files)
+    assert list(routes) == ['GET /busy'], 'Only threads handling a request should be sampled'
+    stacks = routes['GET /busy']
+    assert sum(stacks.values()) > 10, 'The request should be sampled regularly'
+    assert all('busy_work (tests/test_sampler.py:' in stack.split(';')[-1] for stack in stacks), \
+        'Stacks should end in the function that was running'
+
+
+def test_render_svg() -> None:
+    # Act
+    svg = render_svg(Counter({'main (a.py:1);busy_work (b.py:2)': 3, 'main (a.py:1);<listcomp> (b.py:9)': 1}),
+                     'GET /busy')
+
+    # Assert
+    assert svg.startswith('<svg'), 'A flame graph should be drawn'
+    assert '<title>busy_work (b.py:2) (3 samples, 75.00%)</title>' in svg, 'Frames should be sized by samples'
+    assert '&lt;listcomp&gt;' in svg, 'Frame names should be escaped'
+
+
+def test_merge_days(tmp_path: Path) -> None:
+    # Arrange
+    today = time.time() // DAY * DAY
+    (tmp_path / f'{today - 2 * DAY + 60:.0f}.1{FOLDED_SUFFIX}').write_text('GET /a;main (a.py:1) 2\n')
+    (tmp_path / f'{today - 2 * DAY + 900:.0f}.2{FOLDED_SUFFIX}').write_text('GET /a;main (a.py:1) 3\n')
+    (tmp_path / f'{today - DAY + 60:.0f}.1{FOLDED_SUFFIX}').write_text('GET /b;main (a.py:1) 1\n')
+    (tmp_path / f'{today + 60:.0f}.1{FOLDED_SUFFIX}').write_text('GET /a;main (a.py:1) 7\n')
+
+    # Act
+    merged = merge_days(str(tmp_path))
+    # A window that was still running
+    (tmp_path / f'{today - DAY + 900:.0f}.2{FOLDED_SUFFIX}').write_text('GET /b;main (a.py:1) 4\n')
+    merged_again = merge_days(str(tmp_path))
+
+    # Assert
+    assert merged == 2 and merged_again == 1, 'Days before today should be merged'
+    assert len(list(tmp_path.glob('*' + FOLDED_SUFFIX))) == 3, 'There should be one file per day'
+    assert load_folded(sample_files(str(tmp_path), 0)) == {'GET /a': Counter({'main (a.py:1)': 12}),
+                                                           'GET /b': Counter({'main (a.py:1)': 5})}, \
+        'Merging should keep all samples'
+    assert load_folded(sample_files(str(tmp_path), today - 1)) == {'GET /a': Counter({'main (a.py:1)': 7}),
+                                                                   'GET /b': Counter({'main (a.py:1)': 5})}, \
+        'Merged days should count as recent as their end'
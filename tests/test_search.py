@@ -0,0 +1,53 @@
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from packaging import version
+
+from .fixtures.client import client
+from KerbalStuff.objects import Publisher, Game, GameVersion
+from KerbalStuff.database import db
+from KerbalStuff.search import tsquery_text, sorted_game_versions, invalidate_game_versions
+
+
+def test_tsquery_text() -> None:
+    # Arrange
+    terms = ['Mech', 'delta-v', 'under_score', '!!', "it's"]
+
+    # Act
+    ts_query = tsquery_text(terms)
+
+    # Assert
+    assert ts_query == 'Mech:* & delta:* & v:* & under:* & score:* & it:* & s:*', \
+        'Every word should become a prefix match, without any tsquery syntax'
+    assert tsquery_text([]) == '', 'No terms should give an empty query'
+
+
+@pytest.mark.usefixtures("client")
+def test_sorted_game_versions(client: 'FlaskClient[Response]') -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    for friendly_version in ['1.10.1', '1.2.2', 'not a version', '1.9.0']:
+        db.add(GameVersion(friendly_version=friendly_version, game=game))
+    db.add(game)
+    db.commit()
+
+    # Act
+    before = sorted_game_versions(game.id)
+    db.add(GameVersion(friendly_version='1.12.0', game=game))
+    db.commit()
+    cached = sorted_game_versions(game.id)
+    invalidate_game_versions(game.id)
+    after = sorted_game_versions(game.id)
+
+    # Assert
+    assert before == [version.Version(v) for v in ['1.2.2', '1.9.0', '1.10.1']], \
+        'Versions should be parsed and sorted'
+    assert cached is before, 'Versions should be cached'
+    assert after[-1] == version.Version('1.12.0'), 'Invalidating should pick up new versions'
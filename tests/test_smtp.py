@@ -0,0 +1,134 @@
+import socket
+import socketserver
+import threading
+from datetime import datetime
+from typing import Generator, List
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+
+from .fixtures.client import client
+from KerbalStuff import smtp
+from KerbalStuff.app import app
+from KerbalStuff.celery import app as celery_app, send_mail, send_mail_batch
+from KerbalStuff.config import config, env
+from KerbalStuff.database import db
+from KerbalStuff.email import send_update_notification
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.connections = 0
+        self.messages: List[List[str]] = list()
+        self.handlers: List['FakeSMTPHandler'] = list()
+
+    def drop_connections(self) -> None:
+        for handler in self.handlers:
+            handler.request.shutdown(socket.SHUT_RDWR)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough of SMTP for smtplib, remembering the recipients of each message"""
+    server: FakeSMTPServer
+
+    def handle(self) -> None:
+        self.server.connections += 1
+        self.server.handlers.append(self)
+        recipients: List[str] = list()
+        self.wfile.write(b'220 localhost ready\r\n')
+        for line in self.rfile:
+            command = line.decode('ascii').strip().upper()
+            if command.startswith('RCPT'):
+                recipients.append(command)
+            if command.startswith('MAIL') and 'REFUSED' in command:
+                self.wfile.write(b'550 not you\r\n')
+                continue
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                self.server.messages.append(recipients)
+                recipients = list()
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            self.wfile.write(b'250 ok\r\n')
+
+
+@pytest.fixture
+def smtp_server() -> Generator[FakeSMTPServer, None, None]:
+    server = FakeSMTPServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    config[env]['smtp-host'] = '127.0.0.1'
+    config[env]['smtp-port'] = str(server.server_address[1])
+    config[env]['support-mail'] = 'support@example.com'
+    try:
+        yield server
+    finally:
+        smtp.close()
+        del config[env]['smtp-host']
+        del config[env]['smtp-port']
+        del config[env]['support-mail']
+        server.shutdown()
+        server.server_close()
+
+
+def test_send_mail_batch(smtp_server: FakeSMTPServer) -> None:
+    # Arrange
+    many = [f'follower{i}@example.com' for i in range(150)]
+    mails = [{'sender': 'support@example.com', 'recipients': many, 'subject': 'Update', 'message': 'Hi'},
+             {'sender': 'support@example.com', 'recipients': ['a@example.com'], 'subject': 'Hi', 'message': 'Hi'},
+             {'sender': 'refused@example.com', 'recipients': ['x@example.com'], 'subject': 'Hi', 'message': 'Hi'},
+             {'sender': 'support@example.com', 'recipients': ['b@example.com'], 'subject': 'Hi', 'message': 'Hi',
+              'important': True}]
+
+    # Act
+    send_mail_batch(mails)
+    send_mail('support@example.com', ['c@example.com'], 'Hi', 'Hi')
+    connections_before_drop = smtp_server.connections
+    smtp_server.drop_connections()
+    send_mail('support@example.com', ['d@example.com'], 'Hi', 'Hi')
+
+    # Assert
+    assert [len(m) for m in smtp_server.messages] == [100, 50, 1, 1, 1, 1], \
+        'Every mail should be sent, 100 recipients at a time, except the refused one'
+    assert connections_before_drop == 1, 'Mails should share one connection'
+    assert smtp_server.connections == 2, 'A dropped connection should be reopened'
+
+
+@pytest.mark.usefixtures("client")
+def test_update_notification_batches(client: 'FlaskClient[Response]', smtp_server: FakeSMTPServer) -> None:
+    # Arrange
+    game = Game(name='Kerbal Space Program', publisher=Publisher(name='SQUAD'),
+                short='kerbal-space-program', active=True)
+    author = User(username='TestModAuthor', email='webmaster@spacedock.info', public=True)
+    mod = Mod(name='Test Mod', short_description='A mod for testing',
+              description='A mod for testing', license='MIT', game=game, ckan=False, user=author)
+    version = ModVersion(mod=mod, friendly_version='1.0', changelog='Fixed things',
+                         gameversion=GameVersion(friendly_version='1.2.3', game=game),
+                         download_path='/tmp/blah.zip', created=datetime.now())
+    mod.followers = [User(username=f'follower{i}', email=f'follower{i}@example.com')
+                     for i in range(250)]
+    db.add(mod)
+    db.commit()
+    celery_app.conf.task_always_eager = True
+
+    # Act
+    try:
+        with app.test_request_context():
+            send_update_notification(mod, version, author)
+    finally:
+        celery_app.conf.task_always_eager = False
+
+    # Assert
+    assert [len(m) for m in smtp_server.messages] == [100, 100, 50], \
+        'Followers should be mailed in separate batches'
+    assert smtp_server.connections == 1, 'The batches should share one connection'
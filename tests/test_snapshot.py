@@ -0,0 +1,93 @@
+import gzip
+import json
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+from flask_api import status
+
+from .fixtures.client import client
+from KerbalStuff.app import app
+from KerbalStuff.celery import export_catalog_snapshot
+from KerbalStuff.config import config, env
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion
+from KerbalStuff.database import db
+from KerbalStuff.snapshot import write_snapshot, SNAPSHOT_PATH
+
+
+@pytest.mark.usefixtures("client")
+def test_snapshot(client: 'FlaskClient[Response]', tmp_path: Path) -> None:
+    # Arrange
+    game = Game(
+        name='Kerbal Space Program',
+        publisher=Publisher(
+            name='SQUAD',
+        ),
+        short='kerbal-space-program',
+        active=True,
+    )
+    user = User(
+        username='TestModAuthor',
+        description='Test author of a test mod',
+        email='webmaster@spacedock.info',
+        public=True,
+    )
+    for name, published in [('First Mod', True), ('Hidden Mod', False), ('Second Mod', True)]:
+        mod = Mod(
+            name=name,
+            short_description='A mod for testing',
+            description='A mod that we will use to test the snapshot',
+            user=user,
+            license='MIT',
+            game=game,
+            ckan=False,
+            published=published,
+        )
+        mod.default_version = ModVersion(
+            mod=mod,
+            friendly_version='1.0',
+            gameversion=GameVersion(friendly_version='1.12.2', game=game),
+            download_path='/tmp/blah.zip',
+            created=datetime.now(),
+        )
+        db.add(mod)
+    db.commit()
+    config[env]['storage'] = str(tmp_path)
+
+    # Act
+    try:
+        with app.test_request_context():
+            path = write_snapshot(str(tmp_path))
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f]
+        api_resp = client.get('/api/browse?order=asc')
+        content_resp = client.get('/content/' + SNAPSHOT_PATH)
+        cached_resp = client.get('/content/' + SNAPSHOT_PATH,
+                                 headers={'If-None-Match': content_resp.headers['ETag']})
+    finally:
+        del config[env]['storage']
+
+    # Assert
+    assert [m['name'] for m in lines] == ['First Mod', 'Second Mod'], \
+        'Snapshot should contain the published mods'
+    assert lines == api_resp.json['result'], 'Snapshot should match the API format'
+    assert content_resp.status_code == status.HTTP_200_OK, 'Snapshot should be served'
+    assert 'Last-Modified' in content_resp.headers, 'Snapshot should have a modification time'
+    assert cached_resp.status_code == status.HTTP_304_NOT_MODIFIED, 'ETag should be honored'
+
+
+def test_snapshot_without_storage(tmp_path: Path) -> None:
+    # Arrange
+    storage = tmp_path / 'storage'
+    config[env]['storage'] = str(storage)
+
+    # Act
+    try:
+        export_catalog_snapshot()
+    finally:
+        del config[env]['storage']
+
+    # Assert
+    assert not storage.exists(), 'Snapshot should not be written if storage is missing'
@@ -0,0 +1,122 @@
+from pathlib import Path
+from typing import Generator
+
+import pytest
+from PIL import Image
+
+from KerbalStuff import thumbnail
+from KerbalStuff.celery import app as celery_app, create_thumbnails
+from KerbalStuff.config import config, env
+
+
+@pytest.fixture
+def storage(tmp_path: Path) -> Generator[Path, None, None]:
+    config[env]['storage'] = str(tmp_path)
+    celery_app.conf.task_always_eager = True
+    try:
+        yield tmp_path
+    finally:
+        celery_app.conf.task_always_eager = False
+        del config[env]['storage']
+        thumbnail._queued.clear()
+        thumbnail._ready.clear()
+        thumbnail._missing.clear()
+
+
+def test_thumbnails(storage: Path) -> None:
+    # Arrange
+    (storage / 'TestModAuthor_1' / 'Test_Mod').mkdir(parents=True)
+    Image.new('RGB', (1920, 1080), (7, 172, 210)).save(storage / 'TestModAuthor_1' / 'Test_Mod' / 'bg.jpg')
+    background_url = '/content/TestModAuthor_1/Test_Mod/bg.jpg'
+
+    # Act
+    first_url = thumbnail.get_or_queue(background_url)
+    second_url = thumbnail.get_or_queue(background_url)
+    image_set = thumbnail.image_set(background_url)
+    (storage / 'TestModAuthor_1' / 'Test_Mod' / 'thumb_bg.jpg').rename(storage / 'thumb_bg.jpg')
+    cached_url = thumbnail.get_or_queue(background_url)
+    (storage / 'thumb_bg.jpg').rename(storage / 'TestModAuthor_1' / 'Test_Mod' / 'thumb_bg.jpg')
+
+    # Assert
+    assert first_url == thumbnail.PLACEHOLDER_URL, 'Placeholder should be shown until the thumbnail exists'
+    assert second_url == '/content/TestModAuthor_1/Test_Mod/thumb_bg.jpg', 'Thumbnail should be shown once created'
+    assert cached_url == second_url, 'Existing thumbnails should be remembered without looking at the disk'
+    sizes = {p.name: Image.open(p).size for p in (storage / 'TestModAuthor_1' / 'Test_Mod').glob('thumb_*')}
+    assert sizes == {
+        'thumb_bg.jpg': (320, 195),
+        'thumb_bg.webp': (320, 195),
+        'thumb_bg@2x.jpg': (640, 390),
+        'thumb_bg@2x.webp': (640, 390),
+    }, 'All sizes and formats should be created'
+    assert "url('/content/TestModAuthor_1/Test_Mod/thumb_bg@2x.webp') type('image/webp') 2x" in image_set, \
+        'The image set should offer the WebP thumbnails'
+
+
+def test_thumbnails_before_webp(storage: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Arrange
+    Image.new('RGB', (800, 600)).save(storage / 'bg.png')
+    Image.new('RGB', (320, 195)).save(storage / 'thumb_bg.jpg')
+    background_url = '/content/bg.png'
+    queued = list()
+    monkeypatch.setattr(create_thumbnails, 'delay', queued.append)
+
+    # Act
+    url = thumbnail.get_or_queue(background_url)
+    image_set = thumbnail.image_set(background_url)
+
+    # Assert
+    assert url == '/content/thumb_bg.jpg', 'The old thumbnail should be shown until the new ones exist'
+    assert image_set == '', 'The image set should not offer thumbnails that do not exist'
+    assert queued == [background_url], 'The missing thumbnails should be created'
+
+
+def test_thumbnails_need_update(storage: Path) -> None:
+    # Arrange
+    background = storage / 'bg.png'
+    Image.new('RGBA', (800, 600)).save(background)
+    background_url = '/content/bg.png'
+
+    # Act
+    before = thumbnail.needs_update(background_url)
+    thumbnail.create(background_url)
+    after = thumbnail.needs_update(background_url)
+    forced = thumbnail.needs_update(background_url, force=True)
+    config[env]['thumbnail_size'] = '160x100'
+    resized = thumbnail.needs_update(background_url)
+    del config[env]['thumbnail_size']
+    missing = thumbnail.needs_update('/content/gone.png', force=True)
+
+    # Assert
+    assert before, 'Missing thumbnails should be created'
+    assert not after, 'Fresh thumbnails should be up to date'
+    assert forced, 'Forcing should regenerate up to date thumbnails'
+    assert resized, 'Changing the size should regenerate thumbnails'
+    assert not missing, 'Missing backgrounds should be skipped'
+
+
+def test_thumbnails_queue_again(storage: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # Arrange
+    Image.new('RGB', (800, 600)).save(storage / 'bg.png')
+    background_url = '/content/bg.png'
+    queued = list()
+
+    def broken_delay(url: str) -> None:
+        raise ConnectionError('Broker is down')
+    monkeypatch.setattr(create_thumbnails, 'delay', broken_delay)
+
+    # Act
+    broken_url = thumbnail.get_or_queue(background_url)
+    monkeypatch.setattr(create_thumbnails, 'delay', queued.append)
+    # The worker loses the task
+    thumbnail._missing.clear()
+    first_url = thumbnail.get_or_queue(background_url)
+    thumbnail._missing.clear()
+    thumbnail.get_or_queue(background_url)
+    thumbnail._missing.clear()
+    thumbnail._queued[background_url] -= thumbnail.THUMBNAIL_REQUEUE
+    thumbnail.get_or_queue(background_url)
+
+    # Assert
+    assert broken_url == background_url, 'The background should be shown if its thumbnails cannot be queued'
+    assert first_url == thumbnail.PLACEHOLDER_URL, 'Placeholder should be shown while the thumbnails are queued'
+    assert queued == [background_url, background_url], 'Thumbnails should be queued again after a while'
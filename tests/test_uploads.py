@@ -0,0 +1,130 @@
+import hashlib
+import io
+import os
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import pytest
+from flask.testing import FlaskClient
+from flask import Response
+
+from .fixtures.client import client
+from KerbalStuff.app import app
+from KerbalStuff.blueprints.api import _receive_zipball
+from KerbalStuff.database import db
+from KerbalStuff.objects import Publisher, Game, GameVersion, User, Mod, ModVersion
+from KerbalStuff.uploads import ABANDONED_PART_AGE, FileInfo, file_info, backfill_version_files
+
+
+def _zip_bytes() -> bytes:
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        for i in range(20):
+            z.writestr(f'GameData/TestMod/file{i}.cfg', f'PART {{ name = test{i} }}\n' * 100)
+    return buf.getvalue()
+
+
+def _send_chunk(full_path: str, data: bytes, index: int, count: int, offset: int,
+                upload_id: str = 'f00d-cafe') -> Optional[FileInfo]:
+    form = {'zipball': (io.BytesIO(data), 'TestMod.zip'),
+            'dzchunkindex': str(index),
+            'dztotalchunkcount': str(count),
+            'dzchunkbyteoffset': str(offset)}
+    if upload_id:
+        form['dzuuid'] = upload_id
+    with app.test_request_context(method='POST', data=form):
+        return _receive_zipball(full_path)
+
+
+def test_receive_zipball_out_of_order(tmp_path: Path) -> None:
+    # Arrange
+    data = _zip_bytes()
+    chunk_size = len(data) // 3 + 1
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    full_path = str(tmp_path / 'TestMod-1.0.zip')
+
+    # Act
+    results = [_send_chunk(full_path, chunks[i], i, len(chunks), i * chunk_size)
+               for i in [2, 0, 1]]
+
+    # Assert
+    assert results[:2] == [None, None], 'Upload should not be finished before all chunks arrived'
+    assert results[2] == FileInfo(len(data), hashlib.sha256(data).hexdigest()), \
+        'Size and hash of the whole file should be returned'
+    assert Path(full_path).read_bytes() == data, 'Chunks should be assembled by offset'
+    assert [p.name for p in tmp_path.iterdir()] == ['TestMod-1.0.zip'], 'Part files should be cleaned up'
+    assert file_info(full_path) == results[2], 'file_info should agree'
+
+
+def test_receive_zipball_single(tmp_path: Path) -> None:
+    # Arrange
+    data = _zip_bytes()
+    full_path = str(tmp_path / 'TestMod-1.0.zip')
+
+    # Act
+    with app.test_request_context(method='POST', data={'zipball': (io.BytesIO(data), 'TestMod.zip')}):
+        result = _receive_zipball(full_path)
+
+    # Assert
+    assert result == FileInfo(len(data), hashlib.sha256(data).hexdigest()), \
+        'Size and hash should be computed while writing'
+    assert Path(full_path).read_bytes() == data, 'File should be written'
+
+
+def test_receive_zipball_stale_parts(tmp_path: Path) -> None:
+    # Arrange
+    data = _zip_bytes()
+    chunk_size = len(data) // 2 + 1
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    full_path = str(tmp_path / 'TestMod-1.0.zip')
+    # Left behind by an aborted upload without an upload id
+    (tmp_path / 'TestMod-1.0.zip.part').write_bytes(b'x' * 2 * len(data))
+    abandoned = tmp_path / 'TestMod-0.9.zip.0ld-upload.part'
+    abandoned.write_bytes(b'x')
+    (tmp_path / 'TestMod-0.9.zip.0ld-upload.part.chunks').mkdir()
+    for path in tmp_path.iterdir():
+        os.utime(path, (time.time() - ABANDONED_PART_AGE - 1,) * 2)
+
+    # Act
+    results = [_send_chunk(full_path, chunks[i], i, len(chunks), i * chunk_size, upload_id='')
+               for i in range(len(chunks))]
+
+    # Assert
+    assert results[-1] == FileInfo(len(data), hashlib.sha256(data).hexdigest()), \
+        'The new upload should not keep the tail of the old part file'
+    assert Path(full_path).read_bytes() == data, 'File should be written'
+    assert [p.name for p in tmp_path.iterdir()] == ['TestMod-1.0.zip'], 'Abandoned part files should be removed'
+
+
+@pytest.mark.usefixtures("client")
+def test_backfill_version_files(client: 'FlaskClient[Response]', tmp_path: Path) -> None:
+    # Arrange
+    data = _zip_bytes()
+    game = Game(name='Kerbal Space Program', publisher=Publisher(name='SQUAD'),
+                short='kerbal-space-program', active=True)
+    game_version = GameVersion(friendly_version='1.2.3', game=game)
+    mod = Mod(name='Test Mod', short_description='A mod for testing',
+              description='A mod for testing', license='MIT', game=game, ckan=False,
+              user=User(username='TestModAuthor', email='webmaster@spacedock.info', public=True))
+    for name in ['1.0', '1.1', '1.2']:
+        mod.versions.append(ModVersion(friendly_version=name, gameversion=game_version,
+                                       download_path=f'TestMod-{name}.zip', created=datetime.now()))
+    (tmp_path / 'TestMod-1.0.zip').write_bytes(data)
+    (tmp_path / 'TestMod-1.2.zip').write_bytes(data[:100])
+    db.add(mod)
+    db.commit()
+
+    # Act
+    updated = backfill_version_files(str(tmp_path), batch_size=2)
+
+    # Assert
+    assert updated == 2, 'Versions with files should be updated'
+    versions = {v.friendly_version: (v.download_size, v.download_hash) for v in ModVersion.query}
+    assert versions == {
+        '1.0': (len(data), hashlib.sha256(data).hexdigest()),
+        '1.1': (None, None),
+        '1.2': (100, hashlib.sha256(data[:100]).hexdigest()),
+    }, 'Size and hash should match the files'